@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+from main import run_task
+from libreoffice_manager import LibreOfficeWorkerPool, DocumentGuard, load_document_hidden, store_document_copy
+from config import BATCH_WORKERS, BATCH_MAX_ITERATIONS
+
+def load_manifest(manifest_path):
+    """
+    マニフェスト (1行に1件の JSON) を読み込む。
+    各行は {"path": ワークブックのパス, "instruction": 指示} で、"output" (保存先) は省略できる。
+    相対パスはマニフェストのあるディレクトリを基準に解決する。
+
+    Returns:
+        list: 各行の dict。読み込めなかった行は "error" を持つ。
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                path, instruction = entry["path"], entry["instruction"]
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                items.append({"line": line_number, "error": f"マニフェストの行を解釈できません: {e}"})
+                continue
+            item = dict(entry, line=line_number, path=os.path.join(base_dir, path), instruction=instruction)
+            if entry.get("output"):
+                item["output"] = os.path.join(base_dir, entry["output"])
+            items.append(item)
+    return items
+
+def default_output_path(item, output_dir):
+    """保存先が指定されていない項目の出力パス。同名ファイルが衝突しないよう行番号を付ける。"""
+    return os.path.join(output_dir, f"{item['line']:04d}_{os.path.basename(item['path'])}")
+
+def process_item(worker, item, output_dir, max_iterations):
+    """
+    1件のワークブックを worker の soffice に非表示で読み込み、指示を実行して保存する。
+    """
+    record = {"line": item["line"], "path": item["path"], "instruction": item["instruction"],
+              "worker": worker.index, "timings": {}}
+    timings = record["timings"]
+    started = time.perf_counter()
+    desktop = worker.session.desktop
+    doc = None
+    try:
+        stage_started = time.perf_counter()
+        doc = load_document_hidden(desktop, item["path"])
+        timings["load"] = round(time.perf_counter() - stage_started, 3)
+        if doc is None:
+            record.update(status="error", error="ワークブックを読み込めませんでした。")
+            return record
+
+        stage_started = time.perf_counter()
+        session = worker.session.derive(doc)
+        result = run_task(item["instruction"], session, max_iterations=max_iterations,
+                          uno_guard=DocumentGuard(desktop, doc, session.lock),
+                          task_id=f"{item['line']:04d}:{os.path.basename(item['path'])}")
+        timings["run"] = round(time.perf_counter() - stage_started, 3)
+        record.update(iterations=result["iterations"], final_code=result["final_code"])
+
+        if not result["success"]:
+            record["status"] = "failed"
+            return record
+
+        output_path = item.get("output") or default_output_path(item, output_dir)
+        stage_started = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        store_document_copy(doc, output_path)
+        timings["save"] = round(time.perf_counter() - stage_started, 3)
+        record.update(status="success", output=output_path)
+        return record
+    finally:
+        if doc is not None:
+            try:
+                doc.close(True)
+            except Exception as e:
+                print(f"ワークブックのクローズ中にエラーが発生しました: {e}")
+        timings["total"] = round(time.perf_counter() - started, 3)
+
+def run_batch(manifest_path, report_path, output_dir, workers=BATCH_WORKERS, max_iterations=BATCH_MAX_ITERATIONS):
+    """
+    マニフェストの全項目をワーカープールで並行して処理し、1件ごとの結果をレポート (JSONL) に書き出す。
+
+    Returns:
+        dict: 状態 (success / failed / error) ごとの件数
+    """
+    items = load_manifest(manifest_path)
+    counts = {"success": 0, "failed": 0, "error": 0}
+    with open(report_path, "w", encoding="utf-8") as report:
+        def write(record):
+            counts[record["status"]] += 1
+            report.write(json.dumps(record, ensure_ascii=False) + "\n")
+            report.flush()
+            print(f"[{sum(counts.values())}/{len(items)}] {record['path']}: {record['status']}")
+
+        runnable = []
+        for item in items:
+            if "error" in item:
+                write({"line": item["line"], "path": None, "status": "error", "error": item["error"]})
+            else:
+                runnable.append(item)
+        if not runnable:
+            return counts
+
+        with LibreOfficeWorkerPool(min(workers, len(runnable))) as pool:
+            futures = {pool.submit(process_item, item, output_dir, max_iterations): item for item in runnable}
+            for future in concurrent.futures.as_completed(futures):
+                item = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {"line": item["line"], "path": item["path"], "instruction": item["instruction"],
+                              "status": "error", "error": f"{type(e).__name__}: {e}"}
+                write(record)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="マニフェストに列挙したワークブックに指示を一括で適用します。")
+    parser.add_argument("manifest", help='JSONL形式のマニフェスト (各行: {"path": ..., "instruction": ...})')
+    parser.add_argument("--report", default="batch_report.jsonl", help="結果レポートの出力先 (JSONL)")
+    parser.add_argument("--output-dir", default="batch_output", help="保存先を指定していない項目の出力ディレクトリ")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="同時に起動する soffice ワーカー数")
+    parser.add_argument("--max-iterations", type=int, default=BATCH_MAX_ITERATIONS, help="1件あたりの試行回数の上限")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = run_batch(args.manifest, args.report, args.output_dir, args.workers, args.max_iterations)
+    print(f"\n--- バッチ処理完了 ({time.perf_counter() - started:.1f} 秒) ---")
+    print(f"成功: {counts['success']} / 失敗: {counts['failed']} / エラー: {counts['error']}")
+    print(f"レポート: {args.report}")
+    return 0 if counts["failed"] == 0 and counts["error"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+ベンチマーク用の、Ollama の /api/generate を模擬するローカル HTTP サーバー。
+
+生成リクエストには generator_response を、画像付きの検証リクエストには verifier_response を返す。
+ストリーミング (NDJSON のチャンク転送) と非ストリーミングの両方に対応し、
+実際の Ollama と同じ計測値 (total_duration, eval_count など) を終端で返す。
+latency は最初のトークンまでの待ち、chunk_delay はチャンクごとの待ち (秒)。
+"""
+import json
+import time
+import threading
+import http.server
+
+# 既定の生成応答 (コードブロックと、期待値付きの検証クエリ)
+DEFAULT_GENERATOR_RESPONSE = '''A1 に見出しを書き込みます。
+
+```python
+write_range(sheet, "A1", [["集計"]])
+```
+
+```json
+{"cell_values": ["A1"], "expect": [{"cell": "A1", "equals": "集計"}]}
+```
+
+これで完了です。
+'''
+
+# 既定の検証応答
+DEFAULT_VERIFIER_RESPONSE = "Reason: The objective data and the image both show the requested change.\nVerdict: PASS\n"
+
+# 1チャンクあたりの文字数 (Ollama はおおむね1トークンずつ返す)
+CHUNK_CHARS = 8
+
+
+class FakeOllama:
+    """
+    スレッドで動く偽の Ollama サーバー。with 文で起動・停止する。
+
+    with FakeOllama(latency=0.05) as server:
+        client = OllamaClient(api_url=server.url)
+    """
+
+    def __init__(self, latency=0.0, chunk_delay=0.0, generator_response=DEFAULT_GENERATOR_RESPONSE,
+                 verifier_response=DEFAULT_VERIFIER_RESPONSE):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.generator_response = generator_response
+        self.verifier_response = verifier_response
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    def response_for(self, payload):
+        if payload.get("images"):
+            return self.verifier_response
+        return self.generator_response
+
+    def start(self):
+        handler = type("Handler", (_GenerateHandler,), {"ollama": self})
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+
+def _metrics(payload, text, started):
+    """Ollama の終端チャンクと同じ形式の計測値 (所要時間はナノ秒)。"""
+    total = int((time.perf_counter() - started) * 1e9)
+    prompt_tokens = (len(payload.get("prompt", "")) + len(payload.get("system", ""))) // 4
+    eval_tokens = max(1, len(text) // 4)
+    return {
+        "total_duration": total,
+        "load_duration": 0,
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": total // 4,
+        "eval_count": eval_tokens,
+        "eval_duration": total - total // 4,
+    }
+
+
+class _GenerateHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ollama = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.ollama._lock:
+            self.ollama.requests += 1
+        started = time.perf_counter()
+        text = self.ollama.response_for(payload)
+        model = payload.get("model", "")
+        if self.ollama.latency:
+            time.sleep(self.ollama.latency)
+
+        if not payload.get("stream"):
+            body = {"model": model, "response": text, "done": True}
+            body.update(_metrics(payload, text, started))
+            self._send_json(200, body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for offset in range(0, len(text), CHUNK_CHARS):
+                if self.ollama.chunk_delay:
+                    time.sleep(self.ollama.chunk_delay)
+                self._write_chunk({"model": model, "response": text[offset:offset + CHUNK_CHARS], "done": False})
+            final = {"model": model, "response": "", "done": True}
+            final.update(_metrics(payload, text, started))
+            self._write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが必要な部分の受信後に接続を閉じた (生成の打ち切り)
+            self.close_connection = True
+
+    def _write_chunk(self, obj):
+        data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,1018 @@
+"""
+ベンチマーク用の、プロセス内で動く UNO の偽物。
+
+本物の soffice やブリッジ無しで、autospreadsheet が使う範囲の UNO API (シート・セル範囲・
+getDataArray / getFormulaArray・列と行の Position・描画ページ・グラフ・Undo・PNG エクスポート) を再現する。
+UNO 呼び出し (メソッド呼び出し・プロパティ取得) のたびに BRIDGE.call() を通るので、
+ブリッジの往復 1 回あたりの遅延を BRIDGE.latency で設定でき、呼び出し回数も数えられる。
+
+install() で sys.modules に uno / unohelper / com.sun.star.* を登録してから、
+リポジトリのモジュールを import すること。
+"""
+import sys
+import time
+import types
+import threading
+import functools
+
+# 既定の列幅・行高 (1/100mm)。LibreOffice の既定値に近い値
+DEFAULT_COLUMN_WIDTH = 2258
+DEFAULT_ROW_HEIGHT = 452
+
+# LibreOffice Calc のシートの列数・行数の上限
+MAX_COLUMNS = 16384
+MAX_ROWS = 1048576
+
+# エクスポート結果として返す PNG (中身は検証しない)
+FAKE_PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+# 偽の数式で再現するエラー (数式に含まれる文字列, エラーコード)。数式の計算はしない
+FORMULA_ERRORS = (("/0", 532), ("#REF!", 524), ("#NAME?", 525))
+
+
+class Bridge:
+    """UNO ブリッジの往復を模擬する。latency 秒の待ちを入れ、呼び出し回数を数える。"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            # time.sleep は短い待ちが不正確なため、短い遅延はビジーウェイトで再現する
+            if self.latency >= 0.001:
+                time.sleep(self.latency)
+            else:
+                deadline = time.perf_counter() + self.latency
+                while time.perf_counter() < deadline:
+                    pass
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+
+
+BRIDGE = Bridge()
+
+
+def remote(method):
+    """メソッド呼び出しをブリッジの往復 1 回として数える。"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        BRIDGE.call()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def remote_property(getter):
+    """プロパティの取得をブリッジの往復 1 回として数える。"""
+    return property(remote(getter))
+
+
+class Struct:
+    """UNO の構造体 (CellRangeAddress, Point, Size, PropertyValue など)。"""
+
+    def __init__(self, *args, **fields):
+        for name, value in zip(self._fields, args):
+            setattr(self, name, value)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    _fields = ()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.__dict__})"
+
+
+class PropertyValue(Struct):
+    _fields = ("Name", "Handle", "Value", "State")
+
+
+class Point(Struct):
+    _fields = ("X", "Y")
+
+
+class Size(Struct):
+    _fields = ("Width", "Height")
+
+
+class Rectangle(Struct):
+    _fields = ("X", "Y", "Width", "Height")
+
+
+class CellAddress(Struct):
+    _fields = ("Sheet", "Column", "Row")
+
+
+class CellRangeAddress(Struct):
+    _fields = ("Sheet", "StartColumn", "StartRow", "EndColumn", "EndRow")
+
+
+class ByteSequence:
+    def __init__(self, value):
+        self.value = value
+
+
+STRUCTS = {
+    "com.sun.star.beans.PropertyValue": PropertyValue,
+    "com.sun.star.awt.Point": Point,
+    "com.sun.star.awt.Size": Size,
+    "com.sun.star.awt.Rectangle": Rectangle,
+    "com.sun.star.table.CellAddress": CellAddress,
+    "com.sun.star.table.CellRangeAddress": CellRangeAddress,
+}
+
+
+def column_letters(index):
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def parse_cell(reference):
+    """"B12" を (列, 行) に変換する。"""
+    reference = reference.replace("$", "")
+    letters = "".join(ch for ch in reference if ch.isalpha()).upper()
+    digits = reference[len(letters):]
+    column = 0
+    for ch in letters:
+        column = column * 26 + (ord(ch) - ord("A") + 1)
+    return column - 1, int(digits) - 1
+
+
+# --- スプレッドシート ---
+
+class FakeCellRange:
+    def __init__(self, sheet, start_column, start_row, end_column, end_row):
+        self.sheet = sheet
+        self.bounds = (start_column, start_row, end_column, end_row)
+        self.CellStyle = "Default"
+
+    @remote
+    def getRangeAddress(self):
+        c0, r0, c1, r1 = self.bounds
+        return CellRangeAddress(self.sheet.index, c0, r0, c1, r1)
+
+    @remote
+    def getCellAddress(self):
+        return CellAddress(self.sheet.index, self.bounds[0], self.bounds[1])
+
+    @remote
+    def getDataArray(self):
+        return self.sheet.read_block(self.bounds, formulas=False)
+
+    @remote
+    def getFormulaArray(self):
+        return self.sheet.read_block(self.bounds, formulas=True)
+
+    @remote
+    def setDataArray(self, rows):
+        self.sheet.write_block(self.bounds, rows, formulas=False)
+
+    @remote
+    def setFormulaArray(self, rows):
+        self.sheet.write_block(self.bounds, rows, formulas=True)
+
+    @remote
+    def getCellByPosition(self, column, row):
+        c0, r0, _, _ = self.bounds
+        return FakeCellRange(self.sheet, c0 + column, r0 + row, c0 + column, r0 + row)
+
+    @remote
+    def getCellRangeByPosition(self, start_column, start_row, end_column, end_row):
+        c0, r0, _, _ = self.bounds
+        return FakeCellRange(self.sheet, c0 + start_column, r0 + start_row, c0 + end_column, r0 + end_row)
+
+    # --- 単一セルとしての操作 ---
+    @remote
+    def getValue(self):
+        value = self.sheet.get(self.bounds[0], self.bounds[1])
+        return value if isinstance(value, float) else 0.0
+
+    @remote
+    def setValue(self, value):
+        self.sheet.set(self.bounds[0], self.bounds[1], float(value))
+
+    @remote
+    def getString(self):
+        value = self.sheet.get(self.bounds[0], self.bounds[1])
+        return value if isinstance(value, str) else repr(value)
+
+    @remote
+    def setString(self, value):
+        self.sheet.set(self.bounds[0], self.bounds[1], str(value))
+
+    @remote
+    def getFormula(self):
+        return self.sheet.read_block(self.bounds, formulas=True)[0][0]
+
+    @remote
+    def setFormula(self, formula):
+        self.sheet.write_block(self.bounds, ((formula,),), formulas=True)
+
+    @remote
+    def getError(self):
+        return self.sheet.errors.get((self.bounds[0], self.bounds[1]), 0)
+
+    @remote
+    def getType(self):
+        value = self.sheet.get(self.bounds[0], self.bounds[1])
+        if value == "":
+            return 0
+        return 1 if isinstance(value, float) else 2
+
+    @remote
+    def setPropertyValues(self, names, values):
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+
+
+class FakeCursor:
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.address = CellRangeAddress(sheet.index, 0, 0, 0, 0)
+
+    @remote
+    def gotoEndOfUsedArea(self, expand):
+        end_column, end_row = self.sheet.used_end()
+        self.address = CellRangeAddress(self.sheet.index, end_column, end_row, end_column, end_row)
+
+    @remote
+    def getRangeAddress(self):
+        return self.address
+
+
+class FakeAxisEntry:
+    """1 つの列または行。Position は先頭からの累積オフセット。"""
+
+    def __init__(self, axis, index):
+        self.axis = axis
+        self.index = index
+
+    @remote_property
+    def Position(self):
+        offset = self.axis.offset(self.index)
+        return Point(offset, 0) if self.axis.horizontal else Point(0, offset)
+
+    @remote_property
+    def Width(self):
+        return self.axis.size_of(self.index)
+
+    @remote_property
+    def Height(self):
+        return self.axis.size_of(self.index)
+
+    @remote_property
+    def IsVisible(self):
+        return self.index not in self.axis.hidden
+
+
+class FakeAxis:
+    """シートの列 (horizontal=True) または行の集まり。すべて同じ大きさで、hidden の番号は幅 0。"""
+
+    def __init__(self, count, size, horizontal, hidden=()):
+        self.count = count
+        self.size = size
+        self.horizontal = horizontal
+        self.hidden = sorted(set(hidden))
+
+    def size_of(self, index):
+        return 0 if index in self.hidden else self.size
+
+    def offset(self, index):
+        hidden_before = sum(1 for h in self.hidden if h < index)
+        return (index - hidden_before) * self.size
+
+    @remote
+    def getCount(self):
+        return self.count
+
+    @remote
+    def getByIndex(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return FakeAxisEntry(self, index)
+
+
+class FakeChartDiagram:
+    def __init__(self, diagram_type):
+        self.diagram_type = diagram_type
+
+    @remote
+    def getDiagramType(self):
+        return self.diagram_type
+
+    @remote
+    def getImplementationName(self):
+        return self.diagram_type
+
+
+class FakeChartDocument:
+    def __init__(self, diagram_type):
+        self.diagram = FakeChartDiagram(diagram_type)
+        self.modified = False
+
+    @remote
+    def getDiagram(self):
+        return self.diagram
+
+    @remote
+    def setDiagram(self, diagram):
+        self.diagram = diagram
+        self.modified = True
+
+    @remote
+    def isModified(self):
+        return self.modified
+
+    @remote
+    def setModified(self, modified):
+        self.modified = modified
+
+    @remote
+    def createInstance(self, service_name):
+        return FakeChartDiagram(service_name)
+
+
+class FakeChart:
+    """sheet.getCharts() の要素 (TableChart) と、描画ページ上の OLE 図形を兼ねる。"""
+
+    def __init__(self, sheet, name, rectangle, diagram_type="com.sun.star.chart.BarDiagram"):
+        self.sheet = sheet
+        self.Name = name
+        self.PersistName = name
+        self.rectangle = rectangle
+        self.chart_document = FakeChartDocument(diagram_type)
+        self.EmbeddedObject = self.chart_document
+
+    @remote
+    def getName(self):
+        return self.Name
+
+    @remote
+    def getEmbeddedObject(self):
+        return self.chart_document
+
+    # --- 描画ページ上の図形としての操作 ---
+    @remote
+    def getShapeType(self):
+        return "com.sun.star.drawing.OLE2Shape"
+
+    @remote
+    def getAnchor(self):
+        column = self.sheet.columns_axis_index(self.rectangle.X)
+        row = self.sheet.rows_axis_index(self.rectangle.Y)
+        return FakeCellRange(self.sheet, column, row, column, row)
+
+    @remote
+    def getPosition(self):
+        # アンカーセルからの相対位置
+        column = self.sheet.columns_axis_index(self.rectangle.X)
+        row = self.sheet.rows_axis_index(self.rectangle.Y)
+        return Point(self.rectangle.X - self.sheet.columns.offset(column),
+                     self.rectangle.Y - self.sheet.rows.offset(row))
+
+    @remote
+    def getSize(self):
+        return Size(self.rectangle.Width, self.rectangle.Height)
+
+
+class FakeCharts:
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.charts = []
+
+    @remote
+    def getCount(self):
+        return len(self.charts)
+
+    @remote
+    def getByIndex(self, index):
+        return self.charts[index]
+
+    @remote
+    def getByName(self, name):
+        for chart in self.charts:
+            if chart.Name == name:
+                return chart
+        raise KeyError(name)
+
+    @remote
+    def hasByName(self, name):
+        return any(chart.Name == name for chart in self.charts)
+
+    @remote
+    def getElementNames(self):
+        return tuple(chart.Name for chart in self.charts)
+
+    @remote
+    def addNewByName(self, name, rectangle, ranges, column_headers, row_headers):
+        self.charts.append(FakeChart(self.sheet, name, rectangle))
+        self.sheet.document.record_undo(f"グラフの挿入 {name}")
+
+
+class FakeDrawPage:
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    @remote
+    def getCount(self):
+        return len(self.sheet.charts.charts)
+
+    @remote
+    def getByIndex(self, index):
+        return self.sheet.charts.charts[index]
+
+    @remote
+    def hasElements(self):
+        return bool(self.sheet.charts.charts)
+
+
+class FakeSheet:
+    """
+    値を行のリストで保持するシート。値は float、文字列、または "" (空セル)。
+    数式は (列, 行) をキーに別に保持し、値は書き込まれた時点のものを使う (再計算はしない)。
+    エラーになる数式 (FORMULA_ERRORS) のセルは、実際の Calc と同様に getDataArray で None を返し、
+    getError() でエラーコードを返す。
+    """
+
+    def __init__(self, document, index, name, rows=(), hidden_columns=(), hidden_rows=()):
+        self.document = document
+        self.index = index
+        self.name = name
+        self.values = [list(row) for row in rows]
+        self.formulas = {}
+        self.errors = {}
+        self.columns = FakeAxis(MAX_COLUMNS, DEFAULT_COLUMN_WIDTH, True, hidden_columns)
+        self.rows = FakeAxis(MAX_ROWS, DEFAULT_ROW_HEIGHT, False, hidden_rows)
+        self.charts = FakeCharts(self)
+        self.draw_page = FakeDrawPage(self)
+        self.print_areas = ()
+        self.PageStyle = "Default"
+
+    # --- 内部の読み書き (ブリッジ呼び出しとしては数えない) ---
+    def used_end(self):
+        end_row = len(self.values) - 1
+        end_column = max((len(row) for row in self.values), default=1) - 1
+        for column, row in self.formulas:
+            end_column, end_row = max(end_column, column), max(end_row, row)
+        return max(end_column, 0), max(end_row, 0)
+
+    def get(self, column, row):
+        if row < len(self.values) and column < len(self.values[row]):
+            return self.values[row][column]
+        return ""
+
+    def set(self, column, row, value):
+        while len(self.values) <= row:
+            self.values.append([])
+        line = self.values[row]
+        if len(line) <= column:
+            line.extend([""] * (column + 1 - len(line)))
+        line[column] = value
+        self.formulas.pop((column, row), None)
+        self.errors.pop((column, row), None)
+        self.document.modified = True
+
+    def read_block(self, bounds, formulas):
+        c0, r0, c1, r1 = bounds
+        width = c1 - c0 + 1
+        block = []
+        for row_index in range(r0, r1 + 1):
+            line = self.values[row_index] if row_index < len(self.values) else []
+            row = line[c0:c1 + 1]
+            row = row + [""] * (width - len(row))
+            if formulas:
+                row = [self.formulas.get((c0 + i, row_index)) or _formula_text(value) for i, value in enumerate(row)]
+            block.append(tuple(row))
+        return tuple(block)
+
+    def write_block(self, bounds, rows, formulas):
+        c0, r0, _, _ = bounds
+        for row_offset, row in enumerate(rows):
+            for column_offset, value in enumerate(row):
+                column, row_index = c0 + column_offset, r0 + row_offset
+                if formulas and isinstance(value, str) and value.startswith("="):
+                    code = next((code for text, code in FORMULA_ERRORS if text in value), 0)
+                    self.set(column, row_index, None if code else 0.0)
+                    self.formulas[(column, row_index)] = value
+                    if code:
+                        self.errors[(column, row_index)] = code
+                elif formulas and isinstance(value, str) and _is_number(value):
+                    self.set(column, row_index, float(value))
+                else:
+                    self.set(column, row_index, value)
+        self.document.record_undo("データの入力")
+
+    def columns_axis_index(self, x):
+        return _index_at(self.columns, x)
+
+    def rows_axis_index(self, y):
+        return _index_at(self.rows, y)
+
+    # --- UNO API ---
+    @remote
+    def getName(self):
+        return self.name
+
+    @remote
+    def getCellRangeByName(self, reference):
+        if ":" in reference:
+            start, end = reference.split(":", 1)
+            c0, r0 = parse_cell(start)
+            c1, r1 = parse_cell(end)
+        else:
+            c0, r0 = parse_cell(reference)
+            c1, r1 = c0, r0
+        return FakeCellRange(self, c0, r0, c1, r1)
+
+    @remote
+    def getCellRangeByPosition(self, start_column, start_row, end_column, end_row):
+        return FakeCellRange(self, start_column, start_row, end_column, end_row)
+
+    @remote
+    def getCellByPosition(self, column, row):
+        return FakeCellRange(self, column, row, column, row)
+
+    @remote
+    def createCursor(self):
+        return FakeCursor(self)
+
+    @remote
+    def getColumns(self):
+        return self.columns
+
+    @remote
+    def getRows(self):
+        return self.rows
+
+    @remote
+    def getCharts(self):
+        return self.charts
+
+    @remote
+    def getDrawPage(self):
+        return self.draw_page
+
+    @remote
+    def getPrintAreas(self):
+        return self.print_areas
+
+    @remote
+    def setPrintAreas(self, areas):
+        self.print_areas = tuple(areas)
+
+    @remote_property
+    def Charts(self):
+        return self.charts
+
+
+def _formula_text(value):
+    """数式の無いセルの getFormulaArray の値 (入力された値の文字列)。"""
+    if value == "" or value is None:
+        return ""
+    return value if isinstance(value, str) else f"{value:g}"
+
+
+def _index_at(axis, coordinate):
+    """座標を含む列・行の番号 (非表示の列・行が無い前提の近似)。"""
+    return min(axis.count - 1, max(0, int(coordinate // axis.size)))
+
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+class FakeSheets:
+    def __init__(self, document):
+        self.document = document
+
+    @remote
+    def getCount(self):
+        return len(self.document.sheets)
+
+    @remote
+    def getByIndex(self, index):
+        return self.document.sheets[index]
+
+    @remote
+    def getByName(self, name):
+        for sheet in self.document.sheets:
+            if sheet.name == name:
+                return sheet
+        raise KeyError(name)
+
+    @remote
+    def hasByName(self, name):
+        return any(sheet.name == name for sheet in self.document.sheets)
+
+    @remote
+    def getElementNames(self):
+        return tuple(sheet.name for sheet in self.document.sheets)
+
+    @remote
+    def insertNewByName(self, name, position):
+        sheet = FakeSheet(self.document, len(self.document.sheets), name)
+        self.document.sheets.insert(position, sheet)
+        self.document.record_undo(f"シートの挿入 {name}")
+
+
+class FakeUndoManager:
+    def __init__(self, document):
+        self.document = document
+        self.undo_titles = []
+        self.redo_titles = []
+        self.locked = 0
+        self.context_depth = 0
+        self.context_title = None
+        self.context_dirty = False
+
+    def record(self, title):
+        if self.locked:
+            return
+        if self.context_depth:
+            self.context_dirty = True
+            return
+        self.undo_titles.insert(0, title)
+        self.redo_titles = []
+
+    @remote
+    def enterUndoContext(self, title):
+        if self.context_depth == 0:
+            self.context_title = title
+            self.context_dirty = False
+        self.context_depth += 1
+
+    @remote
+    def leaveUndoContext(self):
+        self.context_depth -= 1
+        if self.context_depth == 0 and self.context_dirty:
+            self.undo_titles.insert(0, self.context_title)
+            self.redo_titles = []
+
+    @remote
+    def isUndoPossible(self):
+        return bool(self.undo_titles)
+
+    @remote
+    def getCurrentUndoActionTitle(self):
+        return self.undo_titles[0] if self.undo_titles else ""
+
+    @remote
+    def getAllUndoActionTitles(self):
+        return tuple(self.undo_titles)
+
+    @remote
+    def getAllRedoActionTitles(self):
+        return tuple(self.redo_titles)
+
+    @remote
+    def undo(self):
+        # 偽物では内容は戻さず、履歴だけを動かす
+        self.redo_titles.insert(0, self.undo_titles.pop(0))
+
+    @remote
+    def lock(self):
+        self.locked += 1
+
+    @remote
+    def unlock(self):
+        self.locked -= 1
+
+
+class FakePageStyle:
+    def __init__(self):
+        self.PageScale = 100
+        self.ScaleToPages = 0
+        self.ScaleToPagesX = 0
+        self.ScaleToPagesY = 0
+
+    @remote
+    def getPropertyValue(self, name):
+        return getattr(self, name)
+
+    @remote
+    def setPropertyValue(self, name, value):
+        setattr(self, name, value)
+
+
+class FakeNameAccess:
+    def __init__(self, entries):
+        self.entries = entries
+
+    @remote
+    def getByName(self, name):
+        return self.entries[name]
+
+
+class FakeFrame:
+    pass
+
+
+class FakeController:
+    def __init__(self, document):
+        self.document = document
+        self.frame = FakeFrame()
+
+    @remote
+    def getActiveSheet(self):
+        return self.document.sheets[self.document.active_sheet]
+
+    @remote
+    def getFrame(self):
+        return self.frame
+
+    @remote_property
+    def ActiveSheet(self):
+        return self.document.sheets[self.document.active_sheet]
+
+
+class FakeDocument:
+    """
+    Calc ドキュメント。sheets は (シート名, 行のリスト) の組のリスト。
+    export_latency: PNG エクスポート (storeToURL) 1 回にかかる時間 (秒)。
+    """
+
+    def __init__(self, sheets=(("Sheet1", ()),), url="", export_latency=0.0):
+        self.sheets = [FakeSheet(self, index, name, rows) for index, (name, rows) in enumerate(sheets)]
+        self.active_sheet = 0
+        self.url = url
+        self.export_latency = export_latency
+        self.modified = False
+        self.RuntimeUID = str(id(self))
+        self.controller = FakeController(self)
+        self.undo_manager = FakeUndoManager(self)
+        self.page_style = FakePageStyle()
+        self.style_families = FakeNameAccess({"PageStyles": FakeNameAccess({"Default": self.page_style})})
+        self.sheets_access = FakeSheets(self)
+        self.exports = 0
+        self.automatic_calculation = True
+
+    def record_undo(self, title):
+        self.modified = True
+        self.undo_manager.record(title)
+
+    @remote_property
+    def Sheets(self):
+        return self.sheets_access
+
+    @remote_property
+    def CurrentController(self):
+        return self.controller
+
+    @remote
+    def getSheets(self):
+        return self.sheets_access
+
+    @remote
+    def getCurrentController(self):
+        return self.controller
+
+    @remote
+    def getUndoManager(self):
+        return self.undo_manager
+
+    @remote
+    def getStyleFamilies(self):
+        return self.style_families
+
+    @remote
+    def isModified(self):
+        return self.modified
+
+    @remote
+    def setModified(self, modified):
+        self.modified = modified
+
+    @remote
+    def getURL(self):
+        return self.url
+
+    @remote
+    def getArgs(self):
+        return (PropertyValue("FilterName", 0, "calc8", 0),)
+
+    @remote
+    def supportsService(self, name):
+        return name == "com.sun.star.sheet.SpreadsheetDocument"
+
+    @remote
+    def lockControllers(self):
+        pass
+
+    @remote
+    def unlockControllers(self):
+        pass
+
+    @remote
+    def addActionLock(self):
+        pass
+
+    @remote
+    def removeActionLock(self):
+        pass
+
+    @remote
+    def isAutomaticCalculationEnabled(self):
+        return self.automatic_calculation
+
+    @remote
+    def enableAutomaticCalculation(self, enabled):
+        self.automatic_calculation = enabled
+
+    @remote
+    def calculate(self):
+        pass
+
+    @remote
+    def storeToURL(self, url, properties):
+        properties = {prop.Name: prop.Value for prop in properties}
+        if self.export_latency:
+            time.sleep(self.export_latency)
+        self.exports += 1
+        stream = properties.get("OutputStream")
+        if stream is not None:
+            stream.writeBytes(ByteSequence(FAKE_PNG))
+            stream.closeOutput()
+
+    @remote
+    def close(self, deliver_ownership):
+        pass
+
+    @remote
+    def dispose(self):
+        pass
+
+
+class FakeEnumeration:
+    def __init__(self, items):
+        self.items = list(items)
+        self.position = 0
+
+    @remote
+    def hasMoreElements(self):
+        return self.position < len(self.items)
+
+    @remote
+    def nextElement(self):
+        item = self.items[self.position]
+        self.position += 1
+        return item
+
+
+class FakeEnumerationAccess:
+    """desktop.getComponents() の戻り値。PyUNO と同様に、直接の反復と createEnumeration() の両方に対応する。"""
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    @remote
+    def createEnumeration(self):
+        return FakeEnumeration(self.items)
+
+    def __iter__(self):
+        enumeration = self.createEnumeration()
+        while enumeration.hasMoreElements():
+            yield enumeration.nextElement()
+
+
+class FakeDesktop:
+    def __init__(self, documents):
+        self.documents = list(documents)
+        self.active_frame = None
+
+    @remote
+    def getCurrentComponent(self):
+        return self.documents[0] if self.documents else None
+
+    @remote
+    def getComponents(self):
+        return FakeEnumerationAccess(self.documents)
+
+    @remote
+    def getActiveFrame(self):
+        return self.active_frame
+
+    @remote
+    def setActiveFrame(self, frame):
+        self.active_frame = frame
+
+    @remote
+    def loadComponentFromURL(self, url, target, flags, properties):
+        document = FakeDocument(url=url)
+        self.documents.append(document)
+        return document
+
+    @remote
+    def terminate(self):
+        pass
+
+
+class FakeServiceManager:
+    def __init__(self, context):
+        self.context = context
+
+    @remote
+    def createInstanceWithContext(self, name, context):
+        if name == "com.sun.star.frame.Desktop":
+            return self.context.desktop
+        if name == "com.sun.star.bridge.UnoUrlResolver":
+            return FakeResolver(self.context)
+        raise RuntimeError(f"偽の UNO では未対応のサービスです: {name}")
+
+
+class FakeResolver:
+    def __init__(self, remote_context):
+        self.remote_context = remote_context
+
+    def resolve(self, url):
+        BRIDGE.call()
+        return self.remote_context
+
+
+class FakeContext:
+    def __init__(self, desktop):
+        self.desktop = desktop
+        self.ServiceManager = FakeServiceManager(self)
+
+
+class _LocalContext:
+    """uno.getComponentContext() が返すローカルのコンテキスト。リゾルバだけを作れる。"""
+
+    def __init__(self, remote_context):
+        self.ServiceManager = types.SimpleNamespace(
+            createInstanceWithContext=lambda name, context: FakeResolver(remote_context))
+
+
+def install(documents, latency=0.0):
+    """
+    偽の uno / unohelper / com.sun.star.* を sys.modules に登録し、
+    documents (FakeDocument のリスト。先頭が現在のドキュメント) を持つデスクトップを返す。
+    すでに登録済みの場合は、接続先のデスクトップだけを差し替える。
+    """
+    BRIDGE.latency = latency
+    BRIDGE.reset()
+    desktop = FakeDesktop(documents)
+    remote_context = FakeContext(desktop)
+
+    uno = sys.modules.get("uno")
+    if uno is None or not getattr(uno, "_is_fake", False):
+        uno = types.ModuleType("uno")
+        uno._is_fake = True
+        uno.Any = lambda type_name, value: value
+        uno.invoke = lambda obj, name, args: getattr(obj, name)(*args)
+        uno.createUnoStruct = lambda type_name, *args, **fields: STRUCTS[type_name](*args, **fields)
+        uno.systemPathToFileUrl = lambda path: "file://" + path.replace("\\", "/")
+        uno.fileUrlToSystemPath = lambda url: url[len("file://"):]
+        uno.com = types.SimpleNamespace(sun=types.SimpleNamespace(star=types.SimpleNamespace(
+            table=types.SimpleNamespace(CellContentType=types.SimpleNamespace(EMPTY=0, VALUE=1, TEXT=2, FORMULA=3)))))
+
+        unohelper = types.ModuleType("unohelper")
+        unohelper.Base = type("Base", (), {})
+
+        modules = {"uno": uno, "unohelper": unohelper}
+        for name in ("com", "com.sun", "com.sun.star", "com.sun.star.beans", "com.sun.star.io",
+                     "com.sun.star.awt", "com.sun.star.table"):
+            modules[name] = types.ModuleType(name)
+        modules["com.sun.star.beans"].PropertyValue = PropertyValue
+        modules["com.sun.star.io"].XOutputStream = type("XOutputStream", (), {})
+        modules["com.sun.star.awt"].Rectangle = Rectangle
+        modules["com.sun.star.awt"].Point = Point
+        modules["com.sun.star.awt"].Size = Size
+        modules["com.sun.star.table"].CellRangeAddress = CellRangeAddress
+        modules["com.sun.star.table"].CellAddress = CellAddress
+        sys.modules.update(modules)
+
+    uno.getComponentContext = lambda: _LocalContext(remote_context)
+    return desktop
+
+
+def make_document(rows, columns, charts=0, formulas_every=0, export_latency=0.0):
+    """
+    rows 行 x columns 列に数値と文字列が入ったシートを1枚持つドキュメントを作る。
+    charts 個のグラフをデータの右下に並べて置く。formulas_every > 0 なら、その間隔の行の末尾列を数式にする。
+    """
+    data = [["名前"] + [f"列{column}" for column in range(1, columns)]]
+    for row in range(1, rows):
+        data.append([f"項目{row}"] + [float(row * column) for column in range(1, columns)])
+    document = FakeDocument(sheets=(("Sheet1", data),), export_latency=export_latency)
+    sheet = document.sheets[0]
+    if formulas_every:
+        last = column_letters(columns - 1)
+        for row in range(1, rows, formulas_every):
+            sheet.formulas[(columns - 1, row)] = f"=SUM(B{row + 1}:{last}{row + 1})"
+    for index in range(charts):
+        x = (columns + 1 + index * 6) * DEFAULT_COLUMN_WIDTH
+        y = (rows // 2) * DEFAULT_ROW_HEIGHT
+        sheet.charts.charts.append(FakeChart(sheet, f"Chart{index + 1}", Rectangle(x, y, 12000, 8000)))
+    return document
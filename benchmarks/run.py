@@ -0,0 +1,255 @@
+"""
+soffice と Ollama を使わずに再現できるベンチマーク。
+
+偽の UNO (fake_uno) と偽の Ollama サーバー (fake_ollama) を使い、次の処理をシートの大きさごとに計測する。
+  state       state_extractor.get_calc_state (batched / prose)
+  print_area  capture_png の印刷範囲の計算と PNG エクスポート (キャッシュなし / 指紋によるキャッシュ)
+  extract     main.extract_code_and_query
+  main_loop   main.run_task の1タスク (期待値による高速検証 / 画像検証)
+
+使い方:
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 100 10000 --latency 0.0002 --only state print_area
+    python benchmarks/run.py --json bench.json
+
+--latency は UNO 呼び出し1回あたりの往復時間、--export-latency は PNG エクスポート1回にかかる時間 (秒)。
+calls/op は1回の処理あたりの UNO 呼び出し回数。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import contextlib
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import fake_uno
+from fake_uno import BRIDGE, make_document
+from fake_ollama import FakeOllama
+
+# リポジトリのモジュールは偽の uno を登録してから読み込む
+_desktop = fake_uno.install([])
+
+import llm_wrapper
+import executor
+import capture_png
+import tracing
+import main
+from libreoffice_manager import UnoSession
+from state_extractor import get_calc_state
+
+# 既定のシートの行数
+DEFAULT_SIZES = (100, 1000, 10000)
+
+# ベンチマーク用のシートの列数
+COLUMNS = 10
+
+# 各シートに置くグラフの数
+CHARTS = 3
+
+BENCHMARKS = ("state", "print_area", "extract", "main_loop")
+
+# PNG エクスポート1回にかかる時間 (秒)。main_cli で --export-latency の値に置き換える
+export_latency = 0.0
+
+
+def configure(ollama_url):
+    """リポジトリの設定をベンチマーク用に上書きする (応答キャッシュ・トレースファイル・子プロセス実行を使わない)。"""
+    llm_wrapper._default_client = llm_wrapper.OllamaClient(api_url=ollama_url)
+    llm_wrapper.LLM_CACHE_MODE = "bypass"
+    tracing.get_tracer().trace_path = None
+    tracing.get_tracer().prometheus_path = None
+    executor.EXECUTION_MODE = "inprocess"
+    executor.SAVE_DEBUG_IMAGES = False
+
+
+def connect(doc):
+    """doc だけを開いている偽の soffice に接続したセッションを返す。"""
+    _desktop.documents = [doc]
+    session = UnoSession().connect()
+    session.doc = doc
+    return session
+
+
+def measure(name, size, repeat, setup, fn):
+    """
+    setup() の戻り値を引数に fn を repeat 回実行し、所要時間と UNO 呼び出し回数を集計する。
+    setup は計測に含めない。fn の標準出力は捨てる。
+    """
+    durations = []
+    calls = []
+    for _ in range(repeat):
+        state = setup()
+        BRIDGE.reset()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            fn(state)
+            durations.append(time.perf_counter() - started)
+        calls.append(BRIDGE.calls)
+    return {
+        "benchmark": name,
+        "size": size,
+        "repeat": repeat,
+        "mean_ms": statistics.mean(durations) * 1000,
+        "median_ms": statistics.median(durations) * 1000,
+        "min_ms": min(durations) * 1000,
+        "calls_per_op": statistics.mean(calls),
+    }
+
+
+# --- state_extractor ---
+
+def state_query(rows):
+    return {
+        "cell_values": ["A1", f"B2:E{rows}", "Sheet1.J1:J10", f"A{rows}"],
+        "active_sheet_name": True,
+        "sheet_count": True,
+        "sheet_names": True,
+        "chart_count": True,
+        "chart_types": True,
+        "document_count": True,
+    }
+
+
+def bench_state(size, repeat):
+    query = state_query(size)
+
+    def setup():
+        return connect(make_document(size, COLUMNS, charts=CHARTS))
+
+    return [
+        measure("state/batched", size, repeat, setup,
+                lambda session: get_calc_state(query, session=session, batched=True)),
+        measure("state/prose", size, repeat, setup,
+                lambda session: get_calc_state(query, session=session, batched=False)),
+    ]
+
+
+# --- capture_png ---
+
+def bench_print_area(size, repeat):
+    def setup():
+        capture_png._render_cache.clear()
+        return make_document(size, COLUMNS, charts=CHARTS, formulas_every=10, export_latency=export_latency)
+
+    def render(doc):
+        capture_png.export_active_sheet_to_png(
+            doc, None, max_side=executor.VERIFIER_IMAGE_MAX_SIDE,
+            max_pixels=executor.VERIFIER_IMAGE_MAX_PIXELS, use_cache=False)
+
+    def render_cached(doc):
+        capture_png.export_active_sheet_to_png(
+            doc, None, max_side=executor.VERIFIER_IMAGE_MAX_SIDE,
+            max_pixels=executor.VERIFIER_IMAGE_MAX_PIXELS, use_cache=True)
+
+    def setup_cached():
+        # 1回描画してキャッシュに載せておく
+        doc = setup()
+        render_cached(doc)
+        return doc
+
+    return [
+        measure("print_area/render", size, repeat, setup, render),
+        measure("print_area/cache_hit", size, repeat, setup_cached, render_cached),
+    ]
+
+
+# --- main.extract_code_and_query ---
+
+def generator_response(code_lines):
+    body = "\n".join(f"values_{i} = read_range(sheet, \"A{i + 1}:J{i + 1}\")" for i in range(code_lines))
+    query = {"cell_values": [f"A1:J{code_lines}"], "expect": [{"range": f"A1:J{code_lines}", "no_errors": True}]}
+    return (f"範囲を読み取ります。\n\n```python\n{body}\n```\n\n"
+            f"```json\n{json.dumps(query, ensure_ascii=False)}\n```\n\n以上です。\n")
+
+
+def bench_extract(size, repeat):
+    # シートの行数の代わりに、応答に含まれるコードの行数を size とする
+    text = generator_response(size)
+    return [measure("extract", size, repeat, lambda: text, main.extract_code_and_query)]
+
+
+# --- main.run_task ---
+
+def task_response(rows, fast):
+    """B〜E 列の行ごとの合計を L 列に書き込むコードと、その検証クエリ。"""
+    code = (f'data = read_range(sheet, "B2:E{rows}")\n'
+            f'fill_column(sheet, "L2", [sum(row) for row in data])\n'
+            f'write_range(sheet, "L1", [["合計"]])')
+    if fast:
+        # make_document では 2 行目の B〜E 列は 1, 2, 3, 4
+        query = {"cell_values": ["L1"], "expect": [{"cell": "L2", "equals": 10},
+                                                  {"range": f"L2:L{rows}", "no_errors": True}]}
+    else:
+        query = {"cell_values": ["L1:L5"], "chart_count": True}
+    return (f"L 列に合計を書き込みます。\n\n```python\n{code}\n```\n\n"
+            f"```json\n{json.dumps(query, ensure_ascii=False)}\n```\n")
+
+
+def bench_main_loop(size, repeat, ollama):
+    def setup():
+        return connect(make_document(size, COLUMNS, charts=CHARTS, export_latency=export_latency))
+
+    def run(session):
+        result = main.run_task("B〜E列の合計をL列に入力して", session, max_iterations=1)
+        if not result["success"]:
+            raise RuntimeError("ベンチマークのタスクが失敗しました。")
+
+    results = []
+    for label, fast in (("fast_verifier", True), ("vision", False)):
+        ollama.generator_response = task_response(size, fast)
+        results.append(measure(f"main_loop/{label}", size, repeat, setup, run))
+    return results
+
+
+def print_table(results):
+    header = f"{'benchmark':<24} {'size':>7} {'mean ms':>10} {'median ms':>10} {'min ms':>10} {'calls/op':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['benchmark']:<24} {r['size']:>7} {r['mean_ms']:>10.3f} {r['median_ms']:>10.3f} "
+              f"{r['min_ms']:>10.3f} {r['calls_per_op']:>10.1f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="偽の UNO と偽の Ollama を使ってベンチマークを実行します。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="シートの行数")
+    parser.add_argument("--repeat", type=int, default=5, help="各計測の繰り返し回数")
+    parser.add_argument("--latency", type=float, default=0.0, help="UNO 呼び出し1回あたりの往復時間 (秒)")
+    parser.add_argument("--export-latency", type=float, default=0.0, help="PNG エクスポート1回にかかる時間 (秒)")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="偽の Ollama の最初のトークンまでの待ち (秒)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="実行するベンチマーク")
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    global export_latency
+    BRIDGE.latency = args.latency
+    export_latency = args.export_latency
+    selected = args.only or BENCHMARKS
+    results = []
+    with FakeOllama(latency=args.llm_latency) as ollama:
+        configure(ollama.url)
+        for size in args.sizes:
+            if "state" in selected:
+                results.extend(bench_state(size, args.repeat))
+            if "print_area" in selected:
+                results.extend(bench_print_area(size, args.repeat))
+            if "extract" in selected:
+                results.extend(bench_extract(size, args.repeat))
+            if "main_loop" in selected:
+                results.extend(bench_main_loop(size, args.repeat, ollama))
+        llm_wrapper.get_client().close()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "export_latency": args.export_latency,
+                       "llm_latency": args.llm_latency, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
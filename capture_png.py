@@ -1,17 +1,338 @@
 import uno
+import unohelper
 import os
+import io
+import math
+import hashlib
+import threading
+import collections
 from com.sun.star.beans import PropertyValue
+from com.sun.star.io import XOutputStream
+from libreoffice_manager import UnoSession
+from state_extractor import parse_range_reference, split_sheet_reference
+from config import RENDER_CACHE_MAX_ENTRIES
 
-def export_active_sheet_to_png(doc, output_path):
+# 画面表示相当 (96dpi) の 1/100mm あたりのピクセル数
+NATURAL_PIXELS_PER_UNIT = 96 / 2540
+
+class BytesOutputStream(unohelper.Base, XOutputStream):
     """
-    Calcドキュメントのアクティブなシートを1ページに収まるように調整し、PNGファイルとしてエクスポートします。
+    LibreOfficeのエクスポート結果をPythonのメモリ上のバッファに受け取る XOutputStream。
+    storeToURL("private:stream", ...) の OutputStream プロパティに渡して使う。
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writeBytes(self, data):
+        self.buffer.write(data.value)
+
+    def flush(self):
+        pass
+
+    def closeOutput(self):
+        pass
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+class OffsetIndex:
+    """
+    列 (または行) の開始位置を必要な分だけ取得してキャッシュし、
+    座標を含む列・行の番号を二分探索で求めるインデックス。
+    各列・行の Position は LibreOffice が計算済みの累積オフセット (幅・高さの累積和) なので、
+    全件を取得しなくても、探索で参照した O(log n) 件の取得で済む。
+    """
+
+    def __init__(self, container, axis):
+        self.container = container
+        self.axis = axis
+        self.count = container.getCount()
+        self._offsets = {}
+        self._visible = {}
+        self._size_name = "Width" if axis == "X" else "Height"
+
+    def offset(self, index):
+        """index 番目の列・行の開始位置 (1/100mm) を返す。"""
+        value = self._offsets.get(index)
+        if value is None:
+            value = int(getattr(self.container.getByIndex(index).Position, self.axis))
+            self._offsets[index] = value
+        return value
+
+    def end_offset(self, index):
+        """index 番目の列・行の終了位置 (次の列・行の開始位置) を返す。"""
+        if index + 1 < self.count:
+            return self.offset(index + 1)
+        return self.offset(index) + int(getattr(self.container.getByIndex(index), self._size_name))
+
+    def is_visible(self, index):
+        value = self._visible.get(index)
+        if value is None:
+            value = bool(self.container.getByIndex(index).IsVisible)
+            self._visible[index] = value
+        return value
+
+    def index_containing(self, coordinate, start=0):
+        """
+        start 以降で、次の列・行の開始位置が coordinate 以上になる最初の表示中の番号を返す。
+        該当しない場合は最後の列・行の番号を返す (以降が全て非表示なら start)。
+        """
+        low, high = start, self.count - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.offset(middle + 1) >= coordinate:
+                high = middle
+            else:
+                low = middle + 1
+        # 非表示の列・行 (幅 0) に当たった場合は、次に表示されている列・行を採用する
+        index = low
+        while index < self.count and not self.is_visible(index):
+            index += 1
+        return index if index < self.count else start
+
+
+def _shape_cell_bounds(shape, column_index, row_index):
+    """
+    図形が占めるセル範囲を (開始列, 開始行, 終了列, 終了行) で返す。
+    サイズや位置が取得できない図形の場合は None。
+    """
+    if not hasattr(shape, 'getSize') or not hasattr(shape, 'getPosition'):
+        return None
+
+    shape_size = shape.getSize()
+    shape_pos = shape.getPosition()  # アンカーからの相対位置
+    anchor = shape.getAnchor()
+
+    # アンカーの開始セルを特定
+    start_col_idx, start_row_idx = 0, 0
+    if hasattr(anchor, 'getRangeAddress'):
+        anchor_range = anchor.getRangeAddress()
+        start_col_idx = anchor_range.StartColumn
+        start_row_idx = anchor_range.StartRow
+    elif hasattr(anchor, 'getCellAddress'):
+        anchor_cell = anchor.getCellAddress()
+        start_col_idx = anchor_cell.Column
+        start_row_idx = anchor_cell.Row
+
+    # アンカーセルの絶対座標 (単位: 1/100mm) を取得
+    anchor_abs_x = column_index.offset(start_col_idx)
+    anchor_abs_y = row_index.offset(start_row_idx)
+
+    # オブジェクトの右下端の絶対座標を計算
+    shape_end_x = int(anchor_abs_x) + int(shape_pos.X) + int(shape_size.Width)
+    shape_end_y = int(anchor_abs_y) + int(shape_pos.Y) + int(shape_size.Height)
+
+    # 右下端が含まれるセルを二分探索で特定
+    end_col_idx = column_index.index_containing(shape_end_x, start_col_idx)
+    end_row_idx = row_index.index_containing(shape_end_y, start_row_idx)
+    return start_col_idx, start_row_idx, end_col_idx, end_row_idx
+
+
+def _region_bounds(sheet, region, column_index, row_index):
+    """
+    注目領域 (セル範囲 "B2:F20" / "Sheet1.B2:F20" またはグラフ名) をセル範囲の境界に変換する。
+    出力するのは常にアクティブなシートのため、別のシート名が付いた範囲は見つからない扱いにする。
+    """
+    sheet_name, ref = split_sheet_reference(region)
+    bounds = parse_range_reference(ref)
+    if bounds is not None:
+        if sheet_name is not None and sheet_name != sheet.getName():
+            raise ValueError(f"注目領域 '{region}' はアクティブなシート '{sheet.getName()}' の範囲ではありません。")
+        return bounds
+    draw_page = sheet.getDrawPage()
+    for i in range(draw_page.getCount()):
+        shape = draw_page.getByIndex(i)
+        names = (getattr(shape, 'Name', None), getattr(shape, 'PersistName', None))
+        if region in names:
+            shape_bounds = _shape_cell_bounds(shape, column_index, row_index)
+            if shape_bounds is not None:
+                return shape_bounds
+    raise ValueError(f"注目領域 '{region}' がセル範囲またはグラフ名として見つかりません。")
+
+
+def fit_pixel_size(width, height, max_side=None, max_pixels=None):
+    """
+    印刷範囲の大きさ (1/100mm) から、縦横比を保ったまま上限に収まる画像サイズ (px) を求める。
+    画面表示相当 (96dpi) より大きくはしない。
+    """
+    if width <= 0 or height <= 0:
+        return None
+    scale = NATURAL_PIXELS_PER_UNIT
+    if max_side:
+        scale = min(scale, max_side / width, max_side / height)
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+class RenderCache:
+    """
+    直近のエクスポート結果を、ドキュメントの指紋 (fingerprint) をキーに保持するキャッシュ。
+    """
+
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png_bytes = self._entries.get(key)
+            if png_bytes is not None:
+                self._entries.move_to_end(key)
+            return png_bytes
+
+    def put(self, key, png_bytes):
+        with self._lock:
+            self._entries[key] = png_bytes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_render_cache = RenderCache()
+
+# ドキュメントごとの世代番号 (RuntimeUID → 無効化の回数)。指紋に含め、invalidate_document でキャッシュを無効にする
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def invalidate_document(doc):
+    """
+    doc のキャッシュ済みの画像を無効にする。
+    グラフ内部のモデル (タイトル・軸・系列の書式) の変更は Calc の Undo 履歴にもセルにも現れず、
+    指紋では埋め込みモデルの変更フラグとしてしか検出できない。変更済みのグラフを再度変更した場合に呼び出す。
     """
     try:
-        controller = doc.getCurrentController()
-        sheet = controller.getActiveSheet()
+        uid = doc.RuntimeUID
+    except Exception as e:
+        print(f"描画キャッシュの無効化に失敗しました (キャッシュを全て破棄します): {e}")
+        _render_cache.clear()
+        return
+    with _generations_lock:
+        _generations[uid] = _generations.get(uid, 0) + 1
+
+
+def charts_modified(doc):
+    """doc のいずれかのシートに、埋め込みモデルが変更済みのグラフがあるかを返す。"""
+    sheets = doc.getSheets()
+    for s in range(sheets.getCount()):
+        charts = sheets.getByIndex(s).getCharts()
+        for i in range(charts.getCount()):
+            if charts.getByIndex(i).getEmbeddedObject().isModified():
+                return True
+    return False
+
+
+def document_fingerprint(doc, sheet, extra=()):
+    """
+    再描画が必要かどうかを判定するための、ドキュメントの安価な指紋を返す。
+    使用範囲の数式・値 (1回の getFormulaArray)、図形とグラフの一覧、グラフの埋め込みモデルの変更フラグ、
+    Undo/Redo の履歴、変更フラグ、invalidate_document による世代番号を組み合わせる。
+    書式のみの変更は Undo 履歴の変化として検出される。
+    """
+    cursor = sheet.createCursor()
+    cursor.gotoEndOfUsedArea(False)
+    used = cursor.getRangeAddress()
+    formulas = sheet.getCellRangeByPosition(0, 0, used.EndColumn, used.EndRow).getFormulaArray()
+
+    shapes = []
+    draw_page = sheet.getDrawPage()
+    for i in range(draw_page.getCount()):
+        shape = draw_page.getByIndex(i)
+        position, size = shape.getPosition(), shape.getSize()
+        shapes.append((shape.getShapeType(), getattr(shape, 'Name', ''),
+                       position.X, position.Y, size.Width, size.Height))
+    charts = sheet.getCharts()
+    for i in range(charts.getCount()):
+        chart_doc = charts.getByIndex(i).getEmbeddedObject()
+        diagram = chart_doc.getDiagram()
+        shapes.append((diagram.getDiagramType() if hasattr(diagram, 'getDiagramType') else None,
+                       chart_doc.isModified()))
+
+    undo_manager = doc.getUndoManager()
+    undo_titles = undo_manager.getAllUndoActionTitles()
+    history = (
+        len(undo_titles),
+        undo_titles[0] if undo_titles else None,
+        len(undo_manager.getAllRedoActionTitles()),
+    )
+    uid = doc.RuntimeUID
+    with _generations_lock:
+        generation = _generations.get(uid, 0)
+    key = (uid, generation, sheet.getName(), used.EndColumn, used.EndRow, formulas,
+           tuple(shapes), history, doc.isModified(), extra)
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+class _ExportStateGuard:
+    """
+    エクスポートのために変更する印刷範囲・ページスタイルの拡大縮小設定・変更フラグを保存し、
+    終了時に元に戻す。この間は Undo への記録も止め、ユーザーの Undo 履歴を汚さない。
+    """
+
+    _SCALE_PROPERTIES = ("PageScale", "ScaleToPages", "ScaleToPagesX", "ScaleToPagesY")
+
+    def __init__(self, doc, sheet, page_style):
+        self.doc = doc
+        self.sheet = sheet
+        self.page_style = page_style
+
+    def __enter__(self):
+        self.print_areas = self.sheet.getPrintAreas()
+        self.scale = {name: self.page_style.getPropertyValue(name) for name in self._SCALE_PROPERTIES}
+        self.modified = self.doc.isModified()
+        self.undo_manager = self.doc.getUndoManager()
+        self.undo_manager.lock()
+        return self
+
+    def _restore_order(self):
+        # 最後に設定した拡大縮小モードが有効になるため、元々有効だったモードを最後に設定する
+        if self.scale["ScaleToPagesX"] or self.scale["ScaleToPagesY"]:
+            return ("PageScale", "ScaleToPages", "ScaleToPagesX", "ScaleToPagesY")
+        if self.scale["ScaleToPages"]:
+            return ("PageScale", "ScaleToPagesX", "ScaleToPagesY", "ScaleToPages")
+        return ("ScaleToPagesX", "ScaleToPagesY", "ScaleToPages", "PageScale")
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.sheet.setPrintAreas(self.print_areas)
+            for name in self._restore_order():
+                self.page_style.setPropertyValue(name, self.scale[name])
+            self.doc.setModified(self.modified)
+        except Exception as e:
+            print(f"印刷範囲・ページスタイルの復元に失敗しました: {e}")
+        finally:
+            self.undo_manager.unlock()
+        return False
+
+
+def _render_png(doc, sheet, region, max_side, max_pixels):
+    """
+    印刷範囲を計算してアクティブなシートをPNGのバイト列として描画する。
+    変更した印刷範囲とページスタイルは描画後に元に戻す。
+    """
+    # 列・行の位置インデックスはエクスポート中の全図形で共有する
+    column_index = OffsetIndex(sheet.getColumns(), "X")
+    row_index = OffsetIndex(sheet.getRows(), "Y")
+
+    # --- 印刷範囲の計算ロジック ---
+    if region:
+        try:
+            min_col, min_row, max_col, max_row = _region_bounds(sheet, region, column_index, row_index)
+        except ValueError as e:
+            # 注目領域はモデルが指定するため、解決できなくても試行を失敗させず使用範囲全体を出力する
+            print(f"警告: {e}使用範囲全体を出力します。")
+            region = None
+    if not region:
+        min_col, min_row = 0, 0
 
-        # --- 印刷範囲の計算ロジック ---
-        
         # 1a. データが入力されているセルの範囲を基準に初期の最大行・列を設定
         cursor = sheet.createCursor()
         cursor.gotoEndOfUsedArea(False)
@@ -22,99 +343,88 @@ def export_active_sheet_to_png(doc, output_path):
         # 1b. 図形オブジェクトの実際の表示サイズと位置から最大範囲を計算
         draw_page = sheet.getDrawPage()
         if draw_page and draw_page.hasElements():
-            columns = sheet.getColumns()
-            rows = sheet.getRows()
-
             for i in range(draw_page.getCount()):
-                shape = draw_page.getByIndex(i)
-                
+                shape_bounds = _shape_cell_bounds(draw_page.getByIndex(i), column_index, row_index)
                 # サイズや位置が取得できないオブジェクトはスキップ
-                if not hasattr(shape, 'getSize') or not hasattr(shape, 'getPosition'):
+                if shape_bounds is None:
                     continue
+                _, _, end_col_idx, end_row_idx = shape_bounds
 
-                shape_size = shape.getSize()
-                shape_pos = shape.getPosition()  # アンカーからの相対位置
-                anchor = shape.getAnchor()
-                
-                # アンカーの開始セルを特定
-                start_col_idx, start_row_idx = 0, 0
-                if hasattr(anchor, 'getRangeAddress'):
-                    anchor_range = anchor.getRangeAddress()
-                    start_col_idx = anchor_range.StartColumn
-                    start_row_idx = anchor_range.StartRow
-                elif hasattr(anchor, 'getCellAddress'):
-                    anchor_cell = anchor.getCellAddress()
-                    start_col_idx = anchor_cell.Column
-                    start_row_idx = anchor_cell.Row
-
-                # アンカーセルの絶対座標 (単位: 1/100mm) を取得
-                anchor_abs_pos_x = columns.getByIndex(start_col_idx).Position
-                anchor_abs_pos_y = rows.getByIndex(start_row_idx).Position
-                
-                # オブジェクトの右下端の絶対座標を計算
-                shape_end_x = int(anchor_abs_pos_x.X) + int(shape_pos.X) + int(shape_size.Width)
-                shape_end_y = int(anchor_abs_pos_y.Y) + int(shape_pos.Y) + int(shape_size.Height)
-
-                # 「セルウォーク」で右下端が含まれるセルを特定
-                end_col_idx = start_col_idx
-                current_x = anchor_abs_pos_x
-                for c in range(start_col_idx, columns.getCount()):
-                    col = columns.getByIndex(c)
-                    if not col.IsVisible: continue
-                    # Note: Position of the *next* column is the end of the current one
-                    if c + 1 < columns.getCount():
-                        next_col_pos = columns.getByIndex(c + 1).Position
-                        if next_col_pos.X >= shape_end_x:
-                            end_col_idx = c
-                            break
-                    else: # Last column
-                        end_col_idx = c
-                        break
-
-                end_row_idx = start_row_idx
-                current_y = anchor_abs_pos_y
-                for r in range(start_row_idx, rows.getCount()):
-                    row = rows.getByIndex(r)
-                    if not row.IsVisible: continue
-                    if r + 1 < rows.getCount():
-                        next_row_pos = rows.getByIndex(r + 1).Position
-                        if next_row_pos.Y >= shape_end_y:
-                            end_row_idx = r
-                            break
-                    else: # Last row
-                        end_row_idx = r
-                        break
-                
                 # 最大行・列を更新
                 if end_row_idx > max_row:
                     max_row = end_row_idx
                 if end_col_idx > max_col:
                     max_col = end_col_idx
 
-        # 1c. A1セルから計算された最終的な右下端までを印刷範囲として設定
-        print_area = sheet.getCellRangeByPosition(0, 0, max_col, max_row).getRangeAddress()
+    style_name = sheet.PageStyle
+    page_style = doc.getStyleFamilies().getByName("PageStyles").getByName(style_name)
+
+    with _ExportStateGuard(doc, sheet, page_style):
+        # 1c. 計算された範囲を印刷範囲として設定
+        print_area = sheet.getCellRangeByPosition(min_col, min_row, max_col, max_row).getRangeAddress()
         sheet.setPrintAreas((print_area,))
 
-        # 2. ページスタイルを1ページにスケールするように設定
-        # 注意: この処理はドキュメントのページスタイルを変更します。
-        style_name = sheet.PageStyle
-        style_families = doc.getStyleFamilies()
-        page_styles = style_families.getByName("PageStyles")
-        page_style = page_styles.getByName(style_name)
+        # 2. ページスタイルを1ページにスケールするように設定 (終了時に元に戻す)
         page_style.ScaleToPagesX = 1
         page_style.ScaleToPagesY = 1
 
         # 3. 'calc_png_Export' フィルターを使用してシートをエクスポート
         # このフィルターはアクティブなシートの印刷範囲をエクスポートします。
-        output_url = uno.systemPathToFileUrl(output_path)
-        
-        filter_data = (
-            PropertyValue("FilterName", 0, "calc_png_Export", 0),
-            # PixelWidth/Heightを指定しないことで、LibreOfficeが
-            # シートの内容と印刷設定に基づいてサイズを自動決定します。
-        )
+        filter_data = [PropertyValue("FilterName", 0, "calc_png_Export", 0)]
+        # 上限が指定されない場合、LibreOfficeがシートの内容と印刷設定に基づいてサイズを自動決定します。
+        if max_side or max_pixels:
+            width = column_index.end_offset(max_col) - column_index.offset(min_col)
+            height = row_index.end_offset(max_row) - row_index.offset(min_row)
+            pixel_size = fit_pixel_size(width, height, max_side, max_pixels)
+            if pixel_size:
+                pixel_data = (
+                    PropertyValue("PixelWidth", 0, pixel_size[0], 0),
+                    PropertyValue("PixelHeight", 0, pixel_size[1], 0),
+                )
+                filter_data.append(PropertyValue("FilterData", 0, uno.Any("[]com.sun.star.beans.PropertyValue", pixel_data), 0))
+
+        # ファイルを経由せず、メモリ上のストリームに直接出力する
+        stream = BytesOutputStream()
+        filter_data.append(PropertyValue("OutputStream", 0, stream, 0))
+        uno.invoke(doc, "storeToURL", ("private:stream", tuple(filter_data)))
+        return stream.getvalue()
+
+
+def export_active_sheet_to_png(doc, output_path=None, region=None, max_side=None, max_pixels=None, use_cache=True):
+    """
+    Calcドキュメントのアクティブなシートを1ページに収まるように調整し、PNGファイルとしてエクスポートします。
+    output_path を省略した場合はファイルに書き出さず、PNGのバイト列を返します。
+
+    region: 出力する注目領域 (セル範囲 "B2:F20" またはグラフ名)。省略時はA1から使用範囲・図形の右下端まで。
+    max_side / max_pixels: 画像の長辺 / 総画素数の上限。検証モデルの入力サイズに合わせて縮小して出力する。
+    use_cache: 前回のエクスポートからシートが変わっていなければ、再描画せずに前回の画像を使う。
+    """
+    try:
+        controller = doc.getCurrentController()
+        sheet = controller.getActiveSheet()
+
+        fingerprint = None
+        png_bytes = None
+        if use_cache:
+            try:
+                fingerprint = document_fingerprint(doc, sheet, (region, max_side, max_pixels))
+                png_bytes = _render_cache.get(fingerprint)
+            except Exception as e:
+                print(f"ドキュメントの指紋の計算に失敗しました (キャッシュを使用しません): {e}")
+                fingerprint = None
+
+        if png_bytes is not None:
+            print(f"シート '{sheet.getName()}' は前回のエクスポートから変更されていないため、画像を再利用します。")
+        else:
+            png_bytes = _render_png(doc, sheet, region, max_side, max_pixels)
+            if fingerprint is not None and png_bytes:
+                _render_cache.put(fingerprint, png_bytes)
+
+        if output_path is None:
+            return png_bytes
 
-        doc.storeToURL(output_url, filter_data)
+        with open(output_path, "wb") as f:
+            f.write(png_bytes)
         print(f"シート '{sheet.getName()}' が {output_path} にエクスポートされました。")
 
     except Exception as e:
@@ -127,17 +437,8 @@ def main():
     アクティブなシートをPNGファイルにエクスポートします。
     """
     try:
-        local_ctx = uno.getComponentContext()
-        resolver = local_ctx.ServiceManager.createInstanceWithContext(
-            "com.sun.star.bridge.UnoUrlResolver", local_ctx
-        )
-        ctx = resolver.resolve(
-            "uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext"
-        )
-        smgr = ctx.ServiceManager
-        desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
-
-        doc = desktop.getCurrentComponent()
+        session = UnoSession()
+        doc = session.doc
         if not doc:
             print("ドキュメントが開かれていません。")
             return
@@ -3,6 +3,7 @@
 設定ファイル
 """
 import os
+import sys
 
 # --- LibreOffice関連の設定 ---
 # ご自身の環境に合わせてLibreOfficeのインストールパスを指定してください
@@ -24,3 +25,143 @@ IMAGE_VERIFIER_MODEL = "gemma3:12b"
 # --- スクリプト内部で使用するパス ---
 LO_PYTHON_PATH = os.path.join(LO_PATH, "python-core", "lib")
 LIBREOFFICE_EXECUTABLE = os.path.join(LO_PATH, "scalc.exe")
+
+# --- 状態取得関連の設定 ---
+# get_calc_state をまとめ取り (構造化JSON) モードで実行するかどうか
+STATE_EXTRACTION_BATCHED = True
+
+# まとめ取り時、要求範囲の外接矩形をこのセル数以下なら1回の getDataArray で取得する
+STATE_BOUNDING_RANGE_CELL_LIMIT = 20000
+
+# Ollamaの応答をストリーミングで受信し、必要な部分が揃った時点で打ち切るかどうか
+OLLAMA_STREAM = True
+
+# Ollamaへの永続接続プールの設定
+OLLAMA_MAX_CONNECTIONS = 4       # 同時に使用する接続数の上限
+OLLAMA_CONNECT_TIMEOUT = 10      # 接続確立のタイムアウト (秒)
+OLLAMA_READ_TIMEOUT = 300        # 応答待ち (無通信) のタイムアウト (秒)
+OLLAMA_MAX_RETRIES = 2           # 接続エラー・タイムアウト時の再試行回数
+OLLAMA_RETRY_BACKOFF = 1.0       # 再試行待ち時間の基準値 (秒、試行ごとに倍増)
+
+# モデルをメモリに保持する時間 (プロンプトキャッシュを次の呼び出しまで残すため)
+OLLAMA_KEEP_ALIVE = "30m"
+
+# --- フィードバック履歴の設定 ---
+# モデルのコンテキスト長 (Ollamaの num_ctx として送信する。既定値のままだと超過分が黙って切り捨てられる)
+OLLAMA_NUM_CTX = 16384
+
+# 応答の生成用に空けておくトークン数
+GENERATION_RESERVE_TOKENS = 2048
+
+# フィードバック履歴に使うトークン数の上限 (コンテキストの残りがこれより少なければそちらに従う)
+FEEDBACK_TOKEN_BUDGET = 4096
+
+# --- LLM応答キャッシュの設定 ---
+# "use": キャッシュを参照・保存, "refresh": 参照せずに上書き保存, "bypass": 使用しない
+LLM_CACHE_MODE = "use"
+
+# キャッシュの保存先
+LLM_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache")
+
+# キャッシュの合計サイズの上限 (バイト)。超えた分は最終利用の古い順に削除する
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# キャッシュエントリの有効期間 (秒)
+LLM_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# キャッシュディレクトリ全体を走査して期限切れ・容量超過を整理する最短間隔 (秒)
+# 間の保存では合計サイズを足し込むだけで、上限を超えた時点で走査する
+LLM_CACHE_SCAN_INTERVAL = 10 * 60
+
+# --- 並列候補生成の設定 ---
+# 1イテレーションで同時に生成・検証する候補の数 (1 なら従来どおり逐次実行)
+PARALLEL_CANDIDATES = 1
+
+# 候補ごとに割り当てる生成オプション (候補数が多い場合は循環して使い、seed で区別する)
+CANDIDATE_OPTIONS = [
+    {"temperature": 0.2},
+    {"temperature": 0.6},
+    {"temperature": 0.9},
+    {"temperature": 1.2},
+]
+
+# --- 実行関連の設定 ---
+# 各試行を Undo コンテキストで囲み、不合格なら取り消してから次の試行に進むかどうか
+EXECUTION_ROLLBACK = True
+
+# 生成コードの実行中はコントローラをロックし自動計算を止め、終了時に1回だけ再描画・再計算するかどうか
+EXECUTION_BATCH_EDIT = True
+
+# 生成コードの実行方法。"inprocess": このプロセス内で exec() する (制限なし)
+# "subprocess": 同じ soffice に接続した別プロセスで実行し、制限を超えたら強制終了する
+# "subprocess" は暴走するコードからこのプロセスを守れるが、試行ごとにプロセスの起動と UNO 接続の確立が加わる。
+# 無限ループや大量のメモリ確保を起こしうるモデルを使う場合に切り替える
+EXECUTION_MODE = "inprocess"
+
+# 別プロセス実行の制限時間 (秒)
+EXECUTION_TIMEOUT = 60
+
+# 別プロセス実行のメモリ使用量の上限 (MB)
+# Linux/macOS では resource で制限する。Windows では psutil が必要で、LibreOffice 同梱の python には
+# 含まれていないため、psutil が無い場合は制限されない (初回の実行時に警告を表示する)
+EXECUTION_MEMORY_LIMIT_MB = 1024
+
+# 別プロセス実行に使う Python (UNOモジュールを読み込めるもの。通常は LibreOffice 同梱の python)
+EXECUTOR_PYTHON = sys.executable
+
+# 生成プロンプトの形式。"injected": 接続済みの ctx/smgr/desktop/doc/sheet を使わせる (接続の定型コードを書かせない)
+# "boilerplate": 従来どおり、生成コードの冒頭で LibreOffice に接続させる
+GENERATOR_PROMPT_VARIANT = "injected"
+
+# 実行前の検査で、セルを1つずつ操作するループとして却下する反復回数
+PREFLIGHT_CELL_LOOP_LIMIT = 2000
+
+# --- 検証用スクリーンショットの設定 ---
+# 画像検証モデルの入力サイズに合わせた、画像の長辺と総画素数の上限
+VERIFIER_IMAGE_MAX_SIDE = 896
+VERIFIER_IMAGE_MAX_PIXELS = 896 * 896
+
+# 検証用スクリーンショットをデバッグ用にファイルにも保存するかどうか (通常はメモリ上でのみ扱う)
+SAVE_DEBUG_IMAGES = False
+
+# シートが変わっていない場合に再利用する、エクスポート済み画像の保持数
+RENDER_CACHE_MAX_ENTRIES = 8
+
+# 実行前後で使用範囲を比較し、変更セルの要約を検証に使うかどうか
+CELL_DIFF_ENABLED = True
+
+# 使用範囲 (A1から最終セルまで) がこのセル数を超えるシートでは比較を省く (実行前後に全体を読み込むため)
+CELL_DIFF_CELL_LIMIT = 200000
+
+# 変更セルの要約に列挙するセル数の上限
+CELL_DIFF_MAX_LISTED = 50
+
+# --- LibreOfficeワーカープールの設定 ---
+# ヘッドレス起動に使う soffice の実行ファイル
+SOFFICE_EXECUTABLE = os.path.join(LO_PATH, "soffice.exe")
+
+# ワーカー i はポート WORKER_BASE_PORT + i で待ち受ける
+WORKER_BASE_PORT = 2100
+
+# ワーカーの起動 (UNOで接続できるまで) を待つ時間 (秒)
+WORKER_START_TIMEOUT = 60
+
+# ワーカーの応答確認のタイムアウト (秒)。超えた場合は固まったとみなして再起動する
+WORKER_PING_TIMEOUT = 10
+
+# この件数のタスクを処理したワーカーは再起動する (メモリ増加の抑制)
+WORKER_MAX_TASKS = 50
+
+# --- バッチモードの設定 ---
+# バッチモードで同時に処理するワークブック数 (起動する soffice ワーカー数)
+BATCH_WORKERS = 2
+
+# バッチモードで1件あたりに行う試行回数の上限
+BATCH_MAX_ITERATIONS = 5
+
+# --- 計測 (トレース) の設定 ---
+# フェーズごとの所要時間と LLM の計測値を1行ずつ追記する JSONL ファイル (None で無効)
+TRACE_FILE = "autospreadsheet_trace.jsonl"
+
+# 集計値を Prometheus のテキスト形式で書き出すファイル (None で無効)。node_exporter の textfile collector 向け
+PROMETHEUS_FILE = None
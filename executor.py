@@ -1,6 +1,12 @@
 import sys
 import os
+import re
 import json
+import time
+import base64
+import threading
+import contextlib
+import concurrent.futures
 from config import LO_PATH, LO_PYTHON_PATH
 
 # LibreOffice UNOモジュールへのパスを動的に追加
@@ -12,10 +18,18 @@ if LO_PYTHON_PATH not in sys.path:
 import uno
 import traceback
 from com.sun.star.beans import PropertyValue
-from libreoffice_manager import set_cell_value, get_cell_value, get_sheet, save_document, close_document
-from llm_wrapper import invoke_llm_with_image
-from state_extractor import get_calc_state
+from libreoffice_manager import UndoTransaction, UnoSession, BatchEdit
+import script_runner
+from script_runner import exec_generated
+from llm_wrapper import invoke_llm_with_image, get_last_call_stats
+from state_extractor import get_calc_state, snapshot_used_area, diff_snapshots
+import fast_verifier
+from config import EXECUTION_MODE, EXECUTION_BATCH_EDIT, EXECUTION_ROLLBACK, VERIFIER_IMAGE_MAX_SIDE, VERIFIER_IMAGE_MAX_PIXELS, SAVE_DEBUG_IMAGES, CELL_DIFF_ENABLED
 import capture_png
+import tracing
+
+# 直近の execute_and_verify のステージ別所要時間 (スレッドごと)
+_stage_timings = threading.local()
 
 # ハイブリッド検証用の新しいプロンプトテンプレート
 VERIFICATION_PROMPT_TEMPLATE = """You are a meticulous and detail-oriented AI assistant for spreadsheet verification.
@@ -26,6 +40,7 @@ Your task is to determine if an operation was successful by comparing the user's
 
 # Objective State Data (from API)
 This data is the ground truth. Trust this data over the image if there is a conflict.
+`changed_cells`, when present, summarizes every cell of the active sheet whose value or formula changed during execution.
 ```json
 {objective_state}
 ```
@@ -38,39 +53,76 @@ This data is the ground truth. Trust this data over the image if there is a conf
 **Crucial Instruction**: Do NOT invent or hallucinate elements. If the objective data says `chart_count` is 0, and you think you see a chart in the image, you MUST conclude there is no chart. The objective data is the truth.
 
 # Final Verdict
-Verdict: [PASS or FAIL]
+Answer in exactly this order, and write nothing after the Verdict line:
 Reason: [Your reasoning, referencing both objective data and the image]
+Verdict: [PASS or FAIL]
 """
 
-def execute_code(code_string, doc, desktop):
+# 判定行 ("Verdict: PASS" など)。テンプレートの "[PASS or FAIL]" の復唱には一致しない
+VERDICT_PATTERN = re.compile(r"Verdict\**\s*:\s*\**\s*\[?\s*(PASS|FAIL)\b(?!\s+or\b)", re.IGNORECASE)
+
+def verdict_is_complete(response_text):
+    """ストリーミング受信中の検証応答に判定行が出力されたかを判定する。"""
+    return VERDICT_PATTERN.search(response_text) is not None
+
+def parse_verdict(response_text):
+    """
+    検証応答から合否を判定する。判定行が無い場合は従来どおり "pass" の有無で判断する。
     """
-    Executes the given Python code string.
+    match = VERDICT_PATTERN.search(response_text)
+    if match:
+        return match.group(1).upper() == "PASS"
+    return "pass" in response_text.lower()
+
+def execute_code(code_string, doc, desktop, transaction=None, session=None, mode=None):
     """
+    Executes the given Python code string with ctx, smgr, desktop, doc and sheet pre-bound.
+    If a transaction (UndoTransaction) is given, the code runs inside it.
+    Unless config.EXECUTION_BATCH_EDIT is off, it also runs inside a BatchEdit, so repaints and
+    recalculation happen once at the end rather than after every write.
+    If a chart model had already been modified, the document's cached screenshot is invalidated
+    afterwards, since a further edit to it would not change the render cache's fingerprint.
+
+    session: UnoSession whose connection the code runs on (defaults to the configured soffice).
+    mode: "subprocess" runs the code in a separate process connected to the same soffice,
+          killed when it exceeds config.EXECUTION_TIMEOUT or config.EXECUTION_MEMORY_LIMIT_MB;
+          "inprocess" runs it with exec() in this process. Defaults to config.EXECUTION_MODE.
+    """
+    if mode is None:
+        mode = EXECUTION_MODE
+    if session is None:
+        session = UnoSession()
+    batch_edit = BatchEdit(doc) if EXECUTION_BATCH_EDIT else contextlib.nullcontext()
     try:
-        processed_code_string = code_string.replace(
-            "uno.awt.Rectangle(", "uno.createUnoStruct(\"com.sun.star.awt.Rectangle\", "
-        )
-        exec(processed_code_string, {
-            'doc': doc,
-            'desktop': desktop,
-            'set_cell_value': set_cell_value,
-            'get_cell_value': get_cell_value,
-            'get_sheet': get_sheet,
-            'save_document': save_document,
-            'close_document': close_document
-        })
+        charts_were_modified = capture_png.charts_modified(doc)
+    except Exception:
+        charts_were_modified = True
+    try:
+        with transaction or contextlib.nullcontext(), batch_edit:
+            if mode == "subprocess":
+                return script_runner.run_in_subprocess(code_string, doc, session.connection_string)
+            exec_generated(code_string, doc, desktop, session.ctx)
         return None, "Code executed successfully."
     except Exception as e:
         error_message = f"Code execution error: {type(e).__name__}: {e}\n"
         error_message += "".join(traceback.format_exc())
         return error_message, None
+    finally:
+        # Chart-internal edits (titles, axes, series formatting) only show up in the render
+        # cache's fingerprint as the chart model's modified flag, which is set once
+        if charts_were_modified:
+            capture_png.invalidate_document(doc)
 
-def save_sheet_as_png(doc, output_path):
+def save_sheet_as_png(doc, output_path, region=None):
     """
-    Saves the active sheet as a PNG image.
+    Saves the active sheet as a PNG image, sized for the image verifier model.
+    region: optional cell range or chart name to crop the screenshot to.
     """
     try:
-        capture_png.export_active_sheet_to_png(doc, output_path)
+        capture_png.export_active_sheet_to_png(
+            doc, output_path, region=region,
+            max_side=VERIFIER_IMAGE_MAX_SIDE, max_pixels=VERIFIER_IMAGE_MAX_PIXELS
+        )
         return None
     except Exception as e:
         error_message = f"PNG save error: {type(e).__name__}: {e}\n"
@@ -78,50 +130,225 @@ def save_sheet_as_png(doc, output_path):
         print(error_message)
         return error_message
 
-def execute_and_verify(code_string, verification_query, doc, desktop, instruction, image_verifier_model):
+def render_sheet_png(doc, region=None):
     """
-    Executes code, gets objective state, and verifies the result with an image and state data.
+    Renders the active sheet to PNG bytes in memory, sized for the image verifier model.
+    Returns (png_bytes, error_message).
     """
-    # 1. Execute the code
-    execution_error, result_message = execute_code(code_string, doc, desktop)
-    if execution_error:
-        return f"Execution Error: {execution_error}", False
-
-    # 2. Get objective state from the application
     try:
-        objective_state = get_calc_state(verification_query)
+        png_bytes = capture_png.export_active_sheet_to_png(
+            doc, None, region=region,
+            max_side=VERIFIER_IMAGE_MAX_SIDE, max_pixels=VERIFIER_IMAGE_MAX_PIXELS
+        )
+        if not png_bytes:
+            return None, "PNG export produced no data."
+        return png_bytes, None
     except Exception as e:
-        return f"State Extraction Error: {e}", False
+        error_message = f"PNG render error: {type(e).__name__}: {e}\n"
+        error_message += "".join(traceback.format_exc())
+        print(error_message)
+        return None, error_message
+
+def get_last_stage_timings():
+    """
+    Returns the per-stage latencies (seconds) of the last execute_and_verify call made on this thread.
+    Stages that ran in the background (render, encode) overlap with the foreground ones.
+    """
+    return dict(getattr(_stage_timings, "timings", {}))
+
+class _StageTimer:
+    def __init__(self):
+        self.timings = {}
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times one stage and records it as a trace span (yielded, so attributes can be added)."""
+        started = time.perf_counter()
+        try:
+            with tracing.span(name) as span:
+                yield span
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 4)
+
+    def finish(self):
+        self.timings["total"] = round(time.perf_counter() - self._started, 4)
+        return self.timings
+
+def _render_and_encode(doc, region, timer):
+    """Background stage: render the sheet and Base64-encode it for the verifier request."""
+    with timer.stage("render"):
+        png_bytes, error = render_sheet_png(doc, region=region)
+    if error:
+        return None, None, error
+    with timer.stage("encode"):
+        image_b64 = base64.b64encode(png_bytes).decode("utf-8")
+    return png_bytes, image_b64, None
 
-    # 3. Save the resulting state as a PNG image
-    temp_image_path = os.path.join(os.getcwd(), "verification.png")
-    save_error = save_sheet_as_png(doc, temp_image_path)
-    if save_error:
-        return f"Image Save Error: {save_error}", False
+def execute_and_verify(code_string, verification_query, doc, desktop, instruction, image_verifier_model,
+                       session=None, uno_guard=None, image_path=None, cancel_event=None, rollback=None):
+    """
+    Executes code, gets objective state, and verifies the result with an image and state data.
+    The screenshot is rendered and encoded in the background while the state is read and checked,
+    and the per-stage latencies are available from get_last_stage_timings() afterwards.
 
-    # 4. Verify with LLM using both objective data and the image
+    uno_guard: context manager held while touching LibreOffice (steps 1-3), e.g. a DocumentGuard
+               when several candidates share one soffice. The verifier call runs outside it.
+    image_path: where to write a copy of the screenshot when config.SAVE_DEBUG_IMAGES is on
+                (defaults to verification.png in the cwd). Otherwise it never touches the disk.
+    cancel_event: threading.Event; once set, remaining steps are skipped and the verifier stream is closed.
+    rollback: run the code in an undo context and undo it when the attempt is rejected
+              (defaults to config.EXECUTION_ROLLBACK).
+    """
+    if rollback is None:
+        rollback = EXECUTION_ROLLBACK
+    transaction = UndoTransaction(doc) if rollback else None
+    timer = _StageTimer()
+    pipeline = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="verify-render")
+    verification_result, is_pass = "Cancelled.", False
     try:
-        prompt = VERIFICATION_PROMPT_TEMPLATE.format(
-            instruction=instruction,
-            objective_state=json.dumps(objective_state, indent=2, ensure_ascii=False)
-        )
-        
+        verification_result, is_pass = _execute_and_verify(
+            code_string, verification_query, doc, desktop, instruction, image_verifier_model,
+            session, uno_guard, image_path, cancel_event, transaction, timer, pipeline)
+        return verification_result, is_pass
+    finally:
+        pipeline.shutdown(wait=False)
+        if transaction is not None and not is_pass:
+            with timer.stage("rollback"), uno_guard or contextlib.nullcontext():
+                if transaction.rollback():
+                    print("不合格だった試行の変更を元に戻しました。")
+        _stage_timings.timings = timer.finish()
+
+def _execute_and_verify(code_string, verification_query, doc, desktop, instruction, image_verifier_model,
+                        session, uno_guard, image_path, cancel_event, transaction, timer, pipeline):
+    if image_path is None:
+        image_path = os.path.join(os.getcwd(), "verification.png")
+    if not isinstance(verification_query, dict):
+        # The query comes from the model; a JSON list or null is treated as "no query"
+        verification_query = {}
+
+    with uno_guard or contextlib.nullcontext():
+        if cancel_event is not None and cancel_event.is_set():
+            return "Cancelled.", False
+
+        # 0. Capture the counts that delta expectations compare against
+        expectations = fast_verifier.get_expectations(verification_query)
+        baseline = None
+        baseline_query = fast_verifier.baseline_query(verification_query)
+        if baseline_query:
+            with timer.stage("baseline"):
+                baseline = get_calc_state(baseline_query, session=session, batched=True)
+
+        # 0b. Snapshot the active sheet's used area so the change can be diffed in bulk
+        before_snapshot = None
+        if CELL_DIFF_ENABLED:
+            try:
+                with timer.stage("snapshot"):
+                    diff_sheet = doc.getCurrentController().getActiveSheet()
+                    before_snapshot = snapshot_used_area(diff_sheet)
+                if before_snapshot is None:
+                    print("Used area exceeds CELL_DIFF_CELL_LIMIT; diff disabled for this attempt")
+            except Exception as e:
+                print(f"Used-area snapshot failed (diff disabled for this attempt): {e}")
+
+        # 1. Execute the code
+        with timer.stage("execute"):
+            execution_error, result_message = execute_code(code_string, doc, desktop, transaction, session=session)
+        if execution_error:
+            return f"Execution Error: {execution_error}", False
+
+        cell_diff = None
+        if before_snapshot is not None:
+            try:
+                with timer.stage("diff"):
+                    after_snapshot = snapshot_used_area(diff_sheet)
+                    if after_snapshot is not None:
+                        cell_diff = diff_snapshots(before_snapshot, after_snapshot)
+            except Exception as e:
+                print(f"Used-area diff failed: {e}")
+
+        # Cells that turned into error values are a failure without asking any model
+        if cell_diff is not None and cell_diff.get("new_errors"):
+            errors = ", ".join(f"{e['cell']} ({e['error']})" for e in cell_diff["new_errors"])
+            return (f"Reason: 実行後に新しくエラー値になったセルがあります: {errors}\n"
+                    f"Verdict: FAIL"), False
+
+        # 2. Start rendering the screenshot in the background when the verifier is going to need it.
+        #    Only expectation-only queries may be settled without it.
+        region = verification_query.get("region")
+        render_future = None
+        if not expectations or verification_query.get("visual"):
+            render_future = pipeline.submit(tracing.propagate(_render_and_encode), doc, region, timer)
+
+        try:
+            # 3. Meanwhile, get objective state from the application
+            try:
+                with timer.stage("state"):
+                    if expectations:
+                        objective_state = get_calc_state(fast_verifier.state_query(verification_query),
+                                                         session=session, batched=True)
+                    else:
+                        objective_state = get_calc_state(verification_query, session=session)
+            except Exception as e:
+                return f"State Extraction Error: {e}", False
+
+            if cell_diff is not None:
+                objective_state["changed_cells"] = cell_diff
+
+            # 3b. Judge expected values in Python; skip the image verifier when that settles it
+            if expectations:
+                with timer.stage("checks"):
+                    checks, all_passed = fast_verifier.evaluate_expectations(
+                        verification_query, objective_state, baseline)
+                objective_state["expectation_checks"] = checks
+                if all_passed is False or (all_passed and not verification_query.get("visual")):
+                    return fast_verifier.format_verdict(checks, all_passed), all_passed
+
+            if render_future is None:
+                render_future = pipeline.submit(tracing.propagate(_render_and_encode), doc, region, timer)
+
+            # 4. Build the verifier prompt while the image is still being rendered or encoded
+            with timer.stage("prompt"):
+                prompt = VERIFICATION_PROMPT_TEMPLATE.format(
+                    instruction=instruction,
+                    objective_state=json.dumps(objective_state, indent=2, ensure_ascii=False)
+                )
+
+            with timer.stage("render_wait"):
+                png_bytes, image_b64, save_error = render_future.result()
+            if save_error:
+                return f"Image Save Error: {save_error}", False
+        finally:
+            # Never leave the guard while the background render is still using the document
+            if render_future is not None:
+                concurrent.futures.wait([render_future])
+
+    if SAVE_DEBUG_IMAGES:
+        with open(image_path, "wb") as f:
+            f.write(png_bytes)
+
+    if cancel_event is not None:
+        stop_condition = lambda text: cancel_event.is_set() or verdict_is_complete(text)
+    else:
+        stop_condition = verdict_is_complete
+
+    # 5. Verify with LLM using both objective data and the image
+    with timer.stage("verify") as span:
         verification_result = invoke_llm_with_image(
             prompt=prompt,
-            image_path=temp_image_path,
-            model_name=image_verifier_model
+            image_path=None,
+            model_name=image_verifier_model,
+            stop_condition=stop_condition,
+            complete_condition=verdict_is_complete,
+            image_b64=image_b64
         )
+        span.record_llm(get_last_call_stats())
 
-        if verification_result is None:
-            return "Image verification LLM returned no response.", False
+    if verification_result is None:
+        return "Image verification LLM returned no response.", False
+    if cancel_event is not None and cancel_event.is_set():
+        return "Cancelled.", False
 
-        # Simple pass/fail check
-        is_pass = "pass" in verification_result.lower()
-        
-        return verification_result, is_pass
+    is_pass = parse_verdict(verification_result)
 
-    finally:
-        # Keep the image for debugging purposes
-        # if os.path.exists(temp_image_path):
-        #     os.remove(temp_image_path)
-        pass
+    return verification_result, is_pass
@@ -0,0 +1,205 @@
+"""
+検証クエリの期待値 (expect) を Python 上で判定する高速検証。
+判定が付く場合は画像エクスポートと画像検証LLMの呼び出しを省略できる。
+
+検証クエリの例:
+    {
+        "cell_values": ["A1"],
+        "expect": [
+            {"cell": "A1", "equals": "Hello"},
+            {"range": "B2:B10", "no_errors": true},
+            {"chart_count_delta": 1},
+            {"chart_type": "LineDiagram"}
+        ],
+        "visual": false
+    }
+
+"visual": true の場合は、期待値が全て満たされても画像検証を行う。
+"""
+# 数値比較の許容誤差
+NUMERIC_TOLERANCE = 1e-9
+
+# 実行前後の差分を取るカウント系の項目
+_DELTA_KEYS = {
+    "chart_count_delta": "chart_count",
+    "sheet_count_delta": "sheet_count",
+    "document_count_delta": "document_count",
+}
+
+_COUNT_KEYS = ("chart_count", "sheet_count", "document_count")
+
+
+def get_expectations(query):
+    expectations = query.get("expect") if isinstance(query, dict) else None
+    if isinstance(expectations, dict):
+        expectations = [expectations]
+    if not isinstance(expectations, list):
+        return []
+    return [e for e in expectations if isinstance(e, dict)]
+
+
+def baseline_query(query):
+    """
+    実行前に取得しておく必要がある状態のクエリを返す (差分の判定が無ければ空)。
+    """
+    baseline = {}
+    for expectation in get_expectations(query):
+        for delta_key, count_key in _DELTA_KEYS.items():
+            if delta_key in expectation:
+                baseline[count_key] = True
+    return baseline
+
+
+def state_query(query):
+    """
+    期待値の判定に必要な項目を加えた、get_calc_state 用のクエリを返す。
+    """
+    augmented = {k: v for k, v in query.items() if k not in ("expect", "visual", "region")}
+    addresses = list(augmented.get("cell_values") or [])
+    for expectation in get_expectations(query):
+        address = expectation.get("cell") or expectation.get("range")
+        if address and address not in addresses:
+            addresses.append(address)
+        for key in _COUNT_KEYS:
+            if key in expectation:
+                augmented[key] = True
+        for delta_key, count_key in _DELTA_KEYS.items():
+            if delta_key in expectation:
+                augmented[count_key] = True
+        if "chart_type" in expectation:
+            augmented["chart_types"] = True
+        if "sheet_exists" in expectation:
+            augmented["sheet_names"] = True
+        if "active_sheet_name" in expectation:
+            augmented["active_sheet_name"] = True
+    if addresses:
+        augmented["cell_values"] = addresses
+    return augmented
+
+
+def _values_equal(actual, expected):
+    if isinstance(expected, bool):
+        expected = float(expected)
+    if isinstance(expected, (int, float)):
+        try:
+            actual_number = float(actual)
+        except (TypeError, ValueError):
+            return False
+        return abs(actual_number - expected) <= NUMERIC_TOLERANCE * max(1.0, abs(expected))
+    if isinstance(actual, float) and isinstance(expected, str):
+        try:
+            return _values_equal(actual, float(expected))
+        except ValueError:
+            return False
+    return str(actual) == str(expected)
+
+
+def _grid_equal(actual_grid, expected):
+    if not isinstance(expected, list):
+        # 単一の値は範囲内の全セルに対する期待値とみなす
+        return all(_values_equal(v, expected) for row in actual_grid for v in row)
+    if expected and not isinstance(expected[0], list):
+        # 1次元リストは1行または1列の範囲とみなす
+        flat = [v for row in actual_grid for v in row]
+        return len(flat) == len(expected) and all(_values_equal(a, e) for a, e in zip(flat, expected))
+    if len(actual_grid) != len(expected):
+        return False
+    return all(
+        len(a_row) == len(e_row) and all(_values_equal(a, e) for a, e in zip(a_row, e_row))
+        for a_row, e_row in zip(actual_grid, expected)
+    )
+
+
+def _check_cells(expectation, cell_values):
+    address = expectation.get("cell") or expectation.get("range")
+    entry = cell_values.get(address)
+    if entry is None or "error" in entry and "values" not in entry:
+        return False, f"{address} の値を取得できませんでした"
+    checks = []
+    if "equals" in expectation:
+        ok = _grid_equal(entry["values"], expectation["equals"])
+        checks.append((ok, f"{address} = {entry['values']} (期待値 {expectation['equals']})"))
+    if "formula" in expectation:
+        formulas = entry.get("formulas") or entry["values"]
+        ok = _grid_equal(formulas, expectation["formula"])
+        checks.append((ok, f"{address} の数式 = {formulas} (期待値 {expectation['formula']})"))
+    if expectation.get("no_errors"):
+        errors = entry.get("errors") or []
+        checks.append((not errors, f"{address} のエラーセル: {errors}" if errors else f"{address} にエラーセルなし"))
+    if expectation.get("not_empty"):
+        empty = any(t == "empty" for row in entry["types"] for t in row)
+        checks.append((not empty, f"{address} に空のセルがあります" if empty else f"{address} は全て入力済み"))
+    if not checks:
+        return None, f"{address} に判定条件がありません"
+    return all(ok for ok, _ in checks), "; ".join(message for _, message in checks)
+
+
+def _count(state, key):
+    value = state.get(key) if state else None
+    return value if isinstance(value, int) else None
+
+
+def evaluate_expectations(query, state, baseline=None):
+    """
+    期待値を判定する。
+
+    Returns:
+        tuple: (判定結果のリスト, 全て満たされたか)。
+               判定できない期待値がある場合、全体の結果は None (画像検証に委ねる)。
+    """
+    results = []
+    cell_values = state.get("cell_values") or {}
+    for expectation in get_expectations(query):
+        ok, message = None, None
+        if "cell" in expectation or "range" in expectation:
+            ok, message = _check_cells(expectation, cell_values)
+        elif any(key in expectation for key in _DELTA_KEYS):
+            delta_key = next(key for key in _DELTA_KEYS if key in expectation)
+            count_key = _DELTA_KEYS[delta_key]
+            before, after = _count(baseline, count_key), _count(state, count_key)
+            if before is not None and after is not None:
+                ok = after - before == expectation[delta_key]
+                message = f"{count_key}: {before} -> {after} (期待する増減 {expectation[delta_key]})"
+        elif any(key in expectation for key in _COUNT_KEYS):
+            count_key = next(key for key in _COUNT_KEYS if key in expectation)
+            actual = _count(state, count_key)
+            if actual is not None:
+                ok = actual == expectation[count_key]
+                message = f"{count_key} = {actual} (期待値 {expectation[count_key]})"
+        elif "chart_type" in expectation:
+            chart_types = state.get("chart_types")
+            if isinstance(chart_types, dict) and "error" not in chart_types:
+                wanted = str(expectation["chart_type"]).lower()
+                matched = [name for name, kind in chart_types.items() if wanted in str(kind).lower()]
+                ok = bool(matched)
+                message = f"グラフの種類 {chart_types} (期待値 {expectation['chart_type']})"
+        elif "sheet_exists" in expectation:
+            names = state.get("sheet_names")
+            if isinstance(names, list):
+                ok = expectation["sheet_exists"] in names
+                message = f"シート '{expectation['sheet_exists']}' の存在: {ok}"
+        elif "active_sheet_name" in expectation:
+            name = state.get("active_sheet_name")
+            if isinstance(name, str):
+                ok = name == expectation["active_sheet_name"]
+                message = f"アクティブシート名 = {name} (期待値 {expectation['active_sheet_name']})"
+
+        if message is None:
+            message = f"判定できない期待値です: {expectation}"
+        results.append({"expect": expectation, "passed": ok, "detail": message})
+
+    if not results:
+        return results, None
+    if any(result["passed"] is False for result in results):
+        return results, False
+    if any(result["passed"] is None for result in results):
+        return results, None
+    return results, True
+
+
+def format_verdict(results, passed):
+    """判定結果を、画像検証LLMの応答と同じ Reason/Verdict 形式の文字列にする。"""
+    lines = [f"- [{'OK' if r['passed'] else 'NG'}] {r['detail']}" for r in results]
+    reason = "期待値をAPIの状態データで判定しました (画像検証は省略)。\n" + "\n".join(lines)
+    return f"Reason: {reason}\nVerdict: {'PASS' if passed else 'FAIL'}"
+
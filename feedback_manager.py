@@ -0,0 +1,149 @@
+import re
+from config import OLLAMA_NUM_CTX, GENERATION_RESERVE_TOKENS, FEEDBACK_TOKEN_BUDGET
+
+# 要約時に残すトレースバックの末尾行数
+TRACEBACK_TAIL_LINES = 3
+
+# 要約時に残す判定理由の最大文字数
+REASON_MAX_CHARS = 300
+
+_ERROR_TYPE_PATTERN = re.compile(r"\b([A-Za-z_][A-Za-z0-9_]*(?:Error|Exception|Exit|Interrupt))\b")
+_REASON_PATTERN = re.compile(r"Reason\**\s*:\s*\**\s*(.*?)(?:\n\s*\**Verdict|\Z)", re.DOTALL | re.IGNORECASE)
+
+
+def estimate_tokens(text):
+    """
+    トークン数を概算する。トークナイザに依存しないよう、ASCIIは4文字で1トークン、
+    それ以外 (日本語など) は1文字1トークンとして多めに見積もる。
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def available_feedback_tokens(*prompt_parts, num_ctx=OLLAMA_NUM_CTX, budget=FEEDBACK_TOKEN_BUDGET):
+    """
+    プロンプトの他の部分 (system・指示など) を差し引いて、フィードバックに使えるトークン数を返す。
+    """
+    used = sum(estimate_tokens(part) for part in prompt_parts) + GENERATION_RESERVE_TOKENS
+    return max(0, min(budget, num_ctx - used))
+
+
+def _truncate_middle(text, max_tokens):
+    """先頭と末尾を残して中央を省略し、おおよそ max_tokens に収める。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = "\n... (省略) ...\n"
+    keep = max(0, max_tokens - estimate_tokens(marker))
+    # 1文字あたりのトークン数から、残す文字数を逆算する
+    ratio = estimate_tokens(text) / max(1, len(text))
+    chars = int(keep / ratio) if ratio else keep
+    head = chars // 2
+    tail = chars - head
+    return text[:head] + marker + (text[-tail:] if tail else "")
+
+
+class Attempt:
+    """1回分の失敗した試行。"""
+
+    def __init__(self, iteration, code=None, result=None, note=None):
+        self.iteration = iteration
+        self.code = code
+        self.result = result or ""
+        self.note = note
+
+    def error_type(self):
+        match = _ERROR_TYPE_PATTERN.search(self.result)
+        return match.group(1) if match else None
+
+    def traceback_tail(self):
+        if "Traceback" not in self.result:
+            return None
+        lines = [line for line in self.result.strip().splitlines() if line.strip()]
+        return "\n".join(lines[-TRACEBACK_TAIL_LINES:])
+
+    def verdict_reason(self):
+        match = _REASON_PATTERN.search(self.result)
+        if not match:
+            return None
+        reason = " ".join(match.group(1).split())
+        return reason[:REASON_MAX_CHARS]
+
+    def render_full(self):
+        if self.note:
+            return f"\n試行{self.iteration}: {self.note}"
+        text = f"\n# 試行 {self.iteration}: 失敗\n"
+        text += f"コード:\n{self.code}\n"
+        text += f"判定結果:\n{self.result}\n"
+        return text
+
+    def render_summary(self):
+        if self.note:
+            return f"\n試行{self.iteration}: {self.note}"
+        text = f"\n# 試行 {self.iteration}: 失敗 (要約)\n"
+        error_type = self.error_type()
+        tail = self.traceback_tail()
+        reason = self.verdict_reason()
+        if error_type:
+            text += f"エラー種別: {error_type}\n"
+        if tail:
+            text += f"トレースバック末尾:\n{tail}\n"
+        if reason:
+            text += f"判定理由: {reason}\n"
+        if not (error_type or tail or reason):
+            text += f"判定結果: {_truncate_middle(self.result.strip(), 100)}\n"
+        return text
+
+
+class FeedbackHistory:
+    """
+    過去の試行のフィードバックを、トークン予算内に収めて保持・整形する。
+    直近の試行はそのまま残し、それ以前の試行はエラー種別・トレースバック末尾・判定理由に要約する。
+    それでも予算を超える場合は古い要約から順に捨て、最後に直近の試行自体を切り詰める。
+    """
+
+    def __init__(self, token_budget=FEEDBACK_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.attempts = []
+
+    def add_note(self, iteration, note):
+        """コードが得られなかった場合など、一行で済む記録を追加する。"""
+        self.attempts.append(Attempt(iteration, note=note))
+
+    def add_failure(self, iteration, code, result):
+        self.attempts.append(Attempt(iteration, code=code, result=result))
+
+    def __len__(self):
+        return len(self.attempts)
+
+    def render(self, max_tokens=None):
+        """
+        プロンプトに埋め込むフィードバック文字列を返す。履歴が無ければ "なし"。
+        """
+        if not self.attempts:
+            return "なし"
+        budget = self.token_budget if max_tokens is None else min(self.token_budget, max_tokens)
+
+        latest = self.attempts[-1].render_full()
+        summaries = [attempt.render_summary() for attempt in self.attempts[:-1]]
+
+        latest_tokens = estimate_tokens(latest)
+        if latest_tokens > budget:
+            # 直近の試行だけで予算を超える場合は、要約を全て捨てて直近の試行を切り詰める
+            return _truncate_middle(latest, budget)
+
+        # 省略件数の見出し分を先に確保しておく
+        remaining = budget - latest_tokens - estimate_tokens("\n(古い試行 000 件は省略しました)")
+        kept = []
+        for summary in reversed(summaries):
+            cost = estimate_tokens(summary)
+            if cost > remaining:
+                break
+            kept.append(summary)
+            remaining -= cost
+        kept.reverse()
+
+        omitted = len(summaries) - len(kept)
+        header = f"\n(古い試行 {omitted} 件は省略しました)" if omitted else ""
+        return header + "".join(kept) + latest
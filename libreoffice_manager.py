@@ -1,8 +1,20 @@
 import sys
 import os
+import math
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
-from config import LO_PATH, LO_PYTHON_PATH, LIBREOFFICE_EXECUTABLE, UNO_CONNECTION_STRING
+import uuid
+import contextlib
+import concurrent.futures
+from config import (
+    LO_PATH, LO_PYTHON_PATH, LIBREOFFICE_EXECUTABLE, UNO_CONNECTION_STRING,
+    SOFFICE_EXECUTABLE, WORKER_BASE_PORT, WORKER_START_TIMEOUT, WORKER_PING_TIMEOUT,
+    WORKER_MAX_TASKS,
+)
 
 # LibreOffice UNOモジュールへのパスを動的に追加
 if LO_PATH not in sys.path:
@@ -11,20 +23,169 @@ if LO_PYTHON_PATH not in sys.path:
     sys.path.insert(0, LO_PYTHON_PATH)
 
 import uno
+from com.sun.star.beans import PropertyValue
 
-def check_libreoffice_connection(retries=5, delay=5):
+class UnoSession:
+    """
+    UNOブリッジへの接続を保持し、コンテキスト・デスクトップ・ドキュメントを共有するセッション。
+    接続は一度だけ解決して使い回し、ブリッジが切断された場合は自動で再接続する。
+    lock は同じ soffice 上の操作 (並列候補の実行・状態取得・画像出力) を1つずつ行うためのロックで、
+    derive で作ったセッションとも共有する。
+    """
+
+    def __init__(self, connection_string=UNO_CONNECTION_STRING):
+        self.connection_string = connection_string
+        self.lock = threading.RLock()
+        self._ctx = None
+        self._smgr = None
+        self._desktop = None
+        self._doc = None
+
+    def connect(self):
+        """
+        UNOブリッジを解決し、コンテキストとデスクトップを取得する。
+        失敗した場合は例外をそのまま送出する。
+        """
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_context)
+        ctx = resolver.resolve(self.connection_string + "StarOffice.ComponentContext")
+        smgr = ctx.ServiceManager
+        desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+        self._ctx, self._smgr, self._desktop = ctx, smgr, desktop
+        self._doc = None
+        return self
+
+    def reset(self):
+        """
+        保持しているUNOオブジェクトを破棄し、次回アクセス時に再接続させる。
+        """
+        self._ctx = None
+        self._smgr = None
+        self._desktop = None
+        self._doc = None
+
+    def is_connected(self):
+        return self._desktop is not None
+
+    def ensure_alive(self):
+        """
+        ブリッジが生きているかを1回の呼び出しで確認し、切断されていれば再接続する。
+        イテレーションの開始時など、まとまった処理の前に呼び出すことを想定している。
+        """
+        if self._desktop is None:
+            self.connect()
+            return self
+        try:
+            current = self._desktop.getCurrentComponent()
+            if self._doc is None:
+                self._doc = current
+        except Exception:
+            print("UNOブリッジが切断されました。再接続します...")
+            self.connect()
+        return self
+
+    @property
+    def ctx(self):
+        if self._ctx is None:
+            self.connect()
+        return self._ctx
+
+    @property
+    def smgr(self):
+        if self._smgr is None:
+            self.connect()
+        return self._smgr
+
+    @property
+    def desktop(self):
+        if self._desktop is None:
+            self.connect()
+        return self._desktop
+
+    @property
+    def doc(self):
+        """
+        セッションが操作対象とするドキュメント。未設定の場合は現在のドキュメントを採用する。
+        """
+        if self._doc is None:
+            self._doc = self.desktop.getCurrentComponent()
+        return self._doc
+
+    @doc.setter
+    def doc(self, value):
+        self._doc = value
+
+    def refresh_document(self):
+        """
+        デスクトップの現在のドキュメントを取り直す。
+        """
+        self._doc = self.desktop.getCurrentComponent()
+        return self._doc
+
+    def active_sheet(self):
+        return self.doc.getCurrentController().getActiveSheet()
+
+    def derive(self, doc):
+        """
+        接続 (コンテキスト・デスクトップ) を共有し、操作対象だけを doc に差し替えたセッションを返す。
+        """
+        derived = UnoSession(self.connection_string)
+        derived.lock = self.lock
+        derived._ctx, derived._smgr, derived._desktop = self.ctx, self.smgr, self.desktop
+        derived._doc = doc
+        return derived
+
+
+class DocumentGuard:
+    """
+    指定したドキュメントをデスクトップのアクティブなフレームにした状態で、
+    UNO操作を排他的に行うためのコンテキストマネージャ。
+    生成コードが desktop.getCurrentComponent() で取得するドキュメントを doc に向けるために使う。
+    """
+
+    def __init__(self, desktop, doc, lock=None):
+        self.desktop = desktop
+        self.doc = doc
+        self.lock = lock or threading.RLock()
+        self._previous_frame = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self._previous_frame = self.desktop.getActiveFrame()
+            self.desktop.setActiveFrame(self.doc.getCurrentController().getFrame())
+        except Exception:
+            self.lock.release()
+            raise
+        return self.doc
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if self._previous_frame is not None:
+                self.desktop.setActiveFrame(self._previous_frame)
+        except Exception as e:
+            print(f"アクティブフレームの復元に失敗しました: {e}")
+        finally:
+            self._previous_frame = None
+            self.lock.release()
+        return False
+
+
+def check_libreoffice_connection(retries=5, delay=5, session=None):
     """
     Checks if a LibreOffice process is already running and listening on the UNO port.
     If not, it attempts to start it and retries connecting.
+    When a session is given, the established connection is kept in it for reuse.
     """
+    if session is None:
+        session = UnoSession()
     for i in range(retries):
         try:
-            localContext = uno.getComponentContext()
-            resolver = localContext.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", localContext)
-            ctx = resolver.resolve(UNO_CONNECTION_STRING + "StarOffice.ComponentContext")
+            session.connect()
             print("LibreOffice is running and connected via UNO.")
             return True
         except Exception:
+            session.reset()
             if i == 0:
                 print("LibreOffice is not running or not connected. Attempting to start it...")
                 try:
@@ -44,18 +205,15 @@ def check_libreoffice_connection(retries=5, delay=5):
     print("Failed to connect to LibreOffice after multiple retries.")
     return False
 
-def get_libreoffice_context():
+def get_libreoffice_context(session=None):
     """
     LibreOfficeのUNOコンテキスト、デスクトップ、現在のドキュメントを取得する。
     """
     try:
-        localContext = uno.getComponentContext()
-        resolver = localContext.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", localContext)
-        ctx = resolver.resolve(UNO_CONNECTION_STRING + "StarOffice.ComponentContext")
-        smgr = ctx.ServiceManager
-        desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
-        doc = desktop.getCurrentComponent()
-        return ctx, desktop, doc
+        if session is None:
+            session = UnoSession()
+        session.ensure_alive()
+        return session.ctx, session.desktop, session.doc
     except Exception as e:
         print(f"LibreOfficeコンテキストの取得に失敗しました: {e}")
         return None, None, None
@@ -70,6 +228,7 @@ def set_cell_value(sheet, cell_address, value):
     """
     指定されたシートのセルに値を設定する。
     cell_address: 例 "A1"
+    多数のセルに設定する場合は、BatchEdit(doc) の中で呼び出すと再描画・再計算が最後の1回で済む。
     """
     try:
         cell = sheet.getCellRangeByName(cell_address)
@@ -96,6 +255,108 @@ def get_cell_value(sheet, cell_address):
         print(f"セル {cell_address} の値取得中にエラーが発生しました: {e}")
         return None
 
+def _to_cell_value(value):
+    """setDataArray に渡せる値 (float か str) に変換する。None と NaN は空セルにする。"""
+    if hasattr(value, "item"):
+        # NumPy のスカラー
+        value = value.item()
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return str(value)
+
+def _to_rows(values):
+    """2次元のリスト・タプル・NumPy配列を、行ごとのリストにそろえる。"""
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    rows = [list(row.tolist() if hasattr(row, "tolist") else row) for row in values]
+    if not rows or not rows[0]:
+        raise ValueError("書き込むデータが空です。")
+    width = len(rows[0])
+    if any(len(row) != width for row in rows):
+        raise ValueError("すべての行の列数をそろえてください。")
+    return rows
+
+def _range_from(sheet, start_cell, height, width):
+    """start_cell (例 "B2") を左上とする height 行 x width 列の範囲を返す。"""
+    start = sheet.getCellRangeByName(start_cell).getRangeAddress()
+    return sheet.getCellRangeByPosition(
+        start.StartColumn, start.StartRow, start.StartColumn + width - 1, start.StartRow + height - 1)
+
+def write_range(sheet, start_cell, values):
+    """
+    2次元の値 (行のリスト、または NumPy 配列) を start_cell を左上とする範囲に1回の呼び出しで書き込む。
+    "=" で始まる文字列は数式として、列ごとに連続する数式セルをまとめて setFormulaArray で書き込む。
+    それ以外の値は setDataArray で書き込むため、"007" のような文字列が数値に変換されることはない。
+    書き込んだセル範囲を返す。失敗した場合は例外を送出する。
+    例: write_range(sheet, "A1", [["名前", "点数"], ["佐藤", 80]])
+    """
+    rows = [[_to_cell_value(value) for value in row] for row in _to_rows(values)]
+    cell_range = _range_from(sheet, start_cell, len(rows), len(rows[0]))
+
+    def is_formula(value):
+        return isinstance(value, str) and value.startswith("=")
+
+    cell_range.setDataArray(tuple(tuple("" if is_formula(value) else value for value in row) for row in rows))
+    for c in range(len(rows[0])):
+        r = 0
+        while r < len(rows):
+            if not is_formula(rows[r][c]):
+                r += 1
+                continue
+            end = r
+            while end + 1 < len(rows) and is_formula(rows[end + 1][c]):
+                end += 1
+            cell_range.getCellRangeByPosition(c, r, c, end).setFormulaArray(
+                tuple((rows[i][c],) for i in range(r, end + 1)))
+            r = end + 1
+    return cell_range
+
+def read_range(sheet, range_address):
+    """
+    範囲の値を1回の呼び出しで読み取り、行のリストとして返す。数値は float、それ以外は文字列 (空セルは "")。
+    例: read_range(sheet, "A1:C10")
+    """
+    return [list(row) for row in sheet.getCellRangeByName(range_address).getDataArray()]
+
+def read_formulas(sheet, range_address):
+    """
+    範囲の数式 (数式の無いセルは値の文字列) を1回の呼び出しで読み取り、行のリストとして返す。
+    """
+    return [list(row) for row in sheet.getCellRangeByName(range_address).getFormulaArray()]
+
+def fill_column(sheet, start_cell, values):
+    """
+    1次元の値 (リスト・NumPy配列) を start_cell から下方向に1回の呼び出しで書き込む。
+    例: fill_column(sheet, "B2", [10, 20, 30])
+    """
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    return write_range(sheet, start_cell, [[value] for value in values])
+
+def fill_row(sheet, start_cell, values):
+    """
+    1次元の値 (リスト・NumPy配列) を start_cell から右方向に1回の呼び出しで書き込む。
+    """
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    return write_range(sheet, start_cell, [list(values)])
+
+def set_range_style(sheet, range_address, style_name=None, **properties):
+    """
+    範囲全体にセルスタイルと書式プロパティをまとめて適用する。
+    例: set_range_style(sheet, "A1:D1", CharWeight=150.0, CellBackColor=0xDDDDDD)
+        set_range_style(sheet, "B2:B100", NumberFormat=4)
+    """
+    cell_range = sheet.getCellRangeByName(range_address)
+    if style_name:
+        cell_range.CellStyle = style_name
+    if properties:
+        names = tuple(sorted(properties))
+        cell_range.setPropertyValues(names, tuple(properties[name] for name in names))
+    return cell_range
+
 def get_sheet(doc, sheet_name):
     """
     指定された名前のシートを取得する。
@@ -122,6 +383,160 @@ def save_document(doc, file_path):
     except Exception as e:
         print(f"ドキュメントの保存中にエラーが発生しました: {e}")
 
+def store_document_copy(doc, file_path):
+    """
+    ドキュメントを file_path に書き出す。読み込み時と同じフィルタ (xlsx なら xlsx) で保存する。
+    失敗した場合は例外をそのまま送出する。
+    """
+    filter_name = None
+    for arg in doc.getArgs():
+        if arg.Name == "FilterName":
+            filter_name = arg.Value
+    properties = (PropertyValue("FilterName", 0, filter_name, 0),) if filter_name else ()
+    doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(file_path)), properties)
+
+class UndoTransaction:
+    """
+    1回の試行をドキュメントの UndoManager のコンテキストで囲み、
+    不合格だった場合に undo 1回で試行前の状態へ戻せるようにする。
+
+    with UndoTransaction(doc) as transaction:
+        ...  # ドキュメントへの変更
+    if failed:
+        transaction.rollback()
+    """
+
+    def __init__(self, doc, title=None):
+        self.doc = doc
+        # 他の操作の undo と取り違えないよう、試行ごとに一意なタイトルを付ける
+        self.title = title or f"autospreadsheet-{uuid.uuid4().hex[:12]}"
+        self._undo_manager = None
+
+    def __enter__(self):
+        try:
+            self._undo_manager = self.doc.getUndoManager()
+            self._undo_manager.enterUndoContext(self.title)
+        except Exception as e:
+            print(f"Undoコンテキストを開始できませんでした (ロールバックは無効): {e}")
+            self._undo_manager = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._undo_manager is not None:
+            try:
+                self._undo_manager.leaveUndoContext()
+            except Exception as e:
+                print(f"Undoコンテキストの終了に失敗しました: {e}")
+                self._undo_manager = None
+        return False
+
+    def rollback(self):
+        """
+        この試行の変更を取り消す。変更が無かった場合や取り消せない場合は False を返す。
+        """
+        if self._undo_manager is None:
+            return False
+        try:
+            # 変更が何も無い場合、コンテキストは undo スタックに積まれない
+            if not self._undo_manager.isUndoPossible():
+                return False
+            if self._undo_manager.getCurrentUndoActionTitle() != self.title:
+                return False
+            self._undo_manager.undo()
+            return True
+        except Exception as e:
+            print(f"試行の取り消しに失敗しました: {e}")
+            return False
+        finally:
+            self._undo_manager = None
+
+
+class BatchEdit:
+    """
+    まとまった編集の間、再描画と再計算を止めるコンテキストマネージャ。
+    コントローラをロックし、アクションロックを追加し、自動計算を止めたうえで編集を行い、
+    終了時 (例外が発生した場合も) に元の状態に戻す。自動計算が有効だった場合は、そこで1回だけ再計算する。
+
+    with BatchEdit(doc):
+        for address, value in values.items():
+            set_cell_value(sheet, address, value)
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._locked_controllers = False
+        self._action_locked = False
+        self._auto_calculation = None
+
+    def __enter__(self):
+        try:
+            self.doc.lockControllers()
+            self._locked_controllers = True
+            self.doc.addActionLock()
+            self._action_locked = True
+            self._auto_calculation = self.doc.isAutomaticCalculationEnabled()
+            if self._auto_calculation:
+                self.doc.enableAutomaticCalculation(False)
+        except Exception as e:
+            print(f"一括編集モードを開始できませんでした (通常の編集として続行します): {e}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._auto_calculation:
+            try:
+                self.doc.enableAutomaticCalculation(True)
+                self.doc.calculate()
+            except Exception as e:
+                print(f"自動計算の再開に失敗しました: {e}")
+        if self._action_locked:
+            try:
+                self.doc.removeActionLock()
+            except Exception as e:
+                print(f"アクションロックの解除に失敗しました: {e}")
+        if self._locked_controllers:
+            try:
+                self.doc.unlockControllers()
+            except Exception as e:
+                print(f"コントローラのロック解除に失敗しました: {e}")
+        self._locked_controllers = self._action_locked = False
+        self._auto_calculation = None
+        return False
+
+
+def load_document_hidden(desktop, file_path):
+    """
+    ドキュメントを非表示で読み込む。
+    """
+    file_url = uno.systemPathToFileUrl(os.path.abspath(file_path))
+    return desktop.loadComponentFromURL(file_url, "_blank", 0, (PropertyValue("Hidden", 0, True, 0),))
+
+def clone_document(desktop, doc):
+    """
+    ドキュメントを一時ファイルに保存し、非表示の独立したコピーとして読み込む。
+    戻り値は (コピー, 一時ファイルのパス)。使用後は discard_clone で破棄する。
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".ods")
+    os.close(fd)
+    try:
+        file_url = uno.systemPathToFileUrl(temp_path)
+        doc.storeToURL(file_url, (PropertyValue("FilterName", 0, "calc8", 0),))
+        return load_document_hidden(desktop, temp_path), temp_path
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def discard_clone(copy_doc, temp_path):
+    """
+    clone_document で作成したコピーを閉じ、一時ファイルを削除する。
+    """
+    try:
+        if copy_doc is not None:
+            copy_doc.close(True)
+    except Exception as e:
+        print(f"コピーのクローズ中にエラーが発生しました: {e}")
+    if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
 def close_document(doc):
     """
     ドキュメントを閉じる。
@@ -146,6 +561,215 @@ def close_libreoffice(doc, desktop):
         print(f"LibreOfficeの終了中にエラーが発生しました: {e}")
 
 
+
+class LibreOfficeWorker:
+    """
+    ポートとユーザープロファイルを専有する、ヘッドレスの soffice プロセス1つ。
+    """
+
+    def __init__(self, index, port, profile_dir):
+        self.index = index
+        self.port = port
+        self.profile_dir = profile_dir
+        self.process = None
+        self.session = None
+        self.tasks_done = 0
+
+    @property
+    def connection_string(self):
+        return f"uno:socket,host=localhost,port={self.port};urp;"
+
+    def start(self, timeout=WORKER_START_TIMEOUT):
+        """soffice を起動し、UNOで接続できるまで待つ。"""
+        accept = f"socket,host=localhost,port={self.port};urp;StarOffice.ComponentContext"
+        self.process = subprocess.Popen([
+            SOFFICE_EXECUTABLE, "--headless", "--invisible", "--nologo", "--norestore",
+            "--nodefault", "--nolockcheck", f"--accept={accept}",
+            f"-env:UserInstallation={uno.systemPathToFileUrl(self.profile_dir)}",
+        ])
+        self.session = UnoSession(self.connection_string)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.session.connect()
+                break
+            except Exception:
+                self.session.reset()
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.kill()
+                    raise RuntimeError(f"ワーカー {self.index} (ポート {self.port}) の起動に失敗しました。")
+                time.sleep(0.5)
+        self.tasks_done = 0
+        print(f"ワーカー {self.index} をポート {self.port} で起動しました。")
+
+    def is_responsive(self, timeout=WORKER_PING_TIMEOUT):
+        """
+        プロセスが生きていて、UNO呼び出しに timeout 秒以内に応答するかを確認する。
+        応答しない (固まった) soffice を検出するため、確認は別スレッドで行う。
+        """
+        if self.process is None or self.process.poll() is not None or self.session is None:
+            return False
+        result = {}
+
+        def ping():
+            try:
+                self.session.desktop.getCurrentComponent()
+                result["ok"] = True
+            except Exception:
+                result["ok"] = False
+
+        thread = threading.Thread(target=ping, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        return result.get("ok", False)
+
+    def stop(self, timeout=10):
+        """soffice を終了する。応答しない場合は強制終了する。"""
+        if self.session is not None and self.session.is_connected():
+            try:
+                self.session.desktop.terminate()
+            except Exception:
+                pass
+        if self.process is not None:
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.kill()
+        self.session = None
+        self.process = None
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.session = None
+        self.process = None
+
+    def restart(self, reason):
+        print(f"ワーカー {self.index} を再起動します ({reason})...")
+        if self.is_responsive():
+            self.stop()
+        else:
+            self.kill()
+        self.start()
+
+
+class LibreOfficeWorkerPool:
+    """
+    ヘッドレスの soffice プロセスを size 個起動・監視し、タスクを空いているワーカーに割り当てる。
+    - 異常終了・無応答のワーカーは、タスクの返却時に再起動する。
+    - max_tasks 件のタスクを処理したワーカーは、メモリ増加を抑えるため再起動 (リサイクル) する。
+    - 再起動に失敗したワーカーは次に貸し出す前に再起動を再試行し、それも失敗したら使用をやめる。
+
+    pool = LibreOfficeWorkerPool(size=4)
+    pool.start()
+    future = pool.submit(task, arg)   # task(worker, arg) がワーカー上で実行される
+    pool.shutdown()
+    """
+
+    def __init__(self, size, base_port=WORKER_BASE_PORT, max_tasks=WORKER_MAX_TASKS, profile_root=None):
+        self.size = size
+        self.max_tasks = max_tasks
+        self._profile_root = profile_root or tempfile.mkdtemp(prefix="lo_workers_")
+        self._owns_profile_root = profile_root is None
+        self.workers = [
+            LibreOfficeWorker(i, base_port + i, os.path.join(self._profile_root, f"worker_{i}"))
+            for i in range(size)
+        ]
+        self._idle = queue.Queue()
+        self._executor = None
+        self._available = size
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        全ワーカーを並行して起動する。
+        1つでも起動に失敗した場合は、起動済みのワーカーを終了し、プロファイルを削除してから例外を送出する。
+        """
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.size) as starter:
+                list(starter.map(lambda worker: worker.start(), self.workers))
+        except BaseException:
+            for worker in self.workers:
+                worker.stop()
+            if self._owns_profile_root:
+                shutil.rmtree(self._profile_root, ignore_errors=True)
+            raise
+        for worker in self.workers:
+            self._idle.put(worker)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.size)
+        return self
+
+    def _checkout(self):
+        """
+        空いているワーカーを取り出す。前回の再起動に失敗したワーカーは再起動を再試行し、
+        それも失敗した場合はプールから外して次のワーカーを待つ。
+        """
+        while True:
+            worker = self._idle.get()
+            if worker is None:
+                # 使用できるワーカーが無くなったことを、待っている他のスレッドにも伝える
+                self._idle.put(None)
+                raise RuntimeError("使用できるワーカーがありません (全ワーカーの再起動に失敗しました)。")
+            if worker.session is not None:
+                return worker
+            try:
+                worker.restart("前回の再起動に失敗したため再試行")
+                return worker
+            except Exception as e:
+                print(f"ワーカー {worker.index} の再起動に再び失敗しました。このワーカーは使用しません: {e}")
+                with self._lock:
+                    self._available -= 1
+                    if self._available == 0:
+                        self._idle.put(None)
+
+    @contextlib.contextmanager
+    def worker(self):
+        """空いているワーカーを1つ借りる (空きが出るまで待つ)。"""
+        worker = self._checkout()
+        failed = False
+        try:
+            yield worker
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            worker.tasks_done += 1
+            try:
+                if failed and not worker.is_responsive():
+                    worker.restart("タスク中に異常終了または無応答")
+                elif worker.tasks_done >= self.max_tasks:
+                    worker.restart(f"{worker.tasks_done} 件のタスクを処理")
+                elif not worker.is_responsive():
+                    worker.restart("無応答")
+            except Exception as e:
+                print(f"ワーカー {worker.index} の再起動に失敗しました: {e}")
+            self._idle.put(worker)
+
+    def submit(self, task, *args, **kwargs):
+        """task(worker, *args, **kwargs) を空いているワーカー上で実行し、Future を返す。"""
+        def run():
+            with self.worker() as worker:
+                return task(worker, *args, **kwargs)
+        return self._executor.submit(run)
+
+    def shutdown(self):
+        """タスクの完了を待ってから全ワーカーを終了し、プロファイルを削除する。"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for worker in self.workers:
+            worker.stop()
+        if self._owns_profile_root:
+            shutil.rmtree(self._profile_root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+        return False
+
 if __name__ == "__main__":
     if check_libreoffice_connection():
         print("Connection successful. You can now interact with LibreOffice via UNO.")
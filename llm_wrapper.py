@@ -1,12 +1,27 @@
 import os
 import json
-import urllib.request
+import time
+import threading
+import http.client
+import urllib.parse
 import base64
-from config import CODE_GENERATOR_MODEL, OLLAMA_API_URL
+import hashlib
+import tempfile
+from config import (
+    CODE_GENERATOR_MODEL, OLLAMA_API_URL, OLLAMA_STREAM, OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX,
+    OLLAMA_MAX_CONNECTIONS, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT,
+    OLLAMA_MAX_RETRIES, OLLAMA_RETRY_BACKOFF,
+    LLM_CACHE_MODE, LLM_CACHE_DIR, LLM_CACHE_MAX_BYTES, LLM_CACHE_MAX_AGE, LLM_CACHE_SCAN_INTERVAL,
+    GENERATOR_PROMPT_VARIANT,
+)
 
 # --- プロンプトテンプレート ---
+# 生成プロンプトは、毎回同じ内容の静的部分 (ルール・コード例) と、
+# 指示・フィードバックを含む動的部分に分けて送信する。
+# 静的部分を Ollama の system フィールドで常に先頭に置くことで、モデル側のプロンプトキャッシュ
+# (KVキャッシュの共通接頭辞) が再利用され、2回目以降はプロンプト評価が動的部分だけになる。
 
-GENERATOR_PROMPT_TEMPLATE = """あなたは、ユーザーの指示をPythonのUNO (Universal Network Objects) APIを使ったLibreOffice Calc操作コードに変換するエキスパートです。
+_GENERATOR_RULES_BOILERPLATE = """あなたは、ユーザーの指示をPythonのUNO (Universal Network Objects) APIを使ったLibreOffice Calc操作コードに変換するエキスパートです。
 
 # 厳格なルール
 - **絶対に**新しいドキュメントを作成してはいけません。`desktop.loadComponentFromURL`の使用は固く禁止します。
@@ -24,19 +39,43 @@ doc = desktop.getCurrentComponent()
 sheet = doc.getCurrentController().getActiveSheet()
 ```
 
-# 検証クエリの生成
+"""
+
+# 生成コードで使える一括処理の補助関数の説明 (どちらの形式でも共通)
+_GENERATOR_HELPERS_SECTION = """# 使える補助関数
+- コードの実行時には、範囲をまとめて読み書きする以下の関数が定義済みです (import 不要)。
+- 複数のセルを操作する場合は、セルを1つずつ操作するループではなく**必ずこれらを使ってください**。1回の呼び出しで範囲全体を処理するため、はるかに高速です。
+    - `write_range(sheet, "A1", [["名前", "点数"], ["佐藤", 80]])`: 左上のセルから2次元の値 (行のリスト・NumPy配列) を書き込む。"=" で始まる文字列は数式になる
+    - `fill_column(sheet, "B2", [10, 20, 30])` / `fill_row(sheet, "B2", [10, 20, 30])`: リスト・NumPy配列を下方向 / 右方向に書き込む
+    - `read_range(sheet, "A1:C10")` / `read_formulas(sheet, "A1:C10")`: 範囲の値 / 数式を行のリストとして読み取る
+    - `set_range_style(sheet, "A1:D1", CharWeight=150.0, CellBackColor=0xDDDDDD)`: 範囲全体に書式 (セルのプロパティ) やセルスタイル (`style_name="..."`) を適用する
+
+"""
+
+# 検証クエリの説明 (どちらの形式でも共通)
+_GENERATOR_QUERY_SECTION = """# 検証クエリの生成
 - コード生成に加えて、そのコードが正しく実行されたかを確認するための「検証クエリ」をJSON形式で生成してください。
 - このクエリは、`state_extractor.py` の `get_calc_state` 関数に渡されます。
 - 生成するJSONは、コードブロックの直後に ```json ``` で囲んでください。
 - クエリのキーは、`cell_values` (リスト), `active_sheet_name`, `sheet_count`, `sheet_names`, `chart_count`, `chart_types`, `document_count` のいずれかです。
 - 指示内容に最も関連するキーと値を指定してください。
+- 結果の値が分かっている場合は、`expect` (リスト) に期待値を書いてください。期待値が全て満たされれば画像による確認は省略されます。
+    - `{{"cell": "A1", "equals": 値}}` / `{{"range": "A1:B2", "equals": [[...], [...]]}}`: セルの値
+    - `{{"cell": "B2", "formula": "=SUM(A1:A10)"}}`: セルの数式
+    - `{{"range": "B2:B10", "no_errors": true}}` / `{{"range": "A1:A5", "not_empty": true}}`: エラー値・空セルが無いこと
+    - `{{"chart_count_delta": 1}}` / `{{"sheet_count_delta": 1}}`: 実行前からの増減
+    - `{{"chart_count": 1}}` / `{{"sheet_count": 2}}` / `{{"sheet_exists": "集計"}}` / `{{"active_sheet_name": "Sheet1"}}`
+    - `{{"chart_type": "LineDiagram"}}`: いずれかのグラフの種類
+- グラフの見た目や書式など、画像で確認する必要がある場合は `"visual": true` を指定してください。
+- 画像で確認する範囲が限られる場合は、`"region"` にセル範囲 (例: `"A1:F20"`) またはグラフ名を指定してください。
 
 例1:
 指示: 「A1セルに'Hello'と入力」
 検証クエリ:
 ```json
 {{
-    "cell_values": ["A1"]
+    "cell_values": ["A1"],
+    "expect": [{{"cell": "A1", "equals": "Hello"}}]
 }}
 ```
 
@@ -46,11 +85,15 @@ sheet = doc.getCurrentController().getActiveSheet()
 ```json
 {{
     "sheet_count": true,
-    "chart_count": true
+    "chart_count": true,
+    "expect": [{{"sheet_count_delta": 1}}, {{"chart_count_delta": 1}}],
+    "visual": true
 }}
 ```
 
-# コード生成の注意点
+"""
+
+_GENERATOR_EXAMPLES_BOILERPLATE = """# コード生成の注意点
 - 生成するコードは、LibreOfficeに付属のPython環境で実行可能な、単独のスクリプトにしてください。
 - `doc` と `desktop` オブジェクトが利用可能であることを前提としてください。
 - インデントは正確に4スペースで行ってください。
@@ -295,8 +338,100 @@ sheet = doc.getCurrentController().getActiveSheet()
 
         print("グラフタイトル・軸タイトルを設定し、表示をONにしました。")
         ```
+"""
+
+_GENERATOR_RULES_INJECTED = """あなたは、ユーザーの指示をPythonのUNO (Universal Network Objects) APIを使ったLibreOffice Calc操作コードに変換するエキスパートです。
+
+# 厳格なルール
+- **絶対に**新しいドキュメントを作成してはいけません。`desktop.loadComponentFromURL`の使用は固く禁止します。
+- 指示がない限り、常に `doc` (**既に開かれている操作対象のドキュメント**) に対して操作を行ってください。
+- 生成するコードは、```python ```で囲んでください。
+- コードの実行時には、以下の変数が**接続済みの状態で定義されています**。LibreOfficeへの接続処理 (`UnoUrlResolver` や `resolve` など) は書かずに、そのまま使ってください。
+    - `ctx`: コンポーネントコンテキスト / `smgr`: サービスマネージャ / `desktop`: デスクトップ
+    - `doc`: 操作対象のドキュメント / `sheet`: `doc` のアクティブなシート
+
+"""
+
+_GENERATOR_EXAMPLES_INJECTED = """# コード生成の注意点
+- 生成するコードは、LibreOfficeに付属のPython環境で実行可能な、単独のスクリプトにしてください。
+- `uno` モジュールや `com.sun.star` の型が必要な場合は、通常どおり import してください。
+- インデントは正確に4スペースで行ってください。
+
+# 参考にするコード例
+    # アクティブシートのA1セルに123と入力するコード
+        ```python
+        cell = sheet.getCellRangeByName("A1")
+        cell.setValue(123)  # 数値を入力
+        print("A1に 123 を入力しました。")
+        ```
+
+    # アクティブなシートの"B2"セルに"=SUM(A1:A10)"と入力するコード
+        ```python
+        cell = sheet.getCellRangeByName("B2")
+        cell.setFormula("=SUM(A1:A10)")
+        ```
+
+    # アクティブなシートの最初のグラフを折れ線グラフに変更する。
+        ```python
+        charts = sheet.getCharts()
+        chart_names = charts.getElementNames()
+        if not chart_names:
+            raise Exception("シートにグラフが存在しません。")
+
+        chart_doc = charts.getByName(chart_names[0]).getEmbeddedObject()
+        if not chart_doc.getDiagram().supportsService("com.sun.star.chart.LineDiagram"):
+            chart_doc.setDiagram(chart_doc.createInstance("com.sun.star.chart.LineDiagram"))
+        print("グラフ '{{}}' を折れ線グラフに変更しました。".format(chart_names[0]))
+        ```
+
+    # アクティブシートに散布図を作成する。
+        ```python
+        from com.sun.star.awt import Rectangle
+
+        charts = sheet.getCharts()
+
+        # --- グラフの位置とサイズを定義 ---
+        rect = Rectangle(10000, 1000, 15000, 8000)
+
+        # --- データ範囲のアドレスを定義 (A1:B6) ---
+        range_address = sheet.getCellRangeByName("A1:B6").getRangeAddress()
+
+        # --- チャートの追加と種類の設定 ---
+        charts.addNewByName("SampleScatterChart", rect, (range_address,), True, False)
+        chart_doc = charts.getByName("SampleScatterChart").getEmbeddedObject()
+        chart_doc.setDiagram(chart_doc.createInstance("com.sun.star.chart.XYDiagram"))
+        print("散布図の作成が完了しました。")
+        ```
+
+    # アクティブシートの最初のグラフにタイトルを作成する。
+        ```python
+        charts = sheet.Charts
+        if charts.getCount() == 0:
+            raise Exception("このシートにグラフが見つかりません。")
+
+        chart_doc = charts.getByIndex(0).EmbeddedObject
+        chart_doc.HasMainTitle = True  # タイトル表示ON
+        chart_doc.getTitle().String = "サンプルグラフタイトル"
+
+        diag = chart_doc.Diagram
+        diag.HasXAxisTitle = True  # X軸タイトル表示ON
+        diag.XAxisTitle.String = "X軸タイトル"
+        diag.HasYAxisTitle = True  # Y軸タイトル表示ON
+        diag.YAxisTitle.String = "Y軸タイトル"
+        print("グラフタイトル・軸タイトルを設定しました。")
+        ```
+"""
+
+# 静的部分。"boilerplate" は生成コード自身が接続する従来の形式、"injected" は接続済みのオブジェクトを使う形式
+_GENERATOR_STATIC_TEMPLATES = {
+    "boilerplate": (_GENERATOR_RULES_BOILERPLATE + _GENERATOR_HELPERS_SECTION + _GENERATOR_QUERY_SECTION
+                    + _GENERATOR_EXAMPLES_BOILERPLATE),
+    "injected": (_GENERATOR_RULES_INJECTED + _GENERATOR_HELPERS_SECTION + _GENERATOR_QUERY_SECTION
+                 + _GENERATOR_EXAMPLES_INJECTED),
+}
+_GENERATOR_STATIC_TEMPLATE = _GENERATOR_STATIC_TEMPLATES[GENERATOR_PROMPT_VARIANT]
 
-# 指示
+GENERATOR_TASK_TEMPLATE = """# 指示
 {instruction}
 
 # 過去の試行と評価 (フィードバック)
@@ -305,6 +440,22 @@ sheet = doc.getCurrentController().getActiveSheet()
 # あなたが生成するべき応答:
 """
 
+# 静的部分の波括弧エスケープを解除したもの (system フィールドにそのまま渡す)
+GENERATOR_SYSTEM_PROMPT = _GENERATOR_STATIC_TEMPLATE.format()
+
+# 従来どおり1つのプロンプトとして組み立てる場合のテンプレート
+GENERATOR_PROMPT_TEMPLATE = _GENERATOR_STATIC_TEMPLATE + "\n" + GENERATOR_TASK_TEMPLATE
+
+def build_generator_prompt(instruction, feedback_history):
+    """
+    コード生成用の (system, prompt) の組を返す。system は毎回同一の静的部分。
+    """
+    prompt = GENERATOR_TASK_TEMPLATE.format(
+        instruction=instruction,
+        feedback_history=feedback_history
+    )
+    return GENERATOR_SYSTEM_PROMPT, prompt
+
 def _image_to_base64(image_path):
     """画像をbase64エンコードする内部ヘルパー関数"""
     if not os.path.exists(image_path):
@@ -312,41 +463,382 @@ def _image_to_base64(image_path):
     with open(image_path, "rb") as f:
         return base64.b64encode(f.read()).decode("utf-8")
 
-def invoke_llm(prompt):
+# Ollamaの応答に含まれる計測値のうち、記録しておくフィールド
+OLLAMA_METRIC_FIELDS = (
+    "total_duration", "load_duration", "prompt_eval_count",
+    "prompt_eval_duration", "eval_count", "eval_duration",
+)
+
+# 直近の呼び出しの計測値 (並行呼び出しに備えてスレッドごとに保持する)
+_call_stats = threading.local()
+
+def get_last_call_stats():
+    """現在のスレッドで最後に行ったLLM呼び出しの計測値を返す。"""
+    return dict(getattr(_call_stats, "stats", {}))
+
+def _collect_metrics(json_response):
+    return {key: json_response[key] for key in OLLAMA_METRIC_FIELDS if key in json_response}
+
+def _read_stream(response, stats, started, stop_condition):
+    """
+    NDJSON形式のストリーミング応答を読み進める。
+    stop_condition が真を返した時点で読み取りを打ち切り、それまでのテキストを返す。
+    """
+    chunks = []
+    for line in response:
+        if not line.strip():
+            continue
+        chunk = json.loads(line.decode('utf-8'))
+        piece = chunk.get('response', '')
+        if piece:
+            if "time_to_first_token" not in stats:
+                stats["time_to_first_token"] = time.perf_counter() - started
+            chunks.append(piece)
+        if chunk.get('done'):
+            stats.update(_collect_metrics(chunk))
+            stats["done"] = True
+            # 終端チャンクまで読み切り、接続をプールへ戻せる状態にする
+            response.read()
+            break
+        # コードブロックや判定行の終端になり得るチャンクでのみ判定する
+        if stop_condition and piece and ("`" in piece or "\n" in piece) and stop_condition("".join(chunks)):
+            stats["stopped_early"] = True
+            break
+    return "".join(chunks)
+
+class OllamaClient:
+    """
+    Ollama APIへの永続接続 (keep-alive) をプールして使い回すHTTPクライアント。
+    接続はリクエストごとに排他的に貸し出すため、複数スレッドから同時に使用できる。
+    接続エラー・タイムアウト・5xx応答は指数バックオフで上限回数まで再試行する。
+    """
+
+    def __init__(self, api_url=OLLAMA_API_URL, max_connections=OLLAMA_MAX_CONNECTIONS,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 max_retries=OLLAMA_MAX_RETRIES, retry_backoff=OLLAMA_RETRY_BACKOFF):
+        parsed = urllib.parse.urlsplit(api_url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or "/"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _new_connection(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        conn = connection_class(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        # 接続確立後は、応答待ち (チャンク間の無通信時間) のタイムアウトに切り替える
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._new_connection()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def post_json(self, payload, handle_response):
+        """
+        JSONをPOSTし、handle_response(response) の戻り値を返す。
+        応答を最後まで読み切った接続だけをプールに戻す (途中で打ち切った接続は閉じる)。
+        """
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            conn = None
+            reusable = False
+            try:
+                conn = self._acquire()
+                conn.request("POST", self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                if response.status != 200:
+                    detail = response.read().decode('utf-8', errors='replace')
+                    reusable = not response.will_close
+                    error = RuntimeError(f"Ollama API error {response.status}: {detail}")
+                    if response.status < 500:
+                        raise error
+                    raise http.client.HTTPException(str(error))
+                result = handle_response(response)
+                reusable = response.isclosed() and not response.will_close
+                return result
+            except (OSError, http.client.HTTPException) as e:
+                last_error = e
+                if attempt < self.max_retries:
+                    wait = self.retry_backoff * (2 ** attempt)
+                    print(f"Ollamaへのリクエストに失敗しました ({e})。{wait:.1f}秒後に再試行します ({attempt + 1}/{self.max_retries})...")
+                    if conn is not None:
+                        self._release(conn, False)
+                        conn = None
+                    time.sleep(wait)
+            finally:
+                if conn is not None:
+                    self._release(conn, reusable)
+        raise last_error
+
+    def close(self):
+        """プール中の待機接続をすべて閉じる。"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_client():
+    """共有のOllamaClientを返す (初回呼び出し時に生成する)。"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = OllamaClient()
+        return _default_client
+
+# 応答内容に影響しないため、キャッシュキーから除外するフィールド
+_CACHE_IGNORED_FIELDS = ("stream", "keep_alive")
+
+class ResponseCache:
+    """
+    LLM応答をローカルディスクに保存する、内容アドレス型のキャッシュ。
+    キーは (モデル, system, プロンプト全文, 画像, オプション) のハッシュ。
+    容量と経過時間の上限を超えた分は、最終利用時刻 (mtime) の古い順に削除する。
+    ディレクトリ全体の走査は、保存した分を足し込んだ合計サイズが上限を超えたときか、
+    前回の走査から scan_interval 秒が経過したときだけ行う。
+    """
+
+    def __init__(self, directory=LLM_CACHE_DIR, max_bytes=LLM_CACHE_MAX_BYTES, max_age=LLM_CACHE_MAX_AGE,
+                 scan_interval=LLM_CACHE_SCAN_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.scan_interval = scan_interval
+        self._lock = threading.Lock()
+        # 前回の走査で求めた合計サイズに、その後保存した分を足したもの (未走査なら None)
+        self._total_bytes = None
+        self._last_scan = 0.0
+
+    @staticmethod
+    def make_key(data):
+        keyed = {k: v for k, v in data.items() if k not in _CACHE_IGNORED_FIELDS}
+        if "images" in keyed:
+            # 画像本体の代わりにそのハッシュをキーに含める
+            keyed["images"] = [hashlib.sha256(image.encode("ascii")).hexdigest() for image in keyed["images"]]
+        encoded = json.dumps(keyed, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        """キャッシュ済みの応答を返す。無い・期限切れの場合は None。"""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # 利用時刻を更新し、LRU の順序に反映する
+            os.utime(path, None)
+            return entry.get("response")
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, response, model=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {"model": model, "created": time.time(), "response": response}
+        # 並行書き込みで壊れたファイルを読まないよう、一時ファイルから置き換える
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            written = os.path.getsize(temp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += written - replaced
+            needs_scan = (self._total_bytes is None or self._total_bytes > self.max_bytes
+                          or time.time() - self._last_scan > self.scan_interval)
+        if needs_scan:
+            self.evict()
+
+    def evict(self):
+        """期限切れのエントリを削除し、合計サイズが上限を超えていれば古い順に削除する。"""
+        with self._lock:
+            entries = []
+            now = time.time()
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith(".json"):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if now - stat.st_mtime > self.max_age:
+                        self._remove(path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+            self._total_bytes = total
+            self._last_scan = now
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """キャッシュを全て削除する。"""
+        with self._lock:
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    self._remove(os.path.join(root, name))
+            self._total_bytes = 0
+
+
+_response_cache = ResponseCache()
+
+def _post_generate(data, stop_condition=None, cache_mode=None, complete_condition=None):
+    """
+    /api/generate にリクエストを送り、応答テキストを返す。
+    ストリーミング時は stop_condition を満たした時点で接続を閉じ、残りの生成を打ち切る。
+    キャッシュに保存するのは、終端チャンクまで受信した応答か、途中で打ち切った応答のうち
+    complete_condition (必要な部分が揃ったかの判定) を満たすものだけ。キャンセルによる断片は保存しない。
+    cache_mode: "use" (キャッシュを参照・保存), "refresh" (参照せず上書き保存), "bypass" (使用しない)。
+    省略時は config.LLM_CACHE_MODE に従う。
+    """
+    if cache_mode is None:
+        cache_mode = LLM_CACHE_MODE
+    stats = {"model": data.get("model"), "stream": data.get("stream", False)}
+    started = time.perf_counter()
+
+    cache_key = None
+    if cache_mode in ("use", "refresh"):
+        cache_key = _response_cache.make_key(data)
+        if cache_mode == "use":
+            cached = _response_cache.get(cache_key)
+            if cached is not None:
+                stats["cache_hit"] = True
+                stats["wall_time"] = time.perf_counter() - started
+                _call_stats.stats = stats
+                print("LLM応答: キャッシュを使用しました。")
+                return cached
+
+    def handle_response(response):
+        if data.get("stream"):
+            return _read_stream(response, stats, started, stop_condition)
+        json_response = json.loads(response.read().decode('utf-8'))
+        stats.update(_collect_metrics(json_response))
+        stats["done"] = True
+        return json_response.get('response', '')
+
+    text = get_client().post_json(data, handle_response)
+    stats["wall_time"] = time.perf_counter() - started
+    _call_stats.stats = stats
+
+    complete = stats.get("done") or bool(complete_condition and text and complete_condition(text))
+    if cache_key and text and complete:
+        try:
+            _response_cache.put(cache_key, text, model=data.get("model"))
+        except OSError as e:
+            print(f"LLM応答キャッシュの保存に失敗しました: {e}")
+
+    if "time_to_first_token" in stats:
+        message = f"LLM応答: 最初のトークンまで {stats['time_to_first_token']:.2f}秒, 合計 {stats['wall_time']:.2f}秒"
+        if stats.get("stopped_early"):
+            message += " (必要な部分の受信後に打ち切り)"
+        print(message)
+    if "prompt_eval_count" in stats:
+        # キャッシュが効いていれば、2回目以降は動的部分のトークン数だけになる
+        print(f"プロンプト評価: {stats['prompt_eval_count']} トークン, {stats.get('prompt_eval_duration', 0) / 1e9:.2f}秒")
+    return text
+
+def invoke_llm(prompt, stop_condition=None, stream=None, system=None, cache_mode=None, options=None,
+               complete_condition=None):
     """
     指定されたプロンプトを使用してOllama APIを直接呼び出し、応答を返す。
+    stop_condition (受信済みテキストを受け取り bool を返す関数) を渡すと、
+    ストリーミング受信中に条件を満たした時点で生成を打ち切る。
+    system には毎回同一の静的な指示を渡す (プロンプトキャッシュの再利用のため)。
+    cache_mode で応答キャッシュの使い方 ("use" / "refresh" / "bypass") を上書きできる。
+    options には temperature や seed など、Ollama の追加オプションを渡す。
+    complete_condition には、途中で打ち切った応答が完結しているか (キャッシュしてよいか) の判定を渡す。
+    キャンセルを含む stop_condition を使う場合も、こちらには完結の判定だけを渡すこと。
     """
+    if stream is None:
+        stream = OLLAMA_STREAM
     try:
         data = {
             "model": CODE_GENERATOR_MODEL,
             "prompt": prompt,
-            "stream": False
+            "stream": stream,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            # 同じモデルを生成と検証で共有しても再ロードが起きないよう、num_ctx は常に同じ値を送る
+            "options": dict(options or {}, num_ctx=OLLAMA_NUM_CTX)
         }
-        json_data = json.dumps(data).encode('utf-8')
-
-        req = urllib.request.Request(
-            OLLAMA_API_URL,
-            data=json_data,
-            headers={'Content-Type': 'application/json'}
-        )
-
-        with urllib.request.urlopen(req) as response:
-            response_text = response.read().decode('utf-8')
-            json_response = json.loads(response_text)
-            return json_response.get('response', '')
+        if system:
+            data["system"] = system
+        return _post_generate(data, stop_condition, cache_mode, complete_condition)
 
     except Exception as e:
-        print("LLMの呼び出し中にエラーが発生しました: {{}}".format(e))
+        print("LLMの呼び出し中にエラーが発生しました: {}".format(e))
         return None
 
-def invoke_llm_with_image(prompt, image_path, model_name):
+def invoke_llm_with_image(prompt, image_path, model_name, stop_condition=None, stream=None, cache_mode=None,
+                          image_bytes=None, image_b64=None, complete_condition=None):
     """
     プロンプトと画像をOllamaに送信し、応答を返す。
     画像解析が可能なマルチモーダルモデルを指定してください。
+    image_bytes を渡した場合は、ファイルを読まずにそのバイト列を送信する (image_path は None でよい)。
+    image_b64 を渡した場合は、Base64エンコード済みの画像としてそのまま送信する。
+    complete_condition は invoke_llm と同じ (途中で打ち切った応答をキャッシュしてよいかの判定)。
     """
-    image_b64 = _image_to_base64(image_path)
+    if stream is None:
+        stream = OLLAMA_STREAM
+    if image_b64 is None and image_bytes is not None:
+        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+    elif image_b64 is None:
+        image_b64 = _image_to_base64(image_path)
     if not image_b64:
-        print("エラー: 画像ファイルが見つからないか、読み込めません: {{}}".format(image_path))
+        print("エラー: 画像ファイルが見つからないか、読み込めません: {}".format(image_path))
         return None
 
     try:
@@ -354,21 +846,13 @@ def invoke_llm_with_image(prompt, image_path, model_name):
             "model": model_name,
             "prompt": prompt,
             "images": [image_b64],
-            "stream": False
+            "stream": stream,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            # 同じモデルを生成と検証で共有しても再ロードが起きないよう、num_ctx は常に同じ値を送る
+            "options": {"num_ctx": OLLAMA_NUM_CTX}
         }
-        json_data = json.dumps(data).encode('utf-8')
-
-        req = urllib.request.Request(
-            OLLAMA_API_URL,
-            data=json_data,
-            headers={'Content-Type': 'application/json'}
-        )
-
-        with urllib.request.urlopen(req) as response:
-            response_text = response.read().decode('utf-8')
-            json_response = json.loads(response_text)
-            return json_response.get('response', '')
+        return _post_generate(data, stop_condition, cache_mode, complete_condition)
 
     except Exception as e:
-        print("画像付きLLMの呼び出し中にエラーが発生しました: {{}}".format(e))
-        return None
\ No newline at end of file
+        print("画像付きLLMの呼び出し中にエラーが発生しました: {}".format(e))
+        return None
@@ -2,85 +2,243 @@ import re
 import sys
 import os
 import json
-import uno
-from llm_wrapper import invoke_llm, GENERATOR_PROMPT_TEMPLATE
-from executor import execute_and_verify
-from libreoffice_manager import check_libreoffice_connection
-from config import IMAGE_VERIFIER_MODEL
+import threading
+import concurrent.futures
+from llm_wrapper import invoke_llm, build_generator_prompt, get_last_call_stats
+from executor import execute_and_verify, execute_code, get_last_stage_timings
+from libreoffice_manager import check_libreoffice_connection, UnoSession, DocumentGuard, clone_document, discard_clone
+from preflight import preflight, format_problems
+from script_runner import INJECTED_NAMES
+import tracing
+from feedback_manager import FeedbackHistory, available_feedback_tokens
+from config import IMAGE_VERIFIER_MODEL, PARALLEL_CANDIDATES, CANDIDATE_OPTIONS
+
+CODE_PATTERN = re.compile(r"```python\n(.*?)\n```", re.DOTALL)
+JSON_PATTERN = re.compile(r"```json\n(.*?)\n```", re.DOTALL)
+
+def generation_is_complete(response_text):
+    """
+    ストリーミング受信中の応答に、コードブロックと検証クエリのJSONブロックが
+    両方とも閉じた状態で揃ったかを判定する。揃った後の説明文は不要なため受信を打ち切る。
+    """
+    return bool(CODE_PATTERN.search(response_text) and JSON_PATTERN.search(response_text))
 
 def extract_code_and_query(response_text):
     """
     LLMの応答からPythonコードと検証用JSONクエリを抽出する。
     """
     # Pythonコードの抽出
-    code_pattern = re.compile(r"```python\n(.*?)\n```", re.DOTALL)
-    code_match = code_pattern.search(response_text)
+    code_match = CODE_PATTERN.search(response_text)
     code = code_match.group(1).strip() if code_match else None
 
     # JSONクエリの抽出
-    json_pattern = re.compile(r"```json\n(.*?)\n```", re.DOTALL)
-    json_match = json_pattern.search(response_text)
+    json_match = JSON_PATTERN.search(response_text)
     query_str = json_match.group(1).strip() if json_match else "{}"
     
     try:
         query = json.loads(query_str)
     except json.JSONDecodeError:
         query = {}
+    # オブジェクト以外 (リストや null) は検証クエリとして扱えないため空にする
+    if not isinstance(query, dict):
+        query = {}
 
     return code, query
 
-def main():
+def candidate_options(index):
+    """候補ごとの生成オプション (温度とシード) を返す。"""
+    return dict(CANDIDATE_OPTIONS[index % len(CANDIDATE_OPTIONS)], seed=index + 1)
+
+def run_candidate(index, instruction, feedback_history, session, cancel_event):
     """
-    メインの自己改善ループを実行する。
+    1つの候補を生成し、ドキュメントの非表示コピー上で実行・検証する。
+    cancel_event がセットされると、生成・検証のストリームを閉じて早期に終了する。
     """
-    instruction = input("どのような操作をしますか？（例: A1セルに'Hello'と入力）: ")
-    if not instruction.strip():
-        print("指示が入力されなかったため、処理を終了します。")
-        return
-
-    max_iterations = 5
-    feedback_history = "なし"
-    final_code = ""
-
-    print(f"--- 初期指示 ---\n{instruction}\n")
+    system_prompt, prompt = build_generator_prompt(instruction, feedback_history)
+    stop_condition = lambda text: cancel_event.is_set() or generation_is_complete(text)
+    with tracing.span("generation") as span:
+        generated_text = invoke_llm(prompt, stop_condition=stop_condition, system=system_prompt,
+                                    options=candidate_options(index), complete_condition=generation_is_complete)
+        span.record_llm(get_last_call_stats())
+    if cancel_event.is_set():
+        return {"index": index, "cancelled": True}
+    if not generated_text:
+        return {"index": index, "code": None, "note": "コード生成に失敗しました。"}
 
-    if not check_libreoffice_connection():
-        return
+    with tracing.span("extraction"):
+        code, query = extract_code_and_query(generated_text)
+    if not code:
+        return {"index": index, "code": None, "note": "コードブロックが生成されませんでした。"}
+    with tracing.span("preflight") as span:
+        problems = preflight(code, INJECTED_NAMES)
+        span.attrs["problems"] = len(problems)
+    if problems:
+        return {"index": index, "code": code, "result": format_problems(problems), "is_pass": False}
 
+    copy_doc, copy_path = None, None
     try:
-        local_context = uno.getComponentContext()
-        resolver = local_context.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_context)
-        context = resolver.resolve("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
-        desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
-        doc = desktop.getCurrentComponent()
+        with session.lock:
+            if cancel_event.is_set():
+                return {"index": index, "cancelled": True}
+            copy_doc, copy_path = clone_document(session.desktop, session.doc)
+        result, is_pass = execute_and_verify(
+            code_string=code,
+            verification_query=query,
+            doc=copy_doc,
+            desktop=session.desktop,
+            instruction=instruction,
+            image_verifier_model=IMAGE_VERIFIER_MODEL,
+            session=session.derive(copy_doc),
+            uno_guard=DocumentGuard(session.desktop, copy_doc, session.lock),
+            image_path=os.path.join(os.getcwd(), f"verification_{index + 1}.png"),
+            cancel_event=cancel_event,
+            # コピーは検証後に破棄するため、取り消しは不要
+            rollback=False
+        )
     except Exception as e:
-        print(f"LibreOfficeへの接続に失敗しました: {e}")
-        return
+        return {"index": index, "code": code, "result": f"候補の検証中にエラーが発生しました: {e}", "is_pass": False}
+    finally:
+        with session.lock:
+            discard_clone(copy_doc, copy_path)
+    return {"index": index, "code": code, "result": result, "is_pass": is_pass}
+
+def run_candidates(instruction, feedback_history, session, count):
+    """
+    count 個の候補を並列に生成・検証し、最初に合格した候補を返す。
+    合格が出た時点で残りの候補はキャンセルし、完了を待たずに戻る。
+
+    Returns:
+        tuple: (合格した候補 or None, 不合格だった候補のリスト)
+    """
+    cancel_event = threading.Event()
+    failures = []
+    winner = None
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=count)
 
+    def traced_candidate(index):
+        with tracing.context(candidate=index):
+            return run_candidate(index, instruction, feedback_history, session, cancel_event)
+
+    futures = {pool.submit(tracing.propagate(traced_candidate), index): index for index in range(count)}
     try:
-        for current_iteration in range(1, max_iterations + 1):
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = {"index": futures[future], "code": None, "note": f"候補の処理中にエラーが発生しました: {e}"}
+            if outcome.get("cancelled"):
+                continue
+            if outcome.get("is_pass"):
+                winner = outcome
+                cancel_event.set()
+                break
+            failures.append(outcome)
+    finally:
+        # cancel_futures は Python 3.9 以降のため、未実行の候補は個別にキャンセルする
+        # (LibreOffice 7.x 同梱の python は 3.8)
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+    failures.sort(key=lambda outcome: outcome["index"])
+    return winner, failures
+
+def run_task(instruction, session, max_iterations=5, uno_guard=None, task_id=None):
+    """
+    1つの指示について、生成・実行・検証の自己改善ループを session のドキュメント上で実行する。
+    uno_guard: 実行・検証中に保持するコンテキストマネージャ (非表示で読み込んだドキュメントを
+               操作対象にする DocumentGuard など)。
+    task_id: トレースでこのタスクを識別する値 (省略時は自動で採番する)。
+
+    Returns:
+        dict: success (成功したか), final_code (成功したコード), iterations (実行した試行回数)
+    """
+    with tracing.context(task=task_id or tracing.new_task_id()):
+        with tracing.span("task") as span:
+            result = _run_iterations(instruction, session, max_iterations, uno_guard)
+            span.attrs.update(success=result["success"], iterations=result["iterations"])
+        tracing.get_tracer().record_task("success" if result["success"] else "failed",
+                                         iterations=result["iterations"])
+    return result
+
+def _run_iterations(instruction, session, max_iterations, uno_guard):
+    feedback = FeedbackHistory()
+    # フィードバック以外の部分を差し引いた、コンテキストに収まるフィードバックの上限
+    feedback_tokens = available_feedback_tokens(*build_generator_prompt(instruction, ""))
+    final_code = ""
+    current_iteration = 0
+
+    for current_iteration in range(1, max_iterations + 1):
+        with tracing.context(iteration=current_iteration), tracing.span("iteration"):
             print(f"--- イテレーション {current_iteration}/{max_iterations} ---")
 
+            try:
+                session.ensure_alive()
+                desktop = session.desktop
+                doc = session.doc
+            except Exception as e:
+                print(f"LibreOfficeへの再接続に失敗しました: {e}")
+                break
+
+            feedback_history = feedback.render(feedback_tokens)
+
+            if PARALLEL_CANDIDATES > 1:
+                print(f"1-2. {PARALLEL_CANDIDATES} 個の候補を並列に生成し、ドキュメントのコピー上で検証中...")
+                with tracing.span("candidates", count=PARALLEL_CANDIDATES):
+                    winner, failures = run_candidates(instruction, feedback_history, session, PARALLEL_CANDIDATES)
+                for outcome in failures:
+                    label = f"{current_iteration}-{outcome['index'] + 1}"
+                    if outcome.get("code"):
+                        feedback.add_failure(label, outcome["code"], outcome["result"])
+                    else:
+                        feedback.add_note(label, outcome["note"])
+                if winner:
+                    print(f"候補 {winner['index'] + 1} が検証に合格しました。実際のドキュメントに適用します...")
+                    print(f"検証結果:\n---\n{winner['result']}\n---")
+                    with uno_guard or session.lock:
+                        execution_error, _ = execute_code(winner["code"], doc, desktop, session=session)
+                    if execution_error:
+                        print("合格した候補の適用に失敗しました。")
+                        feedback.add_failure(current_iteration, winner["code"], f"Execution Error: {execution_error}")
+                    else:
+                        print("\n--- タスク成功！ ---")
+                        final_code = winner["code"]
+                        break
+                else:
+                    print("\n--- 全ての候補が失敗。フィードバックを次の試行に活かします。 ---")
+                if current_iteration == max_iterations:
+                    print("\n--- 最大試行回数に達しました ---")
+                continue
+
             print("1. コードと検証クエリを生成中...")
-            prompt = GENERATOR_PROMPT_TEMPLATE.format(
-                instruction=instruction,
-                feedback_history=feedback_history
-            )
-            generated_text = invoke_llm(prompt)
+            system_prompt, prompt = build_generator_prompt(instruction, feedback_history)
+            with tracing.span("generation") as span:
+                generated_text = invoke_llm(prompt, stop_condition=generation_is_complete, system=system_prompt,
+                                            complete_condition=generation_is_complete)
+                span.record_llm(get_last_call_stats())
             if not generated_text:
                 print("コード生成に失敗しました。処理を中断します。")
                 break
 
-            code_to_execute, verification_query = extract_code_and_query(generated_text)
+            with tracing.span("extraction"):
+                code_to_execute, verification_query = extract_code_and_query(generated_text)
 
             if not code_to_execute:
                 print("応答からPythonコードを抽出できませんでした。")
-                feedback_history += f"\n試行{current_iteration}: コードブロックが生成されませんでした。"
+                feedback.add_note(current_iteration, "コードブロックが生成されませんでした。")
                 continue
 
             print(f"生成されたコード:\n---\n{code_to_execute}\n---")
             print(f"生成された検証クエリ:\n---\n{json.dumps(verification_query, indent=2, ensure_ascii=False)}\n---")
 
+            with tracing.span("preflight") as span:
+                problems = preflight(code_to_execute, INJECTED_NAMES)
+                span.attrs["problems"] = len(problems)
+            if problems:
+                preflight_result = format_problems(problems)
+                print(f"{preflight_result}\n\n--- 失敗。フィードバックを次の試行に活かします。 ---")
+                feedback.add_failure(current_iteration, code_to_execute, preflight_result)
+                continue
+
             print("2. コードを実行し、ハイブリッド検証中...")
             verification_result, is_pass = execute_and_verify(
                 code_string=code_to_execute,
@@ -88,10 +246,14 @@ def main():
                 doc=doc,
                 desktop=desktop,
                 instruction=instruction,
-                image_verifier_model=IMAGE_VERIFIER_MODEL
+                image_verifier_model=IMAGE_VERIFIER_MODEL,
+                session=session,
+                uno_guard=uno_guard
             )
 
             print(f"検証結果:\n---\n{verification_result}\n---")
+            timings = get_last_stage_timings()
+            print("ステージ別所要時間 (秒): " + ", ".join(f"{stage}={seconds}" for stage, seconds in timings.items()))
 
             if is_pass:
                 print("\n--- タスク成功！ ---")
@@ -99,19 +261,40 @@ def main():
                 break
             else:
                 print("\n--- 失敗。フィードバックを次の試行に活かします。 ---")
-                feedback_history += f"\n# 試行 {current_iteration}: 失敗\n"
-                feedback_history += f"コード:\n{code_to_execute}\n"
-                feedback_history += f"判定結果:\n{verification_result}\n"
+                feedback.add_failure(current_iteration, code_to_execute, verification_result)
 
             if current_iteration == max_iterations:
                 print("\n--- 最大試行回数に達しました ---")
 
-    finally:
-        pass
+    return {"success": bool(final_code), "final_code": final_code, "iterations": current_iteration}
+
+def main():
+    """
+    メインの自己改善ループを実行する。
+    """
+    instruction = input("どのような操作をしますか？（例: A1セルに'Hello'と入力）: ")
+    if not instruction.strip():
+        print("指示が入力されなかったため、処理を終了します。")
+        return
+
+    print(f"--- 初期指示 ---\n{instruction}\n")
+
+    session = UnoSession()
+    if not check_libreoffice_connection(session=session):
+        return
+
+    try:
+        session.desktop
+        session.doc
+    except Exception as e:
+        print(f"LibreOfficeへの接続に失敗しました: {e}")
+        return
+
+    result = run_task(instruction, session)
 
     print("\n--- 処理完了 ---")
-    if final_code:
-        print(f"最終的に成功したコード:\n{final_code}")
+    if result["final_code"]:
+        print(f"最終的に成功したコード:\n{result['final_code']}")
     else:
         print("タスクは指定された試行回数内に成功しませんでした。")
 
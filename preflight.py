@@ -0,0 +1,246 @@
+import ast
+import builtins
+from config import PREFLIGHT_CELL_LOOP_LIMIT
+
+# 生成コードで使ってはいけない属性 (メソッド) と、その理由
+FORBIDDEN_ATTRIBUTES = {
+    "loadComponentFromURL": "新しいドキュメントを開く・作成する `loadComponentFromURL` の使用は禁止されています。既に開かれているドキュメント (`doc`) を操作してください。",
+    "terminate": "`terminate` は LibreOffice 自体を終了させるため使用できません。",
+}
+
+# 新規ドキュメントの作成を示す URL
+FORBIDDEN_URL_PREFIX = "private:factory/"
+
+# セル単位のアクセスとみなすメソッド・補助関数
+CELL_ACCESS_NAMES = {
+    "getCellByPosition", "getCellRangeByName", "getCellRangeByPosition",
+    "setValue", "setString", "setFormula", "getValue", "getString", "getFormula",
+    "set_cell_value", "get_cell_value",
+}
+
+def preflight(code_string, injected_names=(), cell_loop_limit=None):
+    """
+    生成されたコードを LibreOffice に触れる前に静的に検査する。
+    構文エラー、ルール違反 (禁止された呼び出し)、未定義の名前、広い範囲に対するセル単位のループを検出する。
+
+    injected_names: 実行時に渡される変数名 (doc, desktop, 補助関数など)。未定義とはみなさない。
+
+    Returns:
+        list: 問題点のメッセージ。空なら実行してよい。
+    """
+    if cell_loop_limit is None:
+        cell_loop_limit = PREFLIGHT_CELL_LOOP_LIMIT
+    try:
+        tree = ast.parse(code_string)
+    except SyntaxError as e:
+        return [f"構文エラー ({e.lineno} 行目): {e.msg}"]
+
+    problems = []
+    problems.extend(_find_rule_violations(tree))
+    problems.extend(_find_undefined_names(tree, injected_names))
+    problems.extend(_find_cell_loops(tree, cell_loop_limit))
+    problems.extend(_find_endless_loops(tree))
+    return problems
+
+def format_problems(problems):
+    """問題点をフィードバック用の文字列にまとめる。"""
+    return "Preflight Error: コードは実行前の検査で却下されました (実行していません)。\n" + "\n".join(
+        f"- {problem}" for problem in problems)
+
+def compile_generated(code_string, filename="<generated>"):
+    """
+    既知の書き換えを AST に適用してからコンパイルし、コードオブジェクトを返す。
+    構文エラーの場合は SyntaxError を送出する。
+    """
+    tree = _GeneratedCodeRewriter().visit(ast.parse(code_string, filename))
+    ast.fix_missing_locations(tree)
+    return compile(tree, filename, "exec")
+
+class _GeneratedCodeRewriter(ast.NodeTransformer):
+    """
+    生成コードに対する既知の書き換え。
+    - 存在しない `uno.awt.Rectangle(...)` のような構造体の生成を
+      `uno.createUnoStruct("com.sun.star.awt.Rectangle", ...)` にする
+      (完全修飾の `uno.com.sun.star.awt.Rectangle(...)` も同じ形にする)。
+    - 残っている接続の定型コードを、実行時に渡される接続済みのオブジェクトに置き換える。
+      `resolver.resolve("...StarOffice.ComponentContext")` → `ctx`、
+      Desktop の生成 → `desktop`、`getCurrentComponent()` / `CurrentComponent` → `doc`。
+    """
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        path = _dotted_name(node.func)
+        if path and path[0] == "uno" and len(path) >= 3:
+            # 完全修飾の uno.com.sun.star.awt.Rectangle(...) には接頭辞を重ねない
+            if path[1:4] == ["com", "sun", "star"]:
+                type_name = ".".join(path[1:])
+            else:
+                type_name = "com.sun.star." + ".".join(path[1:])
+            new_func = ast.Attribute(value=ast.Name(id="uno", ctx=ast.Load()), attr="createUnoStruct", ctx=ast.Load())
+            new_node = ast.Call(func=new_func, args=[ast.Constant(value=type_name)] + node.args, keywords=node.keywords)
+            return ast.copy_location(new_node, node)
+        if isinstance(node.func, ast.Attribute):
+            method = node.func.attr
+            first_arg = node.args[0].value if node.args and isinstance(node.args[0], ast.Constant) else None
+            if method == "resolve" and isinstance(first_arg, str) and "StarOffice.ComponentContext" in first_arg:
+                return _injected(node, "ctx")
+            if method in ("createInstanceWithContext", "createInstance") and first_arg == "com.sun.star.frame.Desktop":
+                return _injected(node, "desktop")
+            if method == "getCurrentComponent" and not node.args:
+                return _injected(node, "doc")
+        return node
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        if node.attr == "CurrentComponent" and isinstance(node.ctx, ast.Load):
+            return _injected(node, "doc")
+        return node
+
+def _injected(node, name):
+    return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+def _dotted_name(node):
+    """a.b.c の形の式を ["a", "b", "c"] に変換する。それ以外は None。"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return parts[::-1]
+
+def _find_rule_violations(tree):
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in FORBIDDEN_ATTRIBUTES:
+            problems.append(f"{node.lineno} 行目: {FORBIDDEN_ATTRIBUTES[node.attr]}")
+        elif (isinstance(node, ast.Constant) and isinstance(node.value, str)
+              and node.value.startswith(FORBIDDEN_URL_PREFIX)):
+            problems.append(f"{node.lineno} 行目: 新しいドキュメント ({node.value}) の作成は禁止されています。")
+    return problems
+
+def _find_undefined_names(tree, injected_names):
+    bound = set(dir(builtins)) | set(injected_names)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    # 何が読み込まれるか分からないため検査しない
+                    return []
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+
+    problems = []
+    reported = set()
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
+                and node.id not in bound and node.id not in reported):
+            reported.add(node.id)
+            problems.append(f"{node.lineno} 行目: 未定義の名前 '{node.id}' を使用しています。")
+    return problems
+
+def _constant_int(node):
+    """定数だけからなる整数式 (例: 100, 10 * 1000, -1) を評価する。評価できなければ None。"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, int) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant_int(node.operand)
+        return -value if value is not None else None
+    if isinstance(node, ast.BinOp):
+        left, right = _constant_int(node.left), _constant_int(node.right)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, ast.Add):
+            return left + right
+        if isinstance(node.op, ast.Sub):
+            return left - right
+        if isinstance(node.op, ast.Mult):
+            return left * right
+        if isinstance(node.op, ast.FloorDiv) and right:
+            return left // right
+    return None
+
+def _range_length(node):
+    """range(...) の回数を返す。引数が定数でなければ None。"""
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "range"):
+        return None
+    args = [_constant_int(arg) for arg in node.args]
+    if not args or None in args or node.keywords:
+        return None
+    start, stop, step = (0, args[0], 1) if len(args) == 1 else (args[0], args[1], args[2] if len(args) > 2 else 1)
+    if step == 0:
+        return None
+    return len(range(start, stop, step))
+
+def _accesses_cells(statements):
+    for statement in statements:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Call):
+                func = node.func
+                name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+                if name in CELL_ACCESS_NAMES:
+                    return True
+    return False
+
+def _find_cell_loops(tree, limit):
+    problems = []
+
+    def visit(node, iterations):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.For):
+                count = _range_length(child.iter)
+                total = iterations * count if count is not None else iterations
+                if count is not None and total >= limit and _accesses_cells(child.body):
+                    problems.append(
+                        f"{child.lineno} 行目: セルを1つずつ操作するループが約 {total} 回実行されます (上限 {limit} 回)。"
+                        "範囲をまとめて読み書きしてください (write_range / fill_column / read_range など)。")
+                    continue
+                visit(child, total)
+            else:
+                visit(child, iterations)
+
+    visit(tree, 1)
+    return problems
+
+def _find_endless_loops(tree):
+    problems = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.While) and isinstance(node.test, ast.Constant) and node.test.value
+                and not _exits_loop(node.body)):
+            problems.append(f"{node.lineno} 行目: `while True` のループに break / return / raise がなく、終了しません。")
+    return problems
+
+def _exits_loop(statements):
+    """ループ本体 (内側のループ・関数定義は除く) に break / return / raise があるか。"""
+    for statement in statements:
+        if isinstance(statement, (ast.Break, ast.Return, ast.Raise)):
+            return True
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        if isinstance(statement, (ast.For, ast.While, ast.AsyncFor)):
+            # 内側のループの break は外側を抜けないが、return / raise は抜ける
+            if _has_return_or_raise(statement.body + statement.orelse):
+                return True
+            continue
+        for field in ("body", "orelse", "finalbody", "handlers"):
+            children = getattr(statement, field, None)
+            if children and _exits_loop(children):
+                return True
+    return False
+
+def _has_return_or_raise(statements):
+    for statement in statements:
+        for node in ast.walk(statement):
+            if isinstance(node, (ast.Return, ast.Raise)):
+                return True
+    return False
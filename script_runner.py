@@ -0,0 +1,192 @@
+import sys
+import os
+import json
+import time
+import traceback
+import subprocess
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+from libreoffice_manager import (
+    UnoSession, set_cell_value, get_cell_value, get_sheet, save_document, close_document,
+    write_range, read_range, read_formulas, fill_column, fill_row, set_range_style,
+)
+from preflight import compile_generated
+from config import EXECUTION_TIMEOUT, EXECUTION_MEMORY_LIMIT_MB, EXECUTOR_PYTHON
+
+# 子プロセスのメモリ使用量を確認する間隔 (秒)
+_POLL_INTERVAL = 0.2
+
+# メモリ上限を適用できない旨の警告を表示済みか
+_memory_limit_warned = False
+
+# 生成コードに渡す補助関数
+HELPERS = {
+    'set_cell_value': set_cell_value,
+    'get_cell_value': get_cell_value,
+    'get_sheet': get_sheet,
+    'save_document': save_document,
+    'close_document': close_document,
+    'write_range': write_range,
+    'read_range': read_range,
+    'read_formulas': read_formulas,
+    'fill_column': fill_column,
+    'fill_row': fill_row,
+    'set_range_style': set_range_style,
+}
+
+# 生成コードの実行時に定義済みとなる名前
+INJECTED_NAMES = ('ctx', 'smgr', 'desktop', 'doc', 'sheet') + tuple(HELPERS)
+
+def injected_globals(doc, desktop, ctx):
+    """
+    生成コードに渡す接続済みのオブジェクトと補助関数。
+    生成コードが自分で接続し直さなくて済むよう、ctx / smgr / desktop / doc / sheet を用意する。
+    """
+    try:
+        sheet = doc.getCurrentController().getActiveSheet()
+    except Exception:
+        sheet = None
+    return dict(HELPERS, ctx=ctx, smgr=ctx.ServiceManager if ctx is not None else None,
+                desktop=desktop, doc=doc, sheet=sheet)
+
+def exec_generated(code_string, doc, desktop, ctx=None):
+    """
+    生成されたコードを、既知の書き換え (接続の定型コードの置き換えなど) を適用したうえで実行する。
+    """
+    exec(compile_generated(code_string), injected_globals(doc, desktop, ctx))
+
+def document_url(doc):
+    """子プロセスで同じドキュメントを探すための URL。未保存のドキュメントは空文字列。"""
+    try:
+        return doc.getURL()
+    except Exception:
+        return ""
+
+def _timeout_error(timeout):
+    return (f"TimeoutError: スクリプトが制限時間 {timeout} 秒以内に終了しなかったため、実行プロセスを強制終了しました。\n"
+            "無限ループや、広い範囲に対するセル単位のUNO呼び出しが原因の可能性があります。"
+            "ループの終了条件を見直し、範囲はまとめて読み書きしてください。\n")
+
+def _memory_error(limit_mb):
+    return (f"MemoryError: スクリプトのメモリ使用量が上限 {limit_mb} MB を超えたため、実行プロセスを強制終了しました。\n"
+            "巨大なリストや文字列を作っていないか見直してください。\n")
+
+def run_in_subprocess(code_string, doc, connection_string, timeout=None, memory_limit_mb=None):
+    """
+    生成されたコードを、同じ soffice に接続した別プロセスで実行する。
+    制限時間 timeout 秒を超えた場合、またはメモリ使用量が memory_limit_mb を超えた場合は
+    プロセスを強制終了し、その旨をフィードバック用のエラーとして返す。
+
+    Returns:
+        tuple: (エラーメッセージ or None, 結果メッセージ or None)。execute_code と同じ形式。
+    """
+    if timeout is None:
+        timeout = EXECUTION_TIMEOUT
+    if memory_limit_mb is None:
+        memory_limit_mb = EXECUTION_MEMORY_LIMIT_MB
+    if memory_limit_mb and resource is None and psutil is None:
+        _warn_memory_limit_unavailable(memory_limit_mb)
+    payload = json.dumps({
+        "code": code_string,
+        "connection_string": connection_string,
+        "doc_url": document_url(doc),
+        "memory_limit_mb": memory_limit_mb,
+    })
+    process = subprocess.Popen(
+        [EXECUTOR_PYTHON, os.path.abspath(__file__)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.getcwd(), text=True, encoding="utf-8",
+    )
+    deadline = time.monotonic() + timeout
+    watched = psutil.Process(process.pid) if psutil is not None and resource is None else None
+    stdin_payload = payload
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _kill(process)
+            return _timeout_error(timeout), None
+        try:
+            stdout, _ = process.communicate(stdin_payload, timeout=min(remaining, _POLL_INTERVAL))
+            break
+        except subprocess.TimeoutExpired:
+            stdin_payload = None
+        # resource が使えない環境 (Windows) では、psutil があれば親プロセスから監視する
+        if watched is not None and memory_limit_mb:
+            try:
+                if watched.memory_info().rss > memory_limit_mb * 1024 * 1024:
+                    _kill(process)
+                    return _memory_error(memory_limit_mb), None
+            except psutil.Error:
+                pass
+
+    try:
+        result = json.loads(stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return f"Code execution error: 実行プロセスが異常終了しました (終了コード {process.returncode})。\n", None
+    if result.get("error"):
+        return result["error"], None
+    return None, "Code executed successfully."
+
+def _warn_memory_limit_unavailable(limit_mb):
+    global _memory_limit_warned
+    if _memory_limit_warned:
+        return
+    _memory_limit_warned = True
+    print(f"警告: この環境では resource も psutil も使えないため、生成コードのメモリ上限 ({limit_mb} MB) は適用されません。"
+          "制限するには、実行に使う Python に psutil をインストールしてください。")
+
+def _kill(process):
+    process.kill()
+    try:
+        process.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        pass
+
+def _find_document(desktop, doc_url):
+    """URL が一致するドキュメントを探す。未保存などで見つからない場合は現在のドキュメントを使う。"""
+    if doc_url:
+        components = desktop.getComponents().createEnumeration()
+        while components.hasMoreElements():
+            component = components.nextElement()
+            try:
+                if component.getURL() == doc_url:
+                    return component
+            except Exception:
+                continue
+    return desktop.getCurrentComponent()
+
+def main():
+    """
+    子プロセスとしての入口。標準入力の JSON に従ってコードを実行し、結果を標準出力の最終行に JSON で書く。
+    生成コードの print は標準エラー出力に回す。
+    """
+    result_stream = sys.stdout
+    sys.stdout = sys.stderr
+    request = json.loads(sys.stdin.read())
+    limit_mb = request.get("memory_limit_mb")
+    try:
+        session = UnoSession(request["connection_string"]).connect()
+        doc = _find_document(session.desktop, request.get("doc_url"))
+        # ブリッジの確立後に制限する (UNOライブラリの読み込みで上限に達しないように)
+        if resource is not None and limit_mb:
+            limit = limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        exec_generated(request["code"], doc, session.desktop, session.ctx)
+        result = {"error": None}
+    except MemoryError:
+        result = {"error": _memory_error(limit_mb)}
+    except Exception as e:
+        error_message = f"Code execution error: {type(e).__name__}: {e}\n"
+        error_message += "".join(traceback.format_exc())
+        result = {"error": error_message}
+    result_stream.write(json.dumps(result, ensure_ascii=False) + "\n")
+    result_stream.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,106 +1,521 @@
-import uno
+import re
 
-def get_calc_state(queries):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from libreoffice_manager import UnoSession
+from config import STATE_EXTRACTION_BATCHED, STATE_BOUNDING_RANGE_CELL_LIMIT, CELL_DIFF_MAX_LISTED, CELL_DIFF_CELL_LIMIT
+
+# 数式のエラーコード (XCell.getError の値) と、Calc のセルに表示されるエラー値
+# 一覧に無いコードは "Err:コード" と表示される
+ERROR_CODE_TEXTS = {
+    503: "#NUM!",
+    519: "#VALUE!",
+    521: "#NULL!",
+    524: "#REF!",
+    525: "#NAME?",
+    532: "#DIV/0!",
+    32767: "#N/A",
+}
+
+_CELL_PATTERN = re.compile(r"^\$?([A-Za-z]{1,3})\$?([0-9]+)$")
+
+
+def column_to_index(column):
+    """列名 ("A", "AB" など) を0始まりの列番号に変換する。"""
+    index = 0
+    for ch in column.upper():
+        index = index * 26 + (ord(ch) - ord("A") + 1)
+    return index - 1
+
+
+def index_to_column(index):
+    """0始まりの列番号を列名に変換する。"""
+    name = ""
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord("A") + rem) + name
+    return name
+
+
+def cell_name(col, row):
+    """0始まりの列・行番号から "B3" 形式のセル名を作る。"""
+    return f"{index_to_column(col)}{row + 1}"
+
+
+def split_sheet_reference(address):
     """
-    実行中のLibreOffice Calcインスタンスに接続し、指定された複数の情報を取得する。
+    "Sheet1.A1:B2" のようなアドレスをシート名と範囲に分割する。
+    シート名が無い場合は (None, address) を返す。
+    """
+    if "." in address:
+        sheet_name, ref = address.rsplit(".", 1)
+        sheet_name = sheet_name.lstrip("$").strip("'")
+        return sheet_name, ref
+    return None, address
 
-    Args:
-        queries (dict): 取得したい情報のクエリ。
-                        例: {"cell_value": "A1", "active_sheet_name": True, "sheet_count": True}
 
-    Returns:
-        dict: クエリに対する結果のキーと値のペア。
+def parse_range_reference(ref):
+    """
+    "A1" / "A1:C10" 形式の範囲を (開始列, 開始行, 終了列, 終了行) に変換する。
+    解釈できない (名前付き範囲など) 場合は None を返す。
+    """
+    parts = ref.split(":")
+    if len(parts) > 2:
+        return None
+    coords = []
+    for part in parts:
+        match = _CELL_PATTERN.match(part.strip())
+        if not match:
+            return None
+        coords.append((column_to_index(match.group(1)), int(match.group(2)) - 1))
+    (c0, r0), (c1, r1) = coords[0], coords[-1]
+    return min(c0, c1), min(r0, r1), max(c0, c1), max(r0, r1)
+
+
+def error_text(code):
+    """エラーコードを Calc の表示 ("#DIV/0!", "Err:502" など) に変換する。"""
+    return ERROR_CODE_TEXTS.get(code, f"Err:{code}")
+
+
+def read_cell_errors(cell_range, data, formulas, max_lookups=CELL_DIFF_MAX_LISTED):
+    """
+    getDataArray の結果からエラーのセルを探し、{(行, 列): エラー値の表示} を返す (範囲内の相対位置)。
+    getDataArray はエラーになった数式セルの値を文字列ではなく void (None) で返すため、
+    None の数式セルをエラーとみなし、表示はセルの getError() のエラーコードから求める。
+    エラーコードの取得はセルごとの呼び出しになるため先頭 max_lookups 件に限り、残りは "Err" とする。
+    """
+    errors = {}
+    for r, row in enumerate(data):
+        for c, value in enumerate(row):
+            if value is not None:
+                continue
+            formula = formulas[r][c] if formulas and r < len(formulas) and c < len(formulas[r]) else "="
+            if not (isinstance(formula, str) and formula.startswith("=")):
+                continue
+            text = "Err"
+            if len(errors) < max_lookups:
+                try:
+                    code = cell_range.getCellByPosition(c, r).getError()
+                    if code:
+                        text = error_text(code)
+                except Exception:
+                    pass
+            errors[(r, c)] = text
+    return errors
+
+
+def _sub_errors(errors, row_offset, col_offset, rows, cols):
+    """外接矩形の中で求めたエラーの位置を、部分範囲の相対位置に変換する。"""
+    return {(r - row_offset, c - col_offset): text for (r, c), text in errors.items()
+            if row_offset <= r < row_offset + rows and col_offset <= c < col_offset + cols}
+
+
+def describe_block(address, data, formulas, start_col=0, start_row=0, errors=None):
+    """
+    getDataArray / getFormulaArray の結果を、値・数式・型・エラーを持つ辞書にまとめる。
+    数式とエラーは存在する場合のみ含め、検証プロンプトを小さく保つ。
+    errors: read_cell_errors の結果。エラーのセルの値はエラー値の表示に置き換える。
+    """
+    values = [list(row) for row in data]
+    types = []
+    error_cells = []
+    has_formula = False
+    for r, row in enumerate(values):
+        type_row = []
+        for c, value in enumerate(row):
+            formula = formulas[r][c] if formulas else ""
+            if errors and (r, c) in errors:
+                row[c] = errors[(r, c)]
+                type_row.append("error")
+                error_cells.append({"cell": cell_name(start_col + c, start_row + r), "error": row[c]})
+            elif isinstance(formula, str) and formula.startswith("="):
+                type_row.append("formula")
+            elif isinstance(value, float):
+                type_row.append("number")
+            elif value == "":
+                type_row.append("empty")
+            else:
+                type_row.append("text")
+            if type_row[-1] == "formula" or (type_row[-1] == "error" and str(formula).startswith("=")):
+                has_formula = True
+        types.append(type_row)
+
+    entry = {"range": address, "values": values, "types": types}
+    if has_formula:
+        entry["formulas"] = [list(row) for row in formulas]
+    if error_cells:
+        entry["errors"] = error_cells
+    return entry
+
+
+def snapshot_used_area(sheet, max_cells=CELL_DIFF_CELL_LIMIT):
+    """
+    シートの使用範囲 (A1から最終セルまで) の値と数式を、getDataArray / getFormulaArray 各1回で取得する。
+    エラーのセルは "errors" に {(行, 列): エラー値の表示} として持つ。
+    使用範囲が max_cells を超える場合は読み込まずに None を返す。
+    """
+    cursor = sheet.createCursor()
+    cursor.gotoEndOfUsedArea(False)
+    used = cursor.getRangeAddress()
+    if (used.EndColumn + 1) * (used.EndRow + 1) > max_cells:
+        return None
+    block = sheet.getCellRangeByPosition(0, 0, used.EndColumn, used.EndRow)
+    values = block.getDataArray()
+    formulas = block.getFormulaArray()
+    return {
+        "end_col": used.EndColumn,
+        "end_row": used.EndRow,
+        "values": values,
+        "formulas": formulas,
+        "errors": read_cell_errors(block, values, formulas),
+    }
+
+
+def _padded(grid, rows, cols):
+    """行列を rows x cols に "" で埋めた object 配列にする。"""
+    array = np.full((rows, cols), "", dtype=object)
+    for r, row in enumerate(grid):
+        array[r, :len(row)] = row
+    return array
+
+
+def _changed_positions(before, after, rows, cols):
+    """値または数式が変わったセルの (行, 列) を行優先で返す。NumPy があればベクトル化して比較する。"""
+    if np is not None:
+        changed = (_padded(before["values"], rows, cols) != _padded(after["values"], rows, cols)) | \
+                  (_padded(before["formulas"], rows, cols) != _padded(after["formulas"], rows, cols))
+        return [(int(r), int(c)) for r, c in np.argwhere(changed)]
+
+    def cell(grid, r, c):
+        return grid[r][c] if r < len(grid) and c < len(grid[r]) else ""
+
+    def row(grid, r):
+        return grid[r] if r < len(grid) else ()
+
+    positions = []
+    for r in range(rows):
+        # 行単位の比較で、変更の無い行はセルごとの比較を省く
+        if (row(before["values"], r) == row(after["values"], r)
+                and row(before["formulas"], r) == row(after["formulas"], r)):
+            continue
+        for c in range(cols):
+            if (cell(before["values"], r, c) != cell(after["values"], r, c)
+                    or cell(before["formulas"], r, c) != cell(after["formulas"], r, c)):
+                positions.append((r, c))
+    return positions
+
+
+def diff_snapshots(before, after, max_listed=CELL_DIFF_MAX_LISTED):
+    """
+    snapshot_used_area の結果2つを比較し、変更されたセルの要約を返す。
+    変更セルは先頭 max_listed 件のみ列挙し、件数・範囲・新たに発生したエラーは全件から集計する。
+    位置の比較だけでは行の挿入や並べ替えで移動したエラーも新しいエラーに見えるため、
+    "new_errors" はエラーのセル数が増えた場合と、実行前に無かった数式がエラーになった場合に限る。
+    それ以外で位置が変わったエラーは "moved_errors" として検証モデルに判断を任せる。
+    """
+    rows = max(before["end_row"], after["end_row"]) + 1
+    cols = max(before["end_col"], after["end_col"]) + 1
+    positions = _changed_positions(before, after, rows, cols)
+
+    def cell(grid, r, c):
+        return grid[r][c] if r < len(grid) and c < len(grid[r]) else ""
+
+    summary = {
+        "used_range_before": f"A1:{cell_name(before['end_col'], before['end_row'])}",
+        "used_range_after": f"A1:{cell_name(after['end_col'], after['end_row'])}",
+        "changed_count": len(positions),
+    }
+    if not positions:
+        return summary
+
+    summary["bounds"] = "{}:{}".format(
+        cell_name(min(c for _, c in positions), min(r for r, _ in positions)),
+        cell_name(max(c for _, c in positions), max(r for r, _ in positions)))
+
+    before_errors = before.get("errors") or {}
+    after_errors = after.get("errors") or {}
+    errors_increased = len(after_errors) > len(before_errors)
+    if before_errors or after_errors:
+        summary["error_count_before"] = len(before_errors)
+        summary["error_count_after"] = len(after_errors)
+    before_formulas = {formula for row in before["formulas"] for formula in row
+                       if isinstance(formula, str) and formula.startswith("=")}
+    cells = []
+    new_errors = []
+    moved_errors = []
+    for r, c in positions:
+        value = after_errors.get((r, c), cell(after["values"], r, c))
+        if (r, c) in after_errors and (r, c) not in before_errors:
+            error = {"cell": cell_name(c, r), "error": value}
+            if errors_increased or cell(after["formulas"], r, c) not in before_formulas:
+                new_errors.append(error)
+            else:
+                moved_errors.append(error)
+        if len(cells) < max_listed:
+            entry = {"cell": cell_name(c, r), "before": before_errors.get((r, c), cell(before["values"], r, c)),
+                     "after": value}
+            formula = cell(after["formulas"], r, c)
+            if isinstance(formula, str) and formula.startswith("="):
+                entry["formula"] = formula
+            cells.append(entry)
+    summary["cells"] = cells
+    if len(positions) > max_listed:
+        summary["truncated"] = True
+    if new_errors:
+        summary["new_errors"] = new_errors[:max_listed]
+    if moved_errors:
+        summary["moved_errors"] = moved_errors[:max_listed]
+    return summary
+
+
+def _read_cell_values_batched(doc, addresses):
+    """
+    要求された範囲をシートごとにまとめ、外接矩形の getDataArray / getFormulaArray
+    各1回で取得する。外接矩形が大きすぎる場合や解釈できない範囲は個別に取得する。
     """
     results = {}
-    try:
-        # UNOコンポーネントの取得
-        local_context = uno.getComponentContext()
-        resolver = local_context.ServiceManager.createInstanceWithContext(
-            "com.sun.star.bridge.UnoUrlResolver", local_context)
-        context = resolver.resolve(
-            "uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
-        desktop = context.ServiceManager.createInstanceWithContext(
-            "com.sun.star.frame.Desktop", context)
-        
-        doc = desktop.getCurrentComponent()
-        if not hasattr(doc, "Sheets"):
-            return {"error": "アクティブなドキュメントがCalcのスプレッドシートではありません。"}
+    groups = {}
+    for address in addresses:
+        sheet_name, ref = split_sheet_reference(address)
+        groups.setdefault(sheet_name, []).append((address, ref, parse_range_reference(ref)))
 
-        # クエリに基づいて情報を収集
-        if queries.get("cell_values"):
-            for cell_address in queries["cell_values"]:
+    active_sheet = None
+    for sheet_name, items in groups.items():
+        try:
+            if sheet_name is None:
+                if active_sheet is None:
+                    active_sheet = doc.getCurrentController().getActiveSheet()
+                sheet = active_sheet
+            else:
+                sheet = doc.Sheets.getByName(sheet_name)
+        except Exception as e:
+            for address, _, _ in items:
+                results[address] = {"range": address, "error": f"シートの取得に失敗: {e}"}
+            continue
+
+        parsed = [item for item in items if item[2] is not None]
+        individual = [item for item in items if item[2] is None]
+        if parsed:
+            c0 = min(p[0] for _, _, p in parsed)
+            r0 = min(p[1] for _, _, p in parsed)
+            c1 = max(p[2] for _, _, p in parsed)
+            r1 = max(p[3] for _, _, p in parsed)
+            if (c1 - c0 + 1) * (r1 - r0 + 1) <= STATE_BOUNDING_RANGE_CELL_LIMIT:
                 try:
-                    if "." in cell_address:
-                        sheet_name, cell = cell_address.split(".", 1)
-                        sheet = doc.Sheets.getByName(sheet_name)
-                    else:
-                        sheet = doc.getCurrentController().getActiveSheet()
-                        cell = cell_address
-                    
-                    cell_range = sheet.getCellRangeByName(cell)
-                    # データを行列として取得
-                    data_array = cell_range.getDataArray()
-                    
-                    # 取得したデータを文字列に変換
-                    value_str = str(data_array)
-
-                    results[f"cell_values_{cell_address}"] = f"セル範囲 {cell_address} の値: {value_str}"
+                    block = sheet.getCellRangeByPosition(c0, r0, c1, r1)
+                    data = block.getDataArray()
+                    formulas = block.getFormulaArray()
+                    errors = read_cell_errors(block, data, formulas)
+                    for address, _, (sc, sr, ec, er) in parsed:
+                        sub_data = [row[sc - c0:ec - c0 + 1] for row in data[sr - r0:er - r0 + 1]]
+                        sub_formulas = [row[sc - c0:ec - c0 + 1] for row in formulas[sr - r0:er - r0 + 1]]
+                        sub_errors = _sub_errors(errors, sr - r0, sc - c0, er - sr + 1, ec - sc + 1)
+                        results[address] = describe_block(address, sub_data, sub_formulas, sc, sr, sub_errors)
                 except Exception as e:
-                    results[f"cell_values_{cell_address}"] = f"セル範囲 {cell_address} の値の取得に失敗: {e}"
+                    for address, _, _ in parsed:
+                        results[address] = {"range": address, "error": f"値の取得に失敗: {e}"}
+            else:
+                individual.extend(parsed)
 
-        if queries.get("active_sheet_name"):
+        for address, ref, bounds in individual:
             try:
-                sheet = doc.getCurrentController().getActiveSheet()
-                results["active_sheet_name"] = f"アクティブシート名: {sheet.getName()}"
+                cell_range = sheet.getCellRangeByName(ref)
+                range_address = cell_range.getRangeAddress()
+                data = cell_range.getDataArray()
+                formulas = cell_range.getFormulaArray()
+                results[address] = describe_block(
+                    address, data, formulas, range_address.StartColumn, range_address.StartRow,
+                    read_cell_errors(cell_range, data, formulas))
             except Exception as e:
-                results["active_sheet_name"] = f"アクティブシート名の取得に失敗: {e}"
+                results[address] = {"range": address, "error": f"値の取得に失敗: {e}"}
 
-        if queries.get("sheet_count"):
-            try:
-                count = doc.Sheets.getCount()
-                results["sheet_count"] = f"シートの総数: {count}"
-            except Exception as e:
-                results["sheet_count"] = f"シート数の取得に失敗: {e}"
+    # 要求された順序で返す
+    return {address: results[address] for address in addresses if address in results}
 
-        if queries.get("sheet_names"):
-            try:
-                names = doc.Sheets.getElementNames()
-                results["sheet_names"] = f"全シート名: {list(names)}"
-            except Exception as e:
-                results["sheet_names"] = f"全シート名の取得に失敗: {e}"
 
-        if queries.get("chart_count"):
-            try:
-                sheet = doc.getCurrentController().getActiveSheet()
-                count = sheet.getCharts().getCount()
-                results["chart_count"] = f"アクティブシートのグラフ数: {count}"
-            except Exception as e:
-                results["chart_count"] = f"グラフ数の取得に失敗: {e}"
+def _get_calc_state_batched(queries, doc, desktop):
+    """
+    クエリ結果を型付きの値 (数値・リスト・辞書) で返す。
+    """
+    results = {}
+    if queries.get("cell_values"):
+        results["cell_values"] = _read_cell_values_batched(doc, list(queries["cell_values"]))
 
-        if queries.get("chart_types"):
-            try:
-                sheet = doc.getCurrentController().getActiveSheet()
-                charts = sheet.getCharts()
-                chart_info = {}
-                for i in range(charts.getCount()):
-                    chart_shape = charts.getByIndex(i)
-                    chart_doc = chart_shape.getEmbeddedObject()
-                    diagram = chart_doc.getDiagram()
+    active_sheet = None
+    if queries.get("active_sheet_name") or queries.get("chart_count") or queries.get("chart_types"):
+        try:
+            active_sheet = doc.getCurrentController().getActiveSheet()
+        except Exception as e:
+            results["error"] = f"アクティブシートの取得に失敗: {e}"
+
+    if queries.get("active_sheet_name") and active_sheet is not None:
+        try:
+            results["active_sheet_name"] = active_sheet.getName()
+        except Exception as e:
+            results["active_sheet_name"] = {"error": str(e)}
+
+    if queries.get("sheet_count"):
+        try:
+            results["sheet_count"] = doc.Sheets.getCount()
+        except Exception as e:
+            results["sheet_count"] = {"error": str(e)}
+
+    if queries.get("sheet_names"):
+        try:
+            results["sheet_names"] = list(doc.Sheets.getElementNames())
+        except Exception as e:
+            results["sheet_names"] = {"error": str(e)}
+
+    charts = None
+    if (queries.get("chart_count") or queries.get("chart_types")) and active_sheet is not None:
+        try:
+            charts = active_sheet.getCharts()
+        except Exception as e:
+            results["chart_count"] = {"error": str(e)}
+
+    if queries.get("chart_count") and charts is not None:
+        try:
+            results["chart_count"] = charts.getCount()
+        except Exception as e:
+            results["chart_count"] = {"error": str(e)}
+
+    if queries.get("chart_types") and charts is not None:
+        try:
+            chart_info = {}
+            for i in range(charts.getCount()):
+                chart_shape = charts.getByIndex(i)
+                diagram = chart_shape.getEmbeddedObject().getDiagram()
+                # getDiagramType は "com.sun.star.chart.LineDiagram" のようなサービス名を返す
+                if hasattr(diagram, "getDiagramType"):
+                    chart_info[chart_shape.getName()] = diagram.getDiagramType()
+                else:
                     chart_info[chart_shape.getName()] = diagram.getImplementationName()
-                results["chart_types"] = f"各グラフの種類: {chart_info}"
-            except Exception as e:
-                results["chart_types"] = f"グラフの種類の取得に失敗: {e}"
+            results["chart_types"] = chart_info
+        except Exception as e:
+            results["chart_types"] = {"error": str(e)}
+
+    if queries.get("document_count"):
+        try:
+            components = desktop.getComponents()
+            results["document_count"] = sum(1 for comp in components if hasattr(comp, "Sheets"))
+        except Exception as e:
+            results["document_count"] = {"error": str(e)}
 
-        if queries.get("document_count"):
+    return results
+
+
+def _get_calc_state_prose(queries, doc, desktop):
+    """
+    従来形式 (日本語の説明文) でクエリ結果を返す。
+    """
+    results = {}
+    # クエリに基づいて情報を収集
+    if queries.get("cell_values"):
+        for cell_address in queries["cell_values"]:
             try:
-                components = desktop.getComponents()
-                # com.sun.star.sheet.SpreadsheetDocument をサポートするコンポーネントを数える
-                doc_count = sum(1 for comp in components if hasattr(comp, "Sheets"))
-                results["document_count"] = f"Calcドキュメントの総数: {doc_count}"
+                if "." in cell_address:
+                    sheet_name, cell = cell_address.split(".", 1)
+                    sheet = doc.Sheets.getByName(sheet_name)
+                else:
+                    sheet = doc.getCurrentController().getActiveSheet()
+                    cell = cell_address
+
+                cell_range = sheet.getCellRangeByName(cell)
+                # データを行列として取得
+                data_array = cell_range.getDataArray()
+
+                # 取得したデータを文字列に変換
+                value_str = str(data_array)
+
+                results[f"cell_values_{cell_address}"] = f"セル範囲 {cell_address} の値: {value_str}"
             except Exception as e:
-                results["document_count"] = f"ドキュメント数の取得に失敗: {e}"
+                results[f"cell_values_{cell_address}"] = f"セル範囲 {cell_address} の値の取得に失敗: {e}"
+
+    if queries.get("active_sheet_name"):
+        try:
+            sheet = doc.getCurrentController().getActiveSheet()
+            results["active_sheet_name"] = f"アクティブシート名: {sheet.getName()}"
+        except Exception as e:
+            results["active_sheet_name"] = f"アクティブシート名の取得に失敗: {e}"
+
+    if queries.get("sheet_count"):
+        try:
+            count = doc.Sheets.getCount()
+            results["sheet_count"] = f"シートの総数: {count}"
+        except Exception as e:
+            results["sheet_count"] = f"シート数の取得に失敗: {e}"
+
+    if queries.get("sheet_names"):
+        try:
+            names = doc.Sheets.getElementNames()
+            results["sheet_names"] = f"全シート名: {list(names)}"
+        except Exception as e:
+            results["sheet_names"] = f"全シート名の取得に失敗: {e}"
+
+    if queries.get("chart_count"):
+        try:
+            sheet = doc.getCurrentController().getActiveSheet()
+            count = sheet.getCharts().getCount()
+            results["chart_count"] = f"アクティブシートのグラフ数: {count}"
+        except Exception as e:
+            results["chart_count"] = f"グラフ数の取得に失敗: {e}"
+
+    if queries.get("chart_types"):
+        try:
+            sheet = doc.getCurrentController().getActiveSheet()
+            charts = sheet.getCharts()
+            chart_info = {}
+            for i in range(charts.getCount()):
+                chart_shape = charts.getByIndex(i)
+                chart_doc = chart_shape.getEmbeddedObject()
+                diagram = chart_doc.getDiagram()
+                chart_info[chart_shape.getName()] = diagram.getImplementationName()
+            results["chart_types"] = f"各グラフの種類: {chart_info}"
+        except Exception as e:
+            results["chart_types"] = f"グラフの種類の取得に失敗: {e}"
+
+    if queries.get("document_count"):
+        try:
+            components = desktop.getComponents()
+            # com.sun.star.sheet.SpreadsheetDocument をサポートするコンポーネントを数える
+            doc_count = sum(1 for comp in components if hasattr(comp, "Sheets"))
+            results["document_count"] = f"Calcドキュメントの総数: {doc_count}"
+        except Exception as e:
+            results["document_count"] = f"ドキュメント数の取得に失敗: {e}"
+
+    return results
+
+
+def get_calc_state(queries, session=None, batched=None):
+    """
+    実行中のLibreOffice Calcインスタンスから、指定された複数の情報を取得する。
+
+    Args:
+        queries (dict): 取得したい情報のクエリ。
+                        例: {"cell_values": ["A1", "Sheet2.B1:C3"], "active_sheet_name": True, "sheet_count": True}
+        session (UnoSession): 共有のUNOセッション。省略時はその場で接続する。
+        batched (bool): True の場合、範囲をシートごとにまとめて取得し、型付きのJSONを返す。
+                        省略時は config.STATE_EXTRACTION_BATCHED に従う。
+
+    Returns:
+        dict: クエリに対する結果のキーと値のペア。
+    """
+    if batched is None:
+        batched = STATE_EXTRACTION_BATCHED
+    try:
+        # UNOコンポーネントの取得 (セッションがあれば接続を使い回す)
+        if session is None:
+            session = UnoSession()
+        desktop = session.desktop
+        doc = session.doc
+        if not hasattr(doc, "Sheets"):
+            return {"error": "アクティブなドキュメントがCalcのスプレッドシートではありません。"}
 
+        if batched:
+            return _get_calc_state_batched(queries, doc, desktop)
+        return _get_calc_state_prose(queries, doc, desktop)
     except Exception as e:
-        results["error"] = f"Calcの状態取得中にエラーが発生しました: {e}"
-    
-    return results
\ No newline at end of file
+        return {"error": f"Calcの状態取得中にエラーが発生しました: {e}"}
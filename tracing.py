@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+from config import TRACE_FILE, PROMETHEUS_FILE
+
+# Ollama の応答に含まれる計測値のうち、ナノ秒単位のもの
+_LLM_DURATION_FIELDS = ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+_LLM_COUNT_FIELDS = ("prompt_eval_count", "eval_count")
+
+# 現在のスレッドのトレース文脈 (task / iteration / candidate)
+_local = threading.local()
+
+def current_context():
+    return dict(getattr(_local, "context", {}))
+
+@contextlib.contextmanager
+def context(**values):
+    """
+    ブロック内で記録するスパンに task / iteration などの文脈を付ける。
+    """
+    previous = current_context()
+    _local.context = dict(previous, **values)
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+def propagate(fn):
+    """現在のスレッドの文脈を引き継いで fn を実行する関数を返す (別スレッドに渡す処理に使う)。"""
+    captured = current_context()
+
+    def run(*args, **kwargs):
+        previous = current_context()
+        _local.context = captured
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.context = previous
+    return run
+
+def new_task_id():
+    return uuid.uuid4().hex[:12]
+
+
+class Span:
+    """1つの処理区間。attrs に追加した値もトレースに書き出される。"""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.context = current_context()
+        self.start = time.time()
+        self.duration = None
+
+    def record_llm(self, stats):
+        """llm_wrapper.get_last_call_stats() の値 (モデル名・トークン数・所要時間) をスパンに付ける。"""
+        self.attrs["llm"] = stats
+
+
+class Tracer:
+    """
+    スパンを JSONL のトレースファイルに1行ずつ追記し、Prometheus 形式の集計値を保持する。
+    trace_path が None の場合はファイルに書かず、集計だけ行う。
+    """
+
+    def __init__(self, trace_path=TRACE_FILE, prometheus_path=PROMETHEUS_FILE):
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._span_totals = {}
+        self._llm_totals = {}
+        self._task_totals = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        span = Span(name, attrs)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            self._record(span)
+
+    def _record(self, span):
+        entry = {"type": "span", "name": span.name, "start": round(span.start, 6),
+                 "duration": round(span.duration, 6)}
+        entry.update(span.context)
+        if span.attrs:
+            entry["attrs"] = span.attrs
+        with self._lock:
+            count, total = self._span_totals.get(span.name, (0, 0.0))
+            self._span_totals[span.name] = (count + 1, total + span.duration)
+            stats = span.attrs.get("llm")
+            if stats:
+                self._add_llm_totals(span.name, stats)
+            self._write(entry)
+
+    def _add_llm_totals(self, span_name, stats):
+        key = (span_name, stats.get("model") or "")
+        fields = ("calls", "cache_hits") + _LLM_DURATION_FIELDS + _LLM_COUNT_FIELDS
+        totals = self._llm_totals.setdefault(key, dict.fromkeys(fields, 0))
+        totals["calls"] += 1
+        if stats.get("cache_hit"):
+            totals["cache_hits"] += 1
+        for field in _LLM_DURATION_FIELDS + _LLM_COUNT_FIELDS:
+            totals[field] += stats.get(field, 0)
+
+    def record_task(self, status, **attrs):
+        """タスク1件の結果をトレースに書き、成否ごとの件数を数える。"""
+        entry = {"type": "task", "status": status, "time": round(time.time(), 6)}
+        entry.update(current_context())
+        entry.update(attrs)
+        with self._lock:
+            self._task_totals[status] = self._task_totals.get(status, 0) + 1
+            self._write(entry)
+        self.write_prometheus()
+
+    def _write(self, entry):
+        if not self.trace_path:
+            return
+        try:
+            with open(self.trace_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"トレースの書き込みに失敗しました: {e}")
+
+    def prometheus_text(self):
+        """集計値を Prometheus のテキスト形式で返す。"""
+        with self._lock:
+            span_totals = dict(self._span_totals)
+            llm_totals = {key: dict(value) for key, value in self._llm_totals.items()}
+            task_totals = dict(self._task_totals)
+
+        lines = [
+            "# HELP autospreadsheet_span_seconds Time spent in each phase.",
+            "# TYPE autospreadsheet_span_seconds summary",
+        ]
+        for name, (count, total) in sorted(span_totals.items()):
+            lines.append(f'autospreadsheet_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'autospreadsheet_span_seconds_count{{span="{name}"}} {count}')
+
+        llm_metrics = [
+            ("calls", "autospreadsheet_llm_calls_total", "LLM requests.", 1),
+            ("cache_hits", "autospreadsheet_llm_cache_hits_total", "LLM requests answered from the response cache.", 1),
+            ("prompt_eval_count", "autospreadsheet_llm_prompt_tokens_total", "Prompt tokens evaluated by Ollama.", 1),
+            ("eval_count", "autospreadsheet_llm_eval_tokens_total", "Tokens generated by Ollama.", 1),
+        ] + [
+            (field, f"autospreadsheet_llm_{field}_seconds_total", f"Ollama {field} in seconds.", 1e-9)
+            for field in _LLM_DURATION_FIELDS
+        ]
+        for field, metric, help_text, scale in llm_metrics:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (span_name, model), totals in sorted(llm_totals.items()):
+                value = totals[field] * scale
+                lines.append(f'{metric}{{span="{span_name}",model="{model}"}} {value:g}')
+
+        lines.append("# HELP autospreadsheet_tasks_total Finished tasks by status.")
+        lines.append("# TYPE autospreadsheet_tasks_total counter")
+        for status, count in sorted(task_totals.items()):
+            lines.append(f'autospreadsheet_tasks_total{{status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """prometheus_path が設定されていれば、集計値をファイルに書き出す (node_exporter の textfile 形式)。"""
+        if not self.prometheus_path:
+            return
+        temp_path = self.prometheus_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(temp_path, self.prometheus_path)
+        except OSError as e:
+            print(f"Prometheus形式のメトリクスの書き込みに失敗しました: {e}")
+
+
+_tracer = Tracer()
+
+def get_tracer():
+    return _tracer
+
+def span(name, **attrs):
+    """既定のトレーサーでスパンを記録する。"""
+    return _tracer.span(name, **attrs)